@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+bench_sqlite_db.py
+
+Benchmark suite for the sqlite_db layer at production scale
+
+Notes
+-----
+- Docstrings follow the numpydoc style:
+  https://numpydoc.readthedocs.io/en/latest/format.html
+- Code follows the PEP 8 style guide:
+  https://www.python.org/dev/peps/pep-0008/
+"""
+from datetime import datetime, timedelta
+from sqlite_db import HumidityDB, Co2DB
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+import constants as c
+
+START_TIME = datetime(2021, 1, 1)
+READING_INTERVAL_SECS = 30
+DEVICES = 1000
+LOCATIONS = 50
+DB_CLASSES = {'humidity': HumidityDB, 'co2': Co2DB}
+MASK64 = (1 << 64) - 1
+
+
+def mix64(value):
+    """
+    SplitMix64 finalizer, spreads consecutive integers over 64 bits
+
+    Parameters
+    ----------
+    value : int
+
+    Returns
+    -------
+    int
+    """
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+def make_reading(kind, index, seed=0):
+    """
+    Build one synthetic reading straight from its index
+
+    Parameters
+    ----------
+    kind : str
+        'humidity' or 'co2'
+    index : int
+        Position of the reading, one per device per interval
+    seed : int
+
+    Returns
+    -------
+    record : dict
+        Record suitable for SqliteDB.add_record
+    """
+    device = index % DEVICES
+    created = START_TIME + timedelta(
+        seconds=(index // DEVICES) * READING_INTERVAL_SECS)
+    fraction = (mix64((seed << 40) | index) >> 11) / float(1 << 53)
+    if kind == 'humidity':
+        value = round(c.HUMIDITY_MIN +
+                      (c.HUMIDITY_MAX - c.HUMIDITY_MIN) * fraction, 2)
+    else:
+        value = c.CO2_MIN + int((c.CO2_MAX - c.CO2_MIN + 1) * fraction)
+
+    return {'date': created.strftime('%Y-%m-%d'),
+            'time': created.strftime('%H:%M:%S'),
+            'id': device,
+            'location': 'Room {}'.format(device % LOCATIONS),
+            kind: value}
+
+
+def generate_readings(kind, count, seed=0):
+    """
+    Generate synthetic readings, one per device per interval
+
+    Parameters
+    ----------
+    kind : str
+        'humidity' or 'co2'
+    count : int
+        Number of readings to generate
+    seed : int
+
+    Yields
+    ------
+    record : dict
+        Record suitable for SqliteDB.add_record
+    """
+    for i in range(count):
+        yield make_reading(kind, i, seed)
+
+
+class Benchmark:
+    """
+    Runs & records timed benchmark cases against one DB file
+    """
+
+    def __init__(self, kind, db_file, rows):
+        """
+        Parameters
+        ----------
+        kind : str
+            'humidity' or 'co2'
+        db_file : str
+        rows : int
+            Number of rows loaded before query benchmarks
+        """
+        self.__kind = kind
+        self.__db_class = DB_CLASSES[kind]
+        self.__db_file = db_file
+        self.__rows = rows
+        self.__results = {}
+
+        with self.__db_class(db_file=db_file) as db:
+            if not db.table_exists():
+                db.create_table()
+
+    @property
+    def results(self):
+        """
+        dict : results keyed by benchmark case name
+        """
+        return self.__results
+
+    def __record(self, name, seconds, ops):
+        """
+        Record the result of a benchmark case
+
+        Parameters
+        ----------
+        name : str
+        seconds : float
+        ops : int
+        """
+        self.__results[name] = {
+            'seconds': round(seconds, 6),
+            'ops': ops,
+            'ops_per_sec': round(ops / seconds, 2) if seconds else None}
+        logging.info('{}/{}: {} ops in {:.3f} s'.format(
+            self.__kind, name, ops, seconds))
+
+    def single_insert(self, count):
+        """
+        Insert records one context (transaction) at a time,
+        as CloudParser does
+
+        Parameters
+        ----------
+        count : int
+        """
+        start = time.perf_counter()
+        for record in generate_readings(self.__kind, count, seed=1):
+            with self.__db_class(db_file=self.__db_file) as db:
+                db.add_record(record)
+        self.__record('single_insert', time.perf_counter() - start, count)
+
+    def bulk_insert(self):
+        """
+        Insert all benchmark rows within a single context
+        """
+        start = time.perf_counter()
+        with self.__db_class(db_file=self.__db_file) as db:
+            for record in generate_readings(self.__kind, self.__rows):
+                db.add_record(record)
+        self.__record('bulk_insert', time.perf_counter() - start,
+                      self.__rows)
+
+    def record_exists(self, count):
+        """
+        Check existing records for duplicates, as done before each insert
+
+        Parameters
+        ----------
+        count : int
+        """
+        rng = random.Random(2)
+        indexes = set(rng.randrange(self.__rows) for _ in range(count))
+        samples = [make_reading(self.__kind, i) for i in sorted(indexes)]
+
+        start = time.perf_counter()
+        with self.__db_class(db_file=self.__db_file) as db:
+            for record in samples:
+                db.record_exists(record)
+        self.__record('record_exists', time.perf_counter() - start,
+                      len(samples))
+
+    def range_query(self, count, window_secs=3600):
+        """
+        Aggregate random time windows of the loaded readings
+
+        Parameters
+        ----------
+        count : int
+        window_secs : int
+        """
+        span = (self.__rows // DEVICES) * READING_INTERVAL_SECS
+        rng = random.Random(3)
+        windows = []
+        for _ in range(count):
+            begin = START_TIME + timedelta(
+                seconds=rng.randrange(max(span, 1)))
+            end = begin + timedelta(seconds=window_secs)
+            windows.append((begin.strftime('%Y-%m-%d %H:%M:%S'),
+                            end.strftime('%Y-%m-%d %H:%M:%S')))
+
+        start = time.perf_counter()
+        with self.__db_class(db_file=self.__db_file) as db:
+            for begin, end in windows:
+                db.aggregate('avg', start=begin, end=end)
+        self.__record('range_query', time.perf_counter() - start, count)
+
+    def export(self):
+        """
+        Export every record of the table through get_records()
+        """
+        start = time.perf_counter()
+        with self.__db_class(db_file=self.__db_file) as db:
+            exported = len(db.get_records())
+        self.__record('export', time.perf_counter() - start, exported)
+
+
+def git_commit():
+    """
+    Get the commit being benchmarked
+
+    Returns
+    -------
+    str
+        Commit hash, None if unavailable
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """
+    Run all benchmark cases
+
+    Parameters
+    ----------
+    args : Namespace
+
+    Returns
+    -------
+    report : dict
+        Machine-readable benchmark report
+    """
+    report = {'commit': git_commit(),
+              'timestamp': time.time(),
+              'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version,
+              'rows': args.rows,
+              'results': {}}
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for kind in args.tables:
+            db_file = os.path.join(tmp, '{}.db'.format(kind))
+            bench = Benchmark(kind, db_file, args.rows)
+            bench.bulk_insert()
+            bench.single_insert(args.single_inserts)
+            bench.record_exists(args.lookups)
+            bench.range_query(args.lookups)
+            if not args.skip_export:
+                bench.export()
+            report['results'][kind] = bench.results
+
+    return report
+
+
+def parse_args():
+    """
+    Parses arguments for the benchmark suite
+
+    Returns
+    -------
+    args : Namespace
+        Populated attributes based on args
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sqlite_db layer')
+
+    parser.add_argument('-v',
+                        '--verbose',
+                        default=False,
+                        action='store_true',
+                        help='Print all debug logs')
+
+    parser.add_argument('-n',
+                        '--rows',
+                        metavar='<rows>',
+                        default=1000000,
+                        type=int,
+                        help='Synthetic readings per table. Default: 1000000')
+
+    parser.add_argument('--single-inserts',
+                        metavar='<count>',
+                        default=1000,
+                        type=int,
+                        help='Records inserted one transaction at a time. '
+                             'Default: 1000')
+
+    parser.add_argument('--lookups',
+                        metavar='<count>',
+                        default=100,
+                        type=int,
+                        help='Dedup checks & range queries. Default: 100')
+
+    parser.add_argument('-t',
+                        '--tables',
+                        nargs='*',
+                        choices=sorted(DB_CLASSES),
+                        default=sorted(DB_CLASSES),
+                        help='Tables to benchmark. Default: all')
+
+    parser.add_argument('--skip-export',
+                        default=False,
+                        action='store_true',
+                        help='Skip full exports (memory bound at scale)')
+
+    parser.add_argument('-d',
+                        '--dir',
+                        metavar='<directory>',
+                        default=None,
+                        help='Directory for temporary DB files')
+
+    parser.add_argument('-o',
+                        '--output',
+                        metavar='<file>',
+                        default=None,
+                        help='Write JSON results to file (default: stdout)')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging_level = logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(format=c.LOGGING_FORMAT, level=logging_level)
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
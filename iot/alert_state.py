@@ -0,0 +1,215 @@
+"""
+alert_state.py
+
+Per-device & per-location alert state for DataPoller
+
+Notes
+-----
+- Docstrings follow the numpydoc style:
+  https://numpydoc.readthedocs.io/en/latest/format.html
+- Code follows the PEP 8 style guide:
+  https://www.python.org/dev/peps/pep-0008/
+"""
+from collections import OrderedDict
+import logging
+import time
+
+DEVICE_IDLE_SECS = 3600
+
+
+class DeviceState:
+    """
+    Alert state of a single device
+    """
+    __slots__ = ('location', 'last_seen', 'humidity_warning', 'co2_warning',
+                 'humidity_first', 'co2_first')
+
+    def __init__(self, location, now):
+        """
+        Parameters
+        ----------
+        location : str
+        now : float
+            Monotonic time the device was seen
+        """
+        self.location = location
+        self.last_seen = now
+
+        # Flag to be reset if true after values become safe
+        self.humidity_warning = False
+        self.co2_warning = False
+
+        # Flag to be set false after first message processing
+        self.humidity_first = True
+        self.co2_first = True
+
+
+class LocationState:
+    """
+    Number of devices & devices in warning at one location
+    """
+    __slots__ = ('devices', 'humidity_warnings', 'co2_warnings')
+
+    def __init__(self):
+        self.devices = 0
+        self.humidity_warnings = 0
+        self.co2_warnings = 0
+
+
+class AlertStateTable:
+    """
+    Alert state of every device, with per-location warning counts
+
+    Devices are kept in least recently seen order, so lookups & idle
+    eviction are O(1) per device.
+    """
+
+    def __init__(self, idle_secs=DEVICE_IDLE_SECS):
+        """
+        Parameters
+        ----------
+        idle_secs : float
+            Seconds without readings before a device's state is dropped
+        """
+        self.__idle_secs = idle_secs
+        self.__devices = OrderedDict()
+        self.__locations = {}
+
+    def __len__(self):
+        return len(self.__devices)
+
+    def get(self, device_id, location):
+        """
+        Get the state of a device, creating it on first sight
+
+        Parameters
+        ----------
+        device_id : int
+        location : str
+
+        Returns
+        -------
+        state : DeviceState
+        """
+        now = time.monotonic()
+        state = self.__devices.get(device_id)
+        if state is None:
+            state = DeviceState(location, now)
+            self.__devices[device_id] = state
+            self.__location(location).devices += 1
+        else:
+            state.last_seen = now
+            self.__devices.move_to_end(device_id)
+            if location and location != state.location:
+                self.__move(state, location)
+        return state
+
+    def set_warning(self, state, kind, warning):
+        """
+        Update the warning flag of a device & its location's counts
+
+        Parameters
+        ----------
+        state : DeviceState
+        kind : str
+            'humidity' or 'co2'
+        warning : bool
+        """
+        location = self.__location(state.location)
+        if kind == 'humidity':
+            if warning != state.humidity_warning:
+                location.humidity_warnings += 1 if warning else -1
+            state.humidity_warning = warning
+            state.humidity_first = False
+        else:
+            if warning != state.co2_warning:
+                location.co2_warnings += 1 if warning else -1
+            state.co2_warning = warning
+            state.co2_first = False
+
+    def location(self, location):
+        """
+        Get the state of a location
+
+        Parameters
+        ----------
+        location : str
+
+        Returns
+        -------
+        LocationState
+            None if no device at the location is tracked
+        """
+        return self.__locations.get(location)
+
+    def evict_idle(self):
+        """
+        Drop the state of devices idle for longer than idle_secs
+
+        Returns
+        -------
+        evicted : int
+            Number of devices dropped
+        """
+        evicted = 0
+        expiry = time.monotonic() - self.__idle_secs
+        while self.__devices:
+            device_id, state = next(iter(self.__devices.items()))
+            if state.last_seen > expiry:
+                break
+            del self.__devices[device_id]
+            self.__release(state)
+            evicted += 1
+
+        if evicted:
+            logging.debug('Evicted {} idle devices'.format(evicted))
+        return evicted
+
+    def __location(self, location):
+        """
+        Get or create the state of a location
+
+        Parameters
+        ----------
+        location : str
+
+        Returns
+        -------
+        LocationState
+        """
+        state = self.__locations.get(location)
+        if state is None:
+            state = LocationState()
+            self.__locations[location] = state
+        return state
+
+    def __release(self, state):
+        """
+        Remove a device from its location's counts
+
+        Parameters
+        ----------
+        state : DeviceState
+        """
+        location = self.__locations[state.location]
+        location.devices -= 1
+        location.humidity_warnings -= state.humidity_warning
+        location.co2_warnings -= state.co2_warning
+        if not location.devices:
+            del self.__locations[state.location]
+
+    def __move(self, state, location):
+        """
+        Move a device to a new location
+
+        Parameters
+        ----------
+        state : DeviceState
+        location : str
+        """
+        self.__release(state)
+        state.location = location
+        moved = self.__location(location)
+        moved.devices += 1
+        moved.humidity_warnings += state.humidity_warning
+        moved.co2_warnings += state.co2_warning
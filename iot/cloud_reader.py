@@ -11,56 +11,364 @@ Notes
 - Code follows the PEP 8 style guide:
   https://www.python.org/dev/peps/pep-0008/
 """
-from thingspeak import read_from_channel
+from thingspeak import read_from_channel, stream_from_channel, ChannelPool
+from thingspeak import MAX_RESULTS
 from sqlite_db import HumidityDB, Co2DB
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
 import constants as c
+import timezones
 import argparse
-import re
+import calendar
+import json
+import os
+import queue
 import logging
+import threading
 
 POLL_TIME_SECS = 5
+MIN_POLL_TIME_SECS = 1
+MAX_POLL_TIME_SECS = 60
+POLL_BACKOFF = 1.5
+PIPELINE_DEPTH = 2
+BACKFILL_PAGE_SECS = 3600
+BACKFILL_WORKERS = 4
+BACKFILL_CHECKPOINT = 'backfill.json'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+ONE_SEC = timedelta(seconds=1)
+DAY_CACHE_SIZE = 1024
 LAST_INDEX = -1
 FIRST_INDEX = 0
 INCREMENT = 1
 
 
+class PollInterval:
+    """
+    Poll interval that tightens while new entries keep arriving & backs
+    off while the feed is idle
+    """
+
+    def __init__(self, secs=POLL_TIME_SECS, min_secs=MIN_POLL_TIME_SECS,
+                 max_secs=MAX_POLL_TIME_SECS, backoff=POLL_BACKOFF):
+        """
+        Parameters
+        ----------
+        secs : float
+            Starting interval
+        min_secs : float
+        max_secs : float
+        backoff : float
+            Factor the interval grows by per idle poll
+        """
+        self.__secs = secs
+        self.__min_secs = min_secs
+        self.__max_secs = max_secs
+        self.__backoff = backoff
+        self.__lock = threading.Lock()
+
+    @property
+    def secs(self):
+        """
+        float : Seconds until the next poll
+        """
+        with self.__lock:
+            return self.__secs
+
+    def observe(self, new_entries):
+        """
+        Adapt the interval to a poll's result
+
+        Parameters
+        ----------
+        new_entries : int
+            New entries found by the poll
+        """
+        with self.__lock:
+            if new_entries:
+                self.__secs = max(self.__min_secs, self.__secs / 2)
+            else:
+                self.__secs = min(self.__max_secs,
+                                  self.__secs * self.__backoff)
+
+
+def time_slices(start, end, page_secs):
+    """
+    Split a time range into consecutive slices
+
+    Parameters
+    ----------
+    start : datetime
+    end : datetime
+    page_secs : int
+        Length of each slice
+
+    Returns
+    -------
+    list
+        (start, end) of each slice, both inclusive
+    """
+    slices = []
+    page = timedelta(seconds=page_secs)
+    while start <= end:
+        slices.append((start, min(start + page - ONE_SEC, end)))
+        start += page
+    return slices
+
+
+class TimestampParser:
+    """
+    Converts ThingSpeak created_at values to epoch milliseconds
+
+    Fixed offsets are read straight from the string instead of using
+    regex or strptime. The epoch of each day is cached, since a feed's
+    entries mostly share a few days.
+    """
+
+    def __init__(self, cache_size=DAY_CACHE_SIZE):
+        """
+        Parameters
+        ----------
+        cache_size : int
+            Days kept in the cache
+        """
+        self.__day_epochs = {}
+        self.__cache_size = cache_size
+
+    def parse(self, created_at):
+        """
+        Parameters
+        ----------
+        created_at : str
+            'YYYY-MM-DDTHH:MM:SSZ' or 'YYYY-MM-DDTHH:MM:SS+HH:MM'
+
+        Returns
+        -------
+        timestamp : int
+            Epoch milliseconds
+        utc_offset : int
+            Minutes the channel timezone is ahead of UTC
+        date : str
+            'YYYY-MM-DD' in the channel timezone
+        time : str
+            'HH:MM:SS' in the channel timezone
+
+        Raises
+        ------
+        ValueError
+            Unparseable created_at
+        """
+        if len(created_at) < 20 or created_at[10] != 'T' or \
+                created_at[13] != ':' or created_at[16] != ':':
+            raise ValueError('Unparseable date {}'.format(created_at))
+
+        date = created_at[:10]
+        day_epoch = self.__day_epochs.get(date)
+        if day_epoch is None:
+            if len(self.__day_epochs) >= self.__cache_size:
+                self.__day_epochs.clear()
+            day_epoch = calendar.timegm((int(date[:4]), int(date[5:7]),
+                                         int(date[8:10]), 0, 0, 0))
+            self.__day_epochs[date] = day_epoch
+
+        zone = created_at[19:]
+        if zone == 'Z':
+            utc_offset = 0
+        elif len(zone) == 6 and zone[0] in '+-' and zone[3] == ':':
+            utc_offset = int(zone[1:3]) * 60 + int(zone[4:6])
+            if zone[0] == '-':
+                utc_offset = -utc_offset
+        else:
+            raise ValueError('Unparseable timezone {}'.format(created_at))
+
+        secs = (day_epoch + int(created_at[11:13]) * 3600 +
+                int(created_at[14:16]) * 60 + int(created_at[17:19]) -
+                utc_offset * 60)
+        return secs * 1000, utc_offset, date, created_at[11:19]
+
+
+def parse_feed(feed, timestamps):
+    """
+    Parse data from given feed
+
+    An entry with both humidity & CO2 fields (a coalesced write) is
+    split into one record per reading. Besides the date & time in the
+    channel timezone, records carry the epoch milliseconds & UTC
+    offset, numbers are converted to int & float.
+
+    Parameters
+    ----------
+    feed : dict
+    timestamps : TimestampParser
+
+    Returns
+    -------
+    bool
+        True if data successfully parsed
+    data : list
+        Records parsed
+    """
+    data = []
+    co2 = feed.get(c.CO2_FIELD, '')
+    humidity = feed.get(c.HUMIDITY_FIELD, '')
+
+    try:
+        timestamp, utc_offset, date, time = timestamps.parse(
+            feed.get('created_at', ''))
+    except ValueError:
+        logging.warning('Skipping entry with unparseable date')
+        return False, data
+
+    # Other error handling could go here
+
+    if not co2 and not humidity:
+        raise Exception('Bad read!')
+
+    try:
+        common = {'date': date,
+                  'time': time,
+                  'timestamp': timestamp,
+                  'utc_offset': utc_offset,
+                  'id': int(feed.get(c.NODE_FIELD, '')),
+                  'location': feed.get(c.LOCATION_FIELD, '')}
+
+        if humidity:
+            data.append(dict(common, humidity=float(humidity)))
+
+        if co2:
+            data.append(dict(common, co2=float(co2)))
+    except ValueError:
+        logging.warning('Skipping entry with non-numeric fields')
+        return False, []
+
+    return True, data
+
+
+class BackfillCheckpoint:
+    """
+    Time ranges already backfilled per channel, kept in a JSON file so an
+    interrupted backfill resumes where it stopped
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+        """
+        self.__path = path
+        self.__done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.__done = json.load(f)
+
+    def is_done(self, feed, start, end):
+        """
+        Parameters
+        ----------
+        feed : str
+        start : datetime
+        end : datetime
+
+        Returns
+        -------
+        bool
+            True if the whole range was backfilled
+        """
+        start = start.strftime(TIME_FORMAT)
+        end = end.strftime(TIME_FORMAT)
+        return any(done_start <= start and end <= done_end
+                   for done_start, done_end in self.__done.get(feed, []))
+
+    def mark(self, feed, start, end):
+        """
+        Record a backfilled range & save the checkpoint
+
+        Parameters
+        ----------
+        feed : str
+        start : datetime
+        end : datetime
+        """
+        ranges = [(datetime.strptime(s, TIME_FORMAT),
+                   datetime.strptime(e, TIME_FORMAT))
+                  for s, e in self.__done.get(feed, [])]
+        ranges.append((start, end))
+        ranges.sort()
+
+        # Merge ranges that touch so the file stays small
+        merged = [ranges[0]]
+        for range_start, range_end in ranges[1:]:
+            if range_start <= merged[-1][1] + ONE_SEC:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+            else:
+                merged.append((range_start, range_end))
+
+        self.__done[feed] = [(s.strftime(TIME_FORMAT),
+                              e.strftime(TIME_FORMAT)) for s, e in merged]
+
+        # Replace the file in one step so a crash can't leave it torn
+        with open(self.__path + '.tmp', 'w') as f:
+            json.dump(self.__done, f)
+        os.replace(self.__path + '.tmp', self.__path)
+
+
 class CloudParser:
     """
     Class to parse data from cloud
+
+    Polling runs as a pipeline: one thread fetches the channels, another
+    parses what was fetched & the caller's thread saves it, so the next
+    fetch overlaps parsing & saving of the previous one.
     """
 
-    def __init__(self):
-        self.__latest_data = None
+    def __init__(self, channels=None):
+        """
+        Parameters
+        ----------
+        channels : ChannelPool
+            Channels to read, the configured pool by default
+        """
+        self.__channels = channels if channels is not None else ChannelPool()
+        self.__timestamps = TimestampParser()
+        # Channel feed -> latest entry parsed
+        self.__latest_data = {}
 
-        # Create humidity DB if it doesn't exist
+        # Create humidity DB if it doesn't exist, or bring it up to date
         with HumidityDB() as db:
             if not db.table_exists():
                 db.create_table()
+            else:
+                db.upgrade_table()
 
-        # Create CO2 DB if it doesn't exist
+        # Create CO2 DB if it doesn't exist, or bring it up to date
         with Co2DB() as db:
             if not db.table_exists():
                 db.create_table()
+            else:
+                db.upgrade_table()
 
     def poll_channel(self):
         """
-        Reads from cloud & parses data
+        Reads from every channel of the pool & parses data
         """
         logging.info('Reading from cloud, CTRL-C to stop')
-        key = c.AIR_QUALITY_READ_KEY
-        feed = c.AIR_QUALITY_FEED
+        self.__interval = PollInterval()
+        self.__stop = threading.Event()
+        # Bounded so a slow stage holds back the ones before it
+        self.__fetched = queue.Queue(PIPELINE_DEPTH)
+        self.__parsed = queue.Queue(PIPELINE_DEPTH)
+        threading.Thread(target=self.__fetch_loop, daemon=True).start()
+        threading.Thread(target=self.__parse_loop, daemon=True).start()
         try:
             while True:
-                channel_data = read_from_channel(key, feed)
-                parsed_data = self.__parse_data(channel_data)
+                parsed_data = self.__parsed.get()
+                if isinstance(parsed_data, BaseException):
+                    raise parsed_data
 
-                if parsed_data:
-                    logging.debug('New data parsed from channel')
+                logging.debug('New data parsed from channel')
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
                     logging.debug('New data: {}'.format(parsed_data))
-                    self.__save_data(parsed_data)
-
-                sleep(POLL_TIME_SECS)
+                self.__save_data(parsed_data)
 
         except KeyboardInterrupt:
             logging.info('Exiting due to keyboard interrupt')
@@ -69,13 +377,201 @@ class CloudParser:
             logging.error('An error or exception occurred!')
             logging.error('Error traceback: {}'.format(e))
 
-    def __parse_data(self, channel_data):
+        finally:
+            self.__stop.set()
+
+    def __fetch_loop(self):
+        """
+        Fetch stage, reads every channel once per poll interval
+        """
+        channels = self.__channels.channels
+        with ThreadPoolExecutor(max_workers=len(channels)) as executor:
+            while not self.__stop.is_set():
+                results = executor.map(self.__read_channel, channels)
+                self.__fetched.put(list(zip(channels, results)))
+                self.__stop.wait(self.__interval.secs)
+
+    def __parse_loop(self):
+        """
+        Parse stage, hands new entries to the save stage & adapts the
+        poll interval to them
+        """
+        while not self.__stop.is_set():
+            fetched = self.__fetched.get()
+            try:
+                parsed_data = []
+                for channel, channel_data in fetched:
+                    if channel_data is not None:
+                        parsed_data.extend(
+                            self.__parse_data(channel_data, channel.feed))
+            except Exception as e:
+                # Let the save stage stop polling
+                self.__parsed.put(e)
+                return
+
+            self.__interval.observe(len(parsed_data))
+            logging.debug('Next poll in {:.1f} s'.format(self.__interval.secs))
+            if parsed_data:
+                self.__parsed.put(parsed_data)
+
+    def __read_channel(self, channel):
+        """
+        Read a channel's feed, a failing channel doesn't stop the others
+
+        Parameters
+        ----------
+        channel : Channel
+
+        Returns
+        -------
+        dict
+            Channel data, None if the read failed
+        """
+        try:
+            return read_from_channel(channel.read_key, channel.feed)
+        except Exception as e:
+            logging.error('Failed to read channel {}: {}'.format(
+                channel.feed, e))
+            return None
+
+    def backfill(self, start, end, page_secs=BACKFILL_PAGE_SECS,
+                 workers=BACKFILL_WORKERS,
+                 checkpoint_file=BACKFILL_CHECKPOINT):
+        """
+        Import the history of every channel of the pool
+
+        The range is read in slices, several at once, & each slice is
+        saved in one transaction. Slices saved are recorded in the
+        checkpoint file & skipped when the backfill is run again. Slices
+        not over when the backfill started aren't recorded, as entries may
+        still be added to them.
+
+        Parameters
+        ----------
+        start : datetime
+            In the channel timezone (constants.THINGSPEAK_TIMEZONE)
+        end : datetime
+        page_secs : int
+            Length of the slices requested
+        workers : int
+            Slices requested at once
+        checkpoint_file : str
+        """
+        checkpoint = BackfillCheckpoint(checkpoint_file)
+        started = timezones.now(c.THINGSPEAK_TIMEZONE)
+        for channel in self.__channels.channels:
+            slices = [(s, e) for s, e in time_slices(start, end, page_secs)
+                      if not checkpoint.is_done(channel.feed, s, e)]
+            logging.info('Backfilling {} slices of channel {}'.format(
+                len(slices), channel.feed))
+
+            saved = 0
+            slices = iter(slices)
+            pending = {}
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                while True:
+                    # Bound the slices held in memory
+                    while len(pending) < 2 * workers:
+                        next_slice = next(slices, None)
+                        if next_slice is None:
+                            break
+                        future = executor.submit(self.__fetch_slice,
+                                                 channel, *next_slice)
+                        pending[future] = next_slice
+
+                    if not pending:
+                        break
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        slice_start, slice_end = pending.pop(future)
+                        saved += self.__save_records(future.result(),
+                                                     slice_start, slice_end)
+                        if slice_end < started:
+                            checkpoint.mark(channel.feed, slice_start,
+                                            slice_end)
+
+            logging.info('Backfilled {} records from channel {}'.format(
+                saved, channel.feed))
+
+    def __fetch_slice(self, channel, start, end):
+        """
+        Read & parse a channel's entries within a time range
+
+        ThingSpeak returns at most MAX_RESULTS entries (the latest), so a
+        full slice is split in two & read again.
+
+        Parameters
+        ----------
+        channel : Channel
+        start : datetime
+        end : datetime
+
+        Returns
+        -------
+        list
+            Records parsed
+        """
+        params = {'start': start.strftime(TIME_FORMAT),
+                  'end': end.strftime(TIME_FORMAT),
+                  'results': MAX_RESULTS}
+        entries = list(stream_from_channel(channel.read_key, channel.feed,
+                                           params))
+
+        if len(entries) >= MAX_RESULTS and start < end:
+            middle = start + (end - start) // 2
+            middle = middle.replace(microsecond=0)
+            return (self.__fetch_slice(channel, start, middle) +
+                    self.__fetch_slice(channel, middle + ONE_SEC, end))
+
+        return self.__parse_entries(entries, skip_bad=True)
+
+    def __save_records(self, records, start, end):
+        """
+        Save records not already in the DBs, one transaction per DB
+
+        Parameters
+        ----------
+        records : list
+        start : datetime
+            Start of the range the records are from
+        end : datetime
+
+        Returns
+        -------
+        int
+            Records saved
+        """
+        saved = 0
+        for field, db_class in (('humidity', HumidityDB), ('co2', Co2DB)):
+            with db_class() as db:
+                existing = db.record_keys(start.strftime(TIME_FORMAT),
+                                          end.strftime(TIME_FORMAT))
+                new_records = []
+                for d in records:
+                    if field not in d:
+                        continue
+                    try:
+                        key = (d['date'], d['time'], int(d['id']),
+                               d['location'], float(d[field]))
+                    except ValueError:
+                        key = None
+                    if key not in existing:
+                        existing.add(key)
+                        new_records.append(d)
+                db.add_records(new_records)
+                saved += len(new_records)
+        return saved
+
+    def __parse_data(self, channel_data, feed):
         """
         Parse data from cloud
 
         Parameters
         ----------
         channel_data : dict
+        feed : str
+            Channel the data was read from
 
         Returns
         -------
@@ -85,74 +581,57 @@ class CloudParser:
         feeds = channel_data.get('feeds', '')
 
         # Return if no data or if no new data in channel after last saved data
-        if not feeds or feeds[LAST_INDEX] == self.__latest_data:
+        latest_data = self.__latest_data.get(feed)
+        if not feeds or feeds[LAST_INDEX] == latest_data:
             logging.debug('No new data parsed from channel')
             return parsed_data
 
         # Find starting index (start after latest data or at beginning)
-        if self.__latest_data:
-            start_index = feeds.index(self.__latest_data) + INCREMENT
+        if latest_data in feeds:
+            start_index = feeds.index(latest_data) + INCREMENT
         else:
             start_index = FIRST_INDEX
 
-        # Iterate through feeds & parse for data
-        for f in feeds[start_index:]:
-            parse_status, data = self.__parse_feed(f)
-            if parse_status:
-                parsed_data.append(data)
+        # Parse the new entries
+        parsed_data = self.__parse_entries(feeds[start_index:])
 
         # Update latest_data value to new latest data record
-        self.__latest_data = feeds[LAST_INDEX]
+        self.__latest_data[feed] = feeds[LAST_INDEX]
 
         return parsed_data
 
-    def __parse_feed(self, feed):
+    def __parse_entries(self, entries, skip_bad=False):
         """
-        Parse data from given feed
+        Parse a batch of feed entries
 
         Parameters
         ----------
-        feed : dict
+        entries : list
+        skip_bad : bool
+            Skip entries without readings instead of raising
 
         Returns
         -------
-        bool
-            True if data successfully parsed
-        data : dict
-            Data parsed
-        """
-        data = {}
-        date_data = feed.get('created_at', '')
-        date_list = re.split('T|Z', date_data)
-        id_data = feed.get(c.NODE_FIELD, '')
-        location_data = feed.get(c.LOCATION_FIELD, '')
-        co2 = feed.get(c.CO2_FIELD, '')
-        humidity = feed.get(c.HUMIDITY_FIELD, '')
-
-        if len(date_list) < 2:
-            logging.warning('Skipping entry with unparseable date')
-            return False, data
-
-        # Other error handling could go here
-
-        if co2 and not humidity:
-            data = {'date': date_list[0],
-                    'time': date_list[1].split('-')[0],
-                    'id': id_data,
-                    'location': location_data,
-                    'co2': co2}
-
-        elif humidity and not co2:
-            data = {'date': date_list[0],
-                    'time': date_list[1].split('-')[0],
-                    'id': id_data,
-                    'location': location_data,
-                    'humidity': humidity}
-        else:
-            raise Exception('Bad read!')
+        parsed_data : list
+        """
+        parsed_data = []
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for entry in entries:
+            try:
+                parse_status, data = parse_feed(entry, self.__timestamps)
+            except Exception as e:
+                if not skip_bad:
+                    raise
+                logging.warning('Skipping entry {}: {}'.format(
+                    entry.get('entry_id'), e))
+                continue
+
+            if parse_status:
+                parsed_data.extend(data)
+                if debug:
+                    logging.debug('Data parsed from channel: {}'.format(data))
 
-        logging.debug('Data parsed from channel: {}'.format(data))
-        return True, data
+        return parsed_data
 
     def __save_data(self, data):
         """
@@ -166,7 +645,7 @@ class CloudParser:
         for d in data:
 
             # If data record is for humidity
-            if d.get('humidity', None):
+            if 'humidity' in d:
 
                 # Add to Humidity DB if it's new
                 with HumidityDB() as db:
@@ -174,7 +653,7 @@ class CloudParser:
                         db.add_record(d)
 
             # If data record is for CO2
-            if d.get('co2', None):
+            if 'co2' in d:
 
                 # Add to CO2 DB if it's new
                 with Co2DB() as db:
@@ -200,7 +679,54 @@ def parse_args():
                         action='store_true',
                         help='Print all debug logs')
 
+    parser.add_argument('--backfill',
+                        default=False,
+                        action='store_true',
+                        help='Import the channels\' history from --start '
+                             'to --end instead of polling')
+
+    parser.add_argument('--start',
+                        metavar='<"YYYY-MM-DD HH:MM:SS">',
+                        help='Start of the backfill, in {}'.format(
+                            c.THINGSPEAK_TIMEZONE))
+
+    parser.add_argument('--end',
+                        metavar='<"YYYY-MM-DD HH:MM:SS">',
+                        help='End of the backfill. Default: now')
+
+    parser.add_argument('--page-secs',
+                        type=int,
+                        default=BACKFILL_PAGE_SECS,
+                        metavar='<seconds>',
+                        help='Time range of each backfill request. '
+                             'Default: {}'.format(BACKFILL_PAGE_SECS))
+
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        default=BACKFILL_WORKERS,
+                        metavar='<workers>',
+                        help='Backfill requests at once. '
+                             'Default: {}'.format(BACKFILL_WORKERS))
+
+    parser.add_argument('--checkpoint',
+                        default=BACKFILL_CHECKPOINT,
+                        metavar='<file>',
+                        help='Progress file of the backfill. '
+                             'Default: {}'.format(BACKFILL_CHECKPOINT))
+
     args = parser.parse_args()
+
+    if args.backfill:
+        try:
+            if args.start is None:
+                parser.error('--backfill needs --start')
+            args.start = datetime.strptime(args.start, TIME_FORMAT)
+            args.end = datetime.strptime(args.end, TIME_FORMAT) \
+                if args.end else timezones.now(c.THINGSPEAK_TIMEZONE)
+        except ValueError as e:
+            parser.error(str(e))
+
     return args
 
 
@@ -209,4 +735,11 @@ if __name__ == '__main__':
     logging_level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(format=c.LOGGING_FORMAT, level=logging_level)
     parser = CloudParser()
-    parser.poll_channel()
+    if args.backfill:
+        try:
+            parser.backfill(args.start, args.end, args.page_secs,
+                            args.workers, args.checkpoint)
+        except KeyboardInterrupt:
+            logging.info('Exiting due to keyboard interrupt, rerun to resume')
+    else:
+        parser.poll_channel()
@@ -25,8 +25,13 @@ NODE_FIELD = 'field1'
 CO2_FIELD = 'field2'
 HUMIDITY_FIELD = 'field3'
 LOCATION_FIELD = 'field4'
+# 'min,max,count' of the readings behind a window summary's mean
+HUMIDITY_STATS_FIELD = 'field5'
+CO2_STATS_FIELD = 'field6'
 GOOD_STATUS = 200
-READ_URL = 'https://api.thingspeak.com/channels/' + \
+THINGSPEAK_URL = 'https://api.thingspeak.com'
+THINGSPEAK_TIMEZONE = 'America/New_York'
+READ_URL = '{BASE_URL}/channels/' + \
            '{CHANNEL_FEED}/feeds.json?api_key=' + \
            '{READ_KEY}&timezone=America%2FNew_York'
 
@@ -37,6 +42,13 @@ READ_URL = 'https://api.thingspeak.com/channels/' + \
 # Set to 20 to leave room since
 THINGSPEAK_DELAY_SECS = 20
 
+# Channel pool (feed, write key, read key), devices are spread over
+# the channels so each adds a write every THINGSPEAK_WRITE_SECS
+AIR_QUALITY_CHANNELS = [
+    (AIR_QUALITY_FEED, AIR_QUALITY_WRITE_KEY, AIR_QUALITY_READ_KEY),
+]
+THINGSPEAK_WRITE_SECS = 15
+
 # DB related
 HUMIDITY_DB_FILE = 'humidity.db'
 HUMIDITY_TABLE = 'humidity'
@@ -59,6 +71,7 @@ HUMIDITY_CONTENT = """
     Low humidity increases the risk of COVID19 transmission.<br>
     Take action to prevent the spread of COVID19."""
 SENDER = 'COVID Risk Alert System'
+DIGEST_SUBJECT = 'COVID Risk: {count} alerts'
 CONTENT_HTML = """
     <html>
       <head></head>
@@ -81,3 +94,9 @@ EXCESS_MESSAGE_LOGGER = "excess-message-logger"
 APP_CO2 = "app-co2"
 APP_HUMIDITY = "app-humidity"
 DEVICE_MANAGER = "device-manager"
+
+# Device manager related
+DEVICE_MANAGER_PORT = 3210
+# Device ids per retrieve_many request, keeps replies within one datagram
+MAX_RETRIEVE_MANY = 100
+MAX_DATAGRAM = 65535
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 import argparse
+import csv
 import json
 import socket
+import time
 import uuid
 
+MAX_REPLY = 65535
+DUMP_PAGE_SIZE = 50
+TIMEOUT_SECS = 2
+BULK_WINDOW = 64
+BULK_RETRIES = 3
+
 
 def send_request(request):
     """
@@ -11,9 +19,10 @@ def send_request(request):
     :param request: the request to be send as JSON object
     :return: reply from device manager already load into JSON object
     """
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.sendto(bytes(request, 'utf-8'), addr)
-    reply, _ = sock.recvfrom(1024)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(bytes(request, 'utf-8'), addr)
+        reply, _ = sock.recvfrom(MAX_REPLY)
     return json.loads(reply)
 
 
@@ -23,7 +32,9 @@ def register():
     """
     print(f"Attempting to register for {hw_id}...")
     reply = send_request(json.dumps({'type': 'register', 'device_id': hw_id, 'email': email}))
-    if reply['status']:
+    if 'error' in reply:
+        print(f"Registration failed: {reply['error']}")
+    elif reply['status']:
         print("Registration done")
     else:
         print("Registration failed")
@@ -35,6 +46,9 @@ def retrieve():
     """
     print(f"Attempting to retrieve notification email address for {hw_id}...")
     reply = send_request(json.dumps({'type': 'retrieve', 'device_id': hw_id}))
+    if 'error' in reply:
+        print(f"Retrieval failed: {reply['error']}")
+        return
     address = reply['email']
     if len(address) > 0:
         print(address)
@@ -44,13 +58,138 @@ def retrieve():
 
 def dump():
     """
-    This function dumps everything
+    This function dumps everything, one page at a time or streamed over TCP
     """
     print("Attempting to dump notification email address for all registered device...")
-    reply = send_request(json.dumps({'type': 'dump'}))
-    for row in reply:
-        print(row)
-    return
+    if use_tcp:
+        dump_stream()
+        return
+
+    after = None
+    while True:
+        reply = send_request(json.dumps({'type': 'dump_page', 'after': after, 'limit': DUMP_PAGE_SIZE}))
+        if 'error' in reply:
+            print(f"Dump failed: {reply['error']}")
+            return
+        for row in reply['rows']:
+            print(row)
+        after = reply['next']
+        if after is None:
+            return
+
+
+def dump_stream():
+    """
+    This function streams everything over a TCP connection
+    """
+    with socket.create_connection(addr) as sock, sock.makefile('rwb') as stream:
+        stream.write(bytes(json.dumps({'type': 'dump'}) + '\n', 'utf-8'))
+        stream.flush()
+        for line in stream:
+            row = json.loads(line)
+            if 'error' in row:
+                print(f"Dump failed: {row['error']}")
+                return
+            if row.get('done'):
+                print(f"{row['count']} devices dumped")
+                return
+            print(row)
+    print("Dump failed: connection closed early")
+
+
+def read_devices(file):
+    """
+    Read device_id/email pairs from a CSV or JSONL file
+    CSV rows are device_id,email (a header row is skipped), JSONL lines are
+    {"device_id": ..., "email": ...}
+    :param file: path to the file, .jsonl/.json for JSONL, anything else for CSV
+    :return: list of (device_id, email) tuples
+    """
+    devices = []
+    with open(file, newline='') as f:
+        if file.endswith(('.jsonl', '.json')):
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    devices.append((int(entry['device_id']), entry['email']))
+        else:
+            for row in csv.reader(f):
+                if len(row) < 2 or not row[0].strip().isdigit():
+                    continue
+                devices.append((int(row[0]), row[1].strip()))
+    return devices
+
+
+def register_many(devices, window=BULK_WINDOW, retries=BULK_RETRIES):
+    """
+    Register many devices over one socket, keeping up to window requests in flight
+    Requests without a reply within the timeout are retransmitted, and the window
+    is halved whenever the device manager sheds a request as overloaded
+    :param devices: list of (device_id, email) tuples
+    :param window: maximum number of outstanding requests
+    :param retries: retransmissions before a registration is reported as failed
+    :return: dict of device id to failure reason for devices that failed
+    """
+    # Stack of (device_id, email, attempts), retransmissions are pushed on top
+    pending = [(device_id, address, 0) for device_id, address in reversed(devices)]
+    in_flight = {}
+    failures = {}
+    limit = window
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        while pending or in_flight:
+            # Fill the window
+            while pending and len(in_flight) < limit:
+                device_id, address, attempts = pending.pop()
+                request = json.dumps({'type': 'register', 'device_id': device_id, 'email': address})
+                sock.sendto(bytes(request, 'utf-8'), addr)
+                in_flight[device_id] = (address, attempts, time.monotonic())
+
+            # Wait for replies until the oldest request times out
+            oldest = min(sent for _, _, sent in in_flight.values())
+            sock.settimeout(max(oldest + timeout - time.monotonic(), 0.001))
+            try:
+                reply, _ = sock.recvfrom(MAX_REPLY)
+                reply = json.loads(reply)
+                if reply.get('error') == 'overloaded':
+                    limit = max(1, limit // 2)
+                    continue
+                device_id = reply.get('device_id')
+                if device_id in in_flight:
+                    del in_flight[device_id]
+                    limit = min(window, limit + 1)
+                    if not reply.get('status'):
+                        failures[device_id] = 'rejected by device manager'
+                continue
+            except socket.timeout:
+                pass
+
+            # Queue timed out requests for retransmission or give up on them
+            now = time.monotonic()
+            for device_id, (address, attempts, sent) in list(in_flight.items()):
+                if now - sent < timeout:
+                    continue
+                del in_flight[device_id]
+                if attempts >= retries:
+                    failures[device_id] = 'timed out'
+                else:
+                    pending.append((device_id, address, attempts + 1))
+
+    return failures
+
+
+def bulk_register():
+    """
+    This function registers every device listed in a file and reports failures
+    """
+    devices = read_devices(bulk_file)
+    print(f"Attempting to register {len(devices)} devices...")
+    start = time.monotonic()
+    failures = register_many(devices, window)
+    elapsed = time.monotonic() - start
+    print(f"{len(devices) - len(failures)}/{len(devices)} registrations done in {elapsed:.2f}s")
+    for device_id, reason in sorted(failures.items()):
+        print(f"Registration failed for {device_id}: {reason}")
 
 
 def handle_operation(operation):
@@ -64,6 +203,8 @@ def handle_operation(operation):
         retrieve()
     if operation == "dump":
         dump()
+    if operation == "bulk":
+        bulk_register()
 
 
 if __name__ == '__main__':
@@ -72,8 +213,14 @@ if __name__ == '__main__':
     parser.add_argument("-ip", metavar='<hostname/ip>', help="specify the database address")
     parser.add_argument("-p", default=7777, metavar='<port number>', type=int, help="port of the registration service")
     parser.add_argument("operation",
-                        choices=['register', 'retrieve', 'dump'], help="operation type")
+                        choices=['register', 'retrieve', 'dump', 'bulk'], help="operation type")
     parser.add_argument("--email", help="operation type")
+    parser.add_argument("--tcp", action='store_true', help="stream dump over TCP for large registries")
+    parser.add_argument("-f", "--file", help="CSV or JSONL file of device_id,email pairs for bulk registration")
+    parser.add_argument("-w", "--window", default=BULK_WINDOW, type=int,
+                        help=f"registrations in flight during bulk registration, default is {BULK_WINDOW}")
+    parser.add_argument("-t", "--timeout", default=TIMEOUT_SECS, type=float,
+                        help=f"seconds to wait for a reply, default is {TIMEOUT_SECS}")
     parser.add_argument('-id',
                         '--hardware_id',
                         metavar='<48bit mac in int>',
@@ -85,10 +232,20 @@ if __name__ == '__main__':
     if args.ip:
         addr = (args.ip, args.p)
     hw_id = args.hardware_id
+    use_tcp = args.tcp
+    bulk_file = args.file
+    window = args.window
+    timeout = args.timeout
     if args.operation == "register" and args.email is None:
         print("Valid email is required for registration")
         exit()
+    elif args.operation == "bulk" and args.file is None:
+        print("A file of devices is required for bulk registration")
+        exit()
     else:
         email = args.email
 
-    handle_operation(args.operation)
+    try:
+        handle_operation(args.operation)
+    except socket.timeout:
+        print("No reply from the device manager")
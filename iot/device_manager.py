@@ -3,7 +3,11 @@ import argparse
 import json
 import logging
 import socket
-import psycopg2
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from device_registry import PostgresRegistry, SqliteRegistry
+from device_registry import DB_HOST, DB_PORT, DB_USER, DB_PW, DB_FILE, POOL_SIZE
 
 # logging
 LOG = "/tmp/logfile.log"
@@ -14,40 +18,215 @@ console = logging.StreamHandler()
 console.setLevel(logging.DEBUG)
 logging.getLogger("").addHandler(console)
 
-DB_HOST = "34.71.10.216"
-DB_PORT = 5432
-DB_USER = "device_db_user"
-DB_PW = ""
 RECEIVE_PORT = 3210
+NEGATIVE_TTL_SECS = 60
+WORKERS = 8
+MAX_IN_FLIGHT = 64
+DUMP_PAGE_SIZE = 50
+MAX_DUMP_PAGE_SIZE = 100
+MAX_RETRIEVE_MANY = 100
+MAX_REQUEST = 65535
 
 # PostgreSQL host on GCP 34.71.10.216
 # username: device_db_user
 # password: 0t!^5l1TW^1z&K!!
 
 # need create a table in DB if haven't dont so
-# DB DDL...
-# CREATE TABLE device_list (
-#   /* Mac address, 48bit */
-# 	device_id BIGINT PRIMARY KEY,
-# 	/* Max length per RFC3696 */
-# 	notification_email VARCHAR(320) NOT NULL
-# );
+# DB DDL in device_registry.py
 
 
-def connect():
+class DeviceCache:
     """
-    Connect to the PostgreSQL DB
-    :return: connection to the DB
+    In-process read-through cache of device_id -> notification email
+
+    Unknown devices are remembered for a short time (negative caching) so
+    repeated lookups for unregistered devices do not hit the DB either.
+    Every change bumps a generation, a DB read only fills the cache if the
+    device did not change since the read started.
     """
-    try:
-        connection = psycopg2.connect(user=DB_USER,
-                                      password=DB_PW,
-                                      host=DB_HOST,
-                                      port=DB_PORT,
-                                      database="device-db")
-        return connection
-    except (Exception, psycopg2.Error) as error:
-        logging.error(f"Failed to connect to DB, err:{error}")
+
+    def __init__(self, negative_ttl=NEGATIVE_TTL_SECS):
+        """
+        :param negative_ttl: seconds an unknown device is remembered as unknown
+        """
+        self.__negative_ttl = negative_ttl
+        self.__emails = {}
+        self.__unknown = {}
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__generation = 0
+        self.__loaded = 0
+        # device_id -> generation of its last put or invalidate
+        self.__changed = {}
+
+    def load(self, rows):
+        """
+        Bulk load the cache, replacing its content
+        :param rows: list of dicts with device_id and notification_email
+        """
+        emails = {row['device_id']: row['notification_email'] for row in rows}
+        with self.__lock:
+            self.__emails = emails
+            self.__unknown = {}
+            self.__generation += 1
+            self.__loaded = self.__generation
+            self.__changed = {}
+        logging.info(f"Loaded {len(emails)} devices into cache")
+
+    def get(self, device_id):
+        """
+        Look up a device
+        :param device_id: 48bit mac
+        :return: tuple of (cached, email), email is empty for a known unknown device
+        """
+        with self.__lock:
+            email = self.__emails.get(device_id)
+            if email is not None:
+                self.__hits += 1
+                return True, email
+            expiry = self.__unknown.get(device_id)
+            if expiry is not None:
+                if expiry > time.monotonic():
+                    self.__hits += 1
+                    return True, ""
+                del self.__unknown[device_id]
+            self.__misses += 1
+            return False, ""
+
+    def put(self, device_id, email):
+        """
+        Cache the email of a device, or remember that it is unknown
+        :param device_id: 48bit mac
+        :param email: email address, empty if the device is not registered
+        """
+        with self.__lock:
+            self.__changed_locked(device_id)
+            self.__store_locked(device_id, email)
+
+    def generation(self):
+        """
+        Current generation, to be taken before reading a device from the DB
+        :return: generation to pass to fill
+        """
+        with self.__lock:
+            return self.__generation
+
+    def fill(self, device_id, email, generation):
+        """
+        Cache the result of a DB read, unless the device was put or
+        invalidated since the read started
+        :param device_id: 48bit mac
+        :param email: email address, empty if the device is not registered
+        :param generation: generation taken before the read
+        :return: true if the cache was filled
+        """
+        with self.__lock:
+            if generation < self.__loaded or \
+                    self.__changed.get(device_id, -1) > generation:
+                return False
+            self.__store_locked(device_id, email)
+            return True
+
+    def invalidate(self, device_id):
+        """
+        Drop any cached entry for a device
+        :param device_id: 48bit mac
+        """
+        with self.__lock:
+            self.__changed_locked(device_id)
+            self.__emails.pop(device_id, None)
+            self.__unknown.pop(device_id, None)
+
+    def __changed_locked(self, device_id):
+        """
+        Record a change of a device, with the lock held
+        :param device_id: 48bit mac
+        """
+        self.__generation += 1
+        self.__changed[device_id] = self.__generation
+
+    def __store_locked(self, device_id, email):
+        """
+        Store an entry, with the lock held
+        :param device_id: 48bit mac
+        :param email: email address, empty if the device is not registered
+        """
+        if email:
+            self.__emails[device_id] = email
+            self.__unknown.pop(device_id, None)
+        else:
+            self.__emails.pop(device_id, None)
+            self.__unknown[device_id] = time.monotonic() + self.__negative_ttl
+
+    def stats(self):
+        """
+        Cache metrics
+        :return: dict of cache size and hit ratio
+        """
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {'size': len(self.__emails),
+                    'negative_size': len(self.__unknown),
+                    'hits': self.__hits,
+                    'misses': self.__misses,
+                    'hit_ratio': round(self.__hits / lookups, 4) if lookups else 0.0}
+
+
+class RequestLimiter:
+    """
+    Caps the number of requests in flight and counts shed requests
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT):
+        """
+        :param max_in_flight: maximum number of requests being processed at once
+        """
+        self.__max_in_flight = max_in_flight
+        self.__slots = threading.BoundedSemaphore(max_in_flight)
+        self.__lock = threading.Lock()
+        self.__in_flight = 0
+        self.__accepted = 0
+        self.__shed = 0
+
+    def try_acquire(self):
+        """
+        Reserve a slot for a new request without blocking
+        :return: true if the request may be processed, false if it must be shed
+        """
+        acquired = self.__slots.acquire(blocking=False)
+        with self.__lock:
+            if acquired:
+                self.__in_flight += 1
+                self.__accepted += 1
+            else:
+                self.__shed += 1
+        return acquired
+
+    def release(self):
+        """
+        Free the slot of a finished request
+        """
+        with self.__lock:
+            self.__in_flight -= 1
+        self.__slots.release()
+
+    def stats(self):
+        """
+        Server metrics
+        :return: dict of in flight, accepted and shed request counts
+        """
+        with self.__lock:
+            return {'max_in_flight': self.__max_in_flight,
+                    'in_flight': self.__in_flight,
+                    'accepted': self.__accepted,
+                    'shed': self.__shed}
+
+
+# Storage backend, chosen at startup
+REGISTRY = None
+CACHE = DeviceCache()
+LIMITER = RequestLimiter()
 
 
 def update_device_email(device_id, email):
@@ -59,40 +238,73 @@ def update_device_email(device_id, email):
     :return: true if update is done
     """
     try:
-        connection = connect()
-        postgres_query = "INSERT INTO device_list (device_id, notification_email) VALUES (%s, %s) " \
-                         "ON CONFLICT (device_id) DO UPDATE SET notification_email = excluded.notification_email"
-        cursor = connection.cursor()
-        cursor.execute(postgres_query, [device_id, email])
-
-        connection.commit()
-        count = cursor.rowcount
+        count = REGISTRY.upsert(device_id, email)
         logging.error(f"{count} record inserted successfully into table")
+        CACHE.put(device_id, email)
         return True
-    except (Exception, psycopg2.Error) as error:
+    except Exception as error:
         logging.error(f"Failed to insert record, err:{error}")
+        CACHE.invalidate(device_id)
     return False
 
 
 def retrieve_device_email(device_id):
     """
-    Retrieve the notification email address registered in the DB
+    Retrieve the notification email address registered in the DB,
+    served from the cache when possible
 
     :param device_id: 48bit mac
     :return: email address for this specific device
     """
+    cached, email = CACHE.get(device_id)
+    if cached:
+        return email
+
     try:
-        connection = connect()
-        postgres_query = "SELECT notification_email FROM device_list WHERE device_id=(%s)"
-        cursor = connection.cursor()
-        cursor.execute(postgres_query, [device_id])
-        result = cursor.fetchone()
-        return result[0]
-    except (Exception, psycopg2.Error) as error:
+        generation = CACHE.generation()
+        email = REGISTRY.retrieve(device_id) or ""
+        CACHE.fill(device_id, email, generation)
+        return email
+    except Exception as error:
         logging.error(f"Failed to retrieve record, err:{error}")
         return ""
 
 
+def retrieve_device_emails(device_ids):
+    """
+    Retrieve the notification email addresses of many devices
+    Cached devices are served from the cache, the rest in one DB round trip
+
+    :param device_ids: list of 48bit macs
+    :return: dict of device id to email address, empty for unregistered devices
+    """
+    emails = {}
+    missing = []
+    for device_id in device_ids:
+        cached, email = CACHE.get(device_id)
+        if cached:
+            emails[device_id] = email
+        else:
+            missing.append(device_id)
+
+    if not missing:
+        return emails
+
+    try:
+        generation = CACHE.generation()
+        found = REGISTRY.retrieve_many(missing)
+    except Exception as error:
+        logging.error(f"Failed to retrieve records, err:{error}")
+        emails.update((device_id, "") for device_id in missing)
+        return emails
+
+    for device_id in missing:
+        email = found.get(device_id, "")
+        CACHE.fill(device_id, email, generation)
+        emails[device_id] = email
+    return emails
+
+
 def dump_all_email():
     """
     Dump all emails registered in the db
@@ -100,18 +312,49 @@ def dump_all_email():
     :return: email address for all devices
     """
     try:
-        connection = connect()
-        postgres_query = "SELECT device_id, notification_email FROM device_list"
-        cursor = connection.cursor()
-        cursor.execute(postgres_query)
-        result = [dict((cursor.description[i][0], value)
-                       for i, value in enumerate(row)) for row in cursor.fetchall()]
-        return result
-    except (Exception, psycopg2.Error) as error:
+        return REGISTRY.dump()
+    except Exception as error:
         logging.error(f"Failed to retrieve record, err:{error}")
         return ""
 
 
+def dump_email_page(after=None, limit=DUMP_PAGE_SIZE):
+    """
+    Dump one page of registered emails, ordered by device id
+    Pages are bounded so a reply always fits in a single datagram
+
+    :param after: device id of the last row of the previous page, None for the first page
+    :param limit: maximum number of rows in the page
+    :return: tuple of (rows, device id to request the next page after or None), None on failure
+    """
+    limit = max(1, min(int(limit), MAX_DUMP_PAGE_SIZE))
+
+    try:
+        rows = REGISTRY.page(after, limit + 1)
+    except Exception as error:
+        logging.error(f"Failed to retrieve page, err:{error}")
+        return None
+
+    page = [{'device_id': device_id, 'notification_email': email}
+            for device_id, email in rows[:limit]]
+    next_after = page[-1]['device_id'] if len(rows) > limit else None
+    return page, next_after
+
+
+def stream_all_email(write):
+    """
+    Stream all registered emails as JSON lines in bounded memory
+
+    :param write: callable taking one encoded line
+    :return: number of rows written
+    """
+    def write_row(device_id, email):
+        row = {'device_id': device_id, 'notification_email': email}
+        write(bytes(json.dumps(row) + '\n', 'utf-8'))
+
+    return REGISTRY.for_each(write_row)
+
+
 def process_request_message(message):
     """
     Process message and generate corresponding reply
@@ -128,27 +371,123 @@ def process_request_message(message):
         device_id = parse_msg['device_id']
         email = retrieve_device_email(device_id)
         return json.dumps({'device_id': device_id, 'email': email})
+    if request_type == "retrieve_many":
+        device_ids = parse_msg['device_ids']
+        if len(device_ids) > MAX_RETRIEVE_MANY:
+            return json.dumps({'error': f'at most {MAX_RETRIEVE_MANY} device ids per request'})
+        emails = retrieve_device_emails(device_ids)
+        return json.dumps({'emails': [{'device_id': device_id, 'email': email}
+                                      for device_id, email in emails.items()]})
     if request_type == "dump":
         result = dump_all_email()
         return json.dumps(result)
+    if request_type == "dump_page":
+        result = dump_email_page(parse_msg.get('after'), parse_msg.get('limit', DUMP_PAGE_SIZE))
+        if result is None:
+            return json.dumps({'error': 'dump failed'})
+        rows, next_after = result
+        return json.dumps({'rows': rows, 'next': next_after})
+    if request_type == "stats":
+        return json.dumps({'registry': REGISTRY.stats(), 'cache': CACHE.stats(), 'server': LIMITER.stats()})
+
+
+def handle_request(sock, message, address):
+    """
+    Process one request on a worker thread and send the reply
+    :param sock: socket to reply on
+    :param message: message to be replied
+    :param address: address of the requester
+    """
+    try:
+        reply = process_request_message(message)
+        logging.debug(reply)
+        sock.sendto(bytes(reply, 'utf-8'), address)
+    except Exception as error:
+        logging.error(f"Failed to process request {message}, err:{error}")
+    finally:
+        LIMITER.release()
+
+
+def handle_dump_stream(client, address):
+    """
+    Stream the whole registry over a TCP connection
+    The client sends one JSON line {"type": "dump"} and receives one JSON line
+    per device followed by {"done": true, "count": <rows>}
+    :param client: accepted TCP socket
+    :param address: address of the requester
+    """
+    try:
+        with client, client.makefile('rwb') as stream:
+            request = json.loads(stream.readline().decode('utf-8') or '{}')
+            if request.get('type') != "dump":
+                stream.write(bytes(json.dumps({'error': 'unsupported request'}) + '\n', 'utf-8'))
+                return
+
+            if not LIMITER.try_acquire():
+                logging.warning(f"Overloaded, shedding dump from {address}")
+                stream.write(bytes(json.dumps({'error': 'overloaded'}) + '\n', 'utf-8'))
+                return
+
+            try:
+                count = stream_all_email(stream.write)
+                stream.write(bytes(json.dumps({'done': True, 'count': count}) + '\n', 'utf-8'))
+                logging.info(f"Streamed {count} devices to {address}")
+            finally:
+                LIMITER.release()
+    except Exception as error:
+        logging.error(f"Failed to stream dump to {address}, err:{error}")
 
 
-def device_manager():
+def dump_stream_server():
+    """
+    Accept TCP connections for streamed dumps on the receiving port
+    """
+    logging.info(f"Device manager streaming dumps on TCP port: {RECEIVE_PORT}")
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', int(RECEIVE_PORT)))
+    listener.listen()
+
+    while True:
+        client, address = listener.accept()
+        threading.Thread(target=handle_dump_stream, args=(client, address), daemon=True).start()
+
+
+def device_manager(workers=WORKERS):
     """
     Main loop of the function
+
+    With workers, requests are processed on a thread pool so slow DB calls do
+    not block other requests. Requests beyond the in flight cap are shed with an
+    explicit 'overloaded' reply rather than queued.
+    :param workers: number of worker threads, 0 to process requests one at a time
     :return:
     """
     logging.info(f"Device manager listening on receiving port: {RECEIVE_PORT}")
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
     sock.bind(('', int(RECEIVE_PORT)))
+    threading.Thread(target=dump_stream_server, daemon=True).start()
 
-    while True:
-        message, address = sock.recvfrom(1024)
-        logging.debug('Received: {}'.format(message))
+    if not workers:
+        while True:
+            message, address = sock.recvfrom(MAX_REQUEST)
+            logging.debug('Received: {}'.format(message))
 
-        reply = process_request_message(message)
-        logging.debug(reply)
-        sock.sendto(bytes(reply, 'utf-8'), address)
+            reply = process_request_message(message)
+            logging.debug(reply)
+            sock.sendto(bytes(reply, 'utf-8'), address)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            message, address = sock.recvfrom(MAX_REQUEST)
+            logging.debug('Received: {}'.format(message))
+
+            if not LIMITER.try_acquire():
+                logging.warning(f"Overloaded, shedding request from {address}")
+                sock.sendto(bytes(json.dumps({'error': 'overloaded'}), 'utf-8'), address)
+                continue
+
+            executor.submit(handle_request, sock, message, address)
 
 
 if __name__ == '__main__':
@@ -158,6 +497,18 @@ if __name__ == '__main__':
     parser.add_argument("-r", help=f"specify a port to receive on, default is {RECEIVE_PORT}")
     parser.add_argument("-u", "--username", help="username of the db")
     parser.add_argument("-p", "--password", help="password of the db")
+    parser.add_argument("-b", "--backend", choices=['postgres', 'sqlite'], default='postgres',
+                        help="storage backend of the registry, default is postgres")
+    parser.add_argument("-f", "--db-file", default=DB_FILE,
+                        help=f"file of the sqlite backend, default is {DB_FILE}")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE,
+                        help=f"maximum number of DB connections, default is {POOL_SIZE}")
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS,
+                        help=f"worker threads, 0 to handle one request at a time, default is {WORKERS}")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT,
+                        help=f"requests processed at once before shedding load, default is {MAX_IN_FLIGHT}")
+    parser.add_argument("--negative-ttl", type=float, default=NEGATIVE_TTL_SECS,
+                        help=f"seconds to cache unknown devices, default is {NEGATIVE_TTL_SECS}")
     args = parser.parse_args()
     logging_level = logging.DEBUG if args.verbose else logging.INFO
     if args.ip_address:
@@ -167,6 +518,16 @@ if __name__ == '__main__':
     if args.username:
         DB_USER = args.username
     if args.password:
-        DB_PASSWORD = args.password
+        DB_PW = args.password
+    if args.backend == 'sqlite':
+        REGISTRY = SqliteRegistry(args.db_file)
+    else:
+        REGISTRY = PostgresRegistry(host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PW,
+                                    pool_size=args.pool_size)
+    CACHE = DeviceCache(negative_ttl=args.negative_ttl)
+    LIMITER = RequestLimiter(max_in_flight=args.max_in_flight)
+    registered = dump_all_email()
+    if registered:
+        CACHE.load(registered)
 
-    device_manager()
+    device_manager(workers=args.workers)
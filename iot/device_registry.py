@@ -0,0 +1,480 @@
+"""
+device_registry.py
+
+Storage backends for the device registry used by device_manager.py
+Every backend stores device_id -> notification email with upsert semantics
+
+PostgreSQL DDL (created automatically by the SQLite backend)
+CREATE TABLE device_list (
+  /* Mac address, 48bit */
+  device_id BIGINT PRIMARY KEY,
+  /* Max length per RFC3696 */
+  notification_email VARCHAR(320) NOT NULL
+);
+"""
+import abc
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+try:
+    import psycopg2
+except ImportError:
+    # Only required by the PostgreSQL backend
+    psycopg2 = None
+
+DB_HOST = "34.71.10.216"
+DB_PORT = 5432
+DB_USER = "device_db_user"
+DB_PW = ""
+DB_NAME = "device-db"
+DB_FILE = "device_list.db"
+POOL_SIZE = 4
+POOL_TIMEOUT_SECS = 5
+HEALTH_CHECK_SECS = 30
+FETCH_SIZE = 1000
+SQLITE_TIMEOUT_SECS = 5
+
+
+class DeviceRegistry(metaclass=abc.ABCMeta):
+    """
+    Storage backend for the device registry
+    Methods raise on storage failures, callers decide how to report them
+    """
+
+    @abc.abstractmethod
+    def upsert(self, device_id, email):
+        """
+        Insert or update the notification email of a device
+        :param device_id: 48bit mac
+        :param email: email address to be used for notification
+        :return: number of rows written
+        """
+
+    @abc.abstractmethod
+    def retrieve(self, device_id):
+        """
+        Retrieve the notification email of a device
+        :param device_id: 48bit mac
+        :return: email address, None if the device is not registered
+        """
+
+    @abc.abstractmethod
+    def retrieve_many(self, device_ids):
+        """
+        Retrieve the notification emails of many devices in one round trip
+        :param device_ids: list of 48bit macs
+        :return: dict of device id to email address for registered devices only
+        """
+
+    @abc.abstractmethod
+    def dump(self):
+        """
+        Dump the whole registry
+        :return: list of dicts with device_id and notification_email
+        """
+
+    @abc.abstractmethod
+    def page(self, after, limit):
+        """
+        Dump one page of the registry ordered by device id
+        :param after: device id to start after, None for the first page
+        :param limit: maximum number of rows
+        :return: list of (device_id, email) tuples
+        """
+
+    @abc.abstractmethod
+    def for_each(self, callback):
+        """
+        Call back for every registered device in device id order, in bounded memory
+        :param callback: callable taking device_id and email
+        :return: number of devices
+        """
+
+    def stats(self):
+        """
+        Backend metrics
+        :return: dict of backend specific metrics
+        """
+        return {}
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no pooled connection becomes available in time
+    """
+
+
+class ConnectionPool:
+    """
+    Bounded pool of PostgreSQL connections shared by all requests
+
+    Idle connections are health checked before reuse, broken connections are
+    replaced and a failed unit of work is retried once on a fresh connection.
+    """
+
+    def __init__(self, connect, size=POOL_SIZE, timeout=POOL_TIMEOUT_SECS, health_check=HEALTH_CHECK_SECS):
+        """
+        :param connect: callable opening a new connection, returning None on failure
+        :param size: maximum number of open connections
+        :param timeout: seconds to wait for a free connection
+        :param health_check: idle seconds after which a connection is checked before reuse
+        """
+        self.__connect = connect
+        self.__size = size
+        self.__timeout = timeout
+        self.__health_check = health_check
+        self.__slots = threading.BoundedSemaphore(size)
+        self.__idle = queue.LifoQueue()
+        self.__lock = threading.Lock()
+        self.__open = 0
+        self.__checkouts = 0
+        self.__wait_total = 0.0
+        self.__wait_max = 0.0
+        self.__timeouts = 0
+        self.__reconnects = 0
+
+    def __acquire(self):
+        """
+        Wait for a free slot and check out a healthy connection
+        :return: connection to the DB
+        """
+        start = time.monotonic()
+        if not self.__slots.acquire(timeout=self.__timeout):
+            with self.__lock:
+                self.__timeouts += 1
+            raise PoolTimeout(f"No DB connection available after {self.__timeout}s")
+
+        waited = time.monotonic() - start
+        with self.__lock:
+            self.__checkouts += 1
+            self.__wait_total += waited
+            self.__wait_max = max(self.__wait_max, waited)
+
+        try:
+            while True:
+                try:
+                    connection, last_used = self.__idle.get_nowait()
+                except queue.Empty:
+                    return self.__open_connection()
+                if self.__healthy(connection, last_used):
+                    return connection
+                self.__discard(connection)
+        except BaseException:
+            self.__slots.release()
+            raise
+
+    def __release(self, connection, broken=False):
+        """
+        Return a connection to the pool, dropping it if it is broken
+        :param connection: connection checked out from the pool
+        :param broken: true if the connection failed while in use
+        """
+        try:
+            if broken or connection.closed:
+                self.__discard(connection)
+            else:
+                connection.rollback()
+                self.__idle.put((connection, time.monotonic()))
+        except psycopg2.Error:
+            self.__discard(connection)
+        finally:
+            self.__slots.release()
+
+    def __open_connection(self):
+        """
+        Open a new connection
+        :return: connection to the DB
+        """
+        connection = self.__connect()
+        if connection is None:
+            raise psycopg2.OperationalError("Unable to connect to DB")
+        with self.__lock:
+            self.__open += 1
+        return connection
+
+    def __discard(self, connection):
+        """
+        Close a connection that will not be reused
+        :param connection: connection to be closed
+        """
+        with self.__lock:
+            self.__open -= 1
+            self.__reconnects += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def __healthy(self, connection, last_used):
+        """
+        Check that an idle connection is still usable
+        :param connection: idle connection
+        :param last_used: monotonic time the connection was returned
+        :return: true if the connection can be reused
+        """
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.__health_check:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error as error:
+            logging.warning(f"Dropping unhealthy DB connection, err:{error}")
+            return False
+
+    def run(self, work):
+        """
+        Run a unit of work with a pooled connection, retrying once on a
+        fresh connection if the connection fails
+        :param work: callable taking the connection and returning a result
+        :return: result of work
+        """
+        for attempt in range(2):
+            connection = self.__acquire()
+            try:
+                result = work(connection)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+                self.__release(connection, broken=True)
+                if attempt:
+                    raise
+                logging.warning(f"DB connection failed, reconnecting, err:{error}")
+            except BaseException:
+                self.__release(connection)
+                raise
+            else:
+                self.__release(connection)
+                return result
+
+    def stats(self):
+        """
+        Pool metrics
+        :return: dict of pool size, usage and wait time metrics
+        """
+        with self.__lock:
+            return {'size': self.__size,
+                    'open': self.__open,
+                    'idle': self.__idle.qsize(),
+                    'checkouts': self.__checkouts,
+                    'wait_total_secs': round(self.__wait_total, 6),
+                    'wait_avg_secs': round(self.__wait_total / self.__checkouts, 6) if self.__checkouts else 0.0,
+                    'wait_max_secs': round(self.__wait_max, 6),
+                    'timeouts': self.__timeouts,
+                    'reconnects': self.__reconnects}
+
+
+def connect(host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PW, database=DB_NAME):
+    """
+    Connect to the PostgreSQL DB
+    :return: connection to the DB
+    """
+    try:
+        connection = psycopg2.connect(user=user,
+                                      password=password,
+                                      host=host,
+                                      port=port,
+                                      database=database)
+        return connection
+    except (Exception, psycopg2.Error) as error:
+        logging.error(f"Failed to connect to DB, err:{error}")
+
+
+class PostgresRegistry(DeviceRegistry):
+    """
+    Device registry on a remote PostgreSQL DB, accessed through a connection pool
+    """
+
+    def __init__(self, host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PW,
+                 database=DB_NAME, pool_size=POOL_SIZE):
+        """
+        :param host: DB host
+        :param port: DB port
+        :param user: username of the db
+        :param password: password of the db
+        :param database: name of the db
+        :param pool_size: maximum number of DB connections
+        """
+        if psycopg2 is None:
+            raise Exception('psycopg2 is required for the PostgreSQL backend!')
+
+        def open_connection():
+            return connect(host, port, user, password, database)
+
+        self.__pool = ConnectionPool(open_connection, size=pool_size)
+
+    def upsert(self, device_id, email):
+        def work(connection):
+            postgres_query = "INSERT INTO device_list (device_id, notification_email) VALUES (%s, %s) " \
+                             "ON CONFLICT (device_id) DO UPDATE SET notification_email = excluded.notification_email"
+            cursor = connection.cursor()
+            cursor.execute(postgres_query, [device_id, email])
+
+            connection.commit()
+            return cursor.rowcount
+
+        return self.__pool.run(work)
+
+    def retrieve(self, device_id):
+        def work(connection):
+            postgres_query = "SELECT notification_email FROM device_list WHERE device_id=(%s)"
+            cursor = connection.cursor()
+            cursor.execute(postgres_query, [device_id])
+            return cursor.fetchone()
+
+        result = self.__pool.run(work)
+        return result[0] if result else None
+
+    def retrieve_many(self, device_ids):
+        def work(connection):
+            postgres_query = "SELECT device_id, notification_email FROM device_list WHERE device_id = ANY(%s)"
+            cursor = connection.cursor()
+            cursor.execute(postgres_query, [list(device_ids)])
+            return cursor.fetchall()
+
+        return dict(self.__pool.run(work))
+
+    def dump(self):
+        def work(connection):
+            postgres_query = "SELECT device_id, notification_email FROM device_list"
+            cursor = connection.cursor()
+            cursor.execute(postgres_query)
+            return [dict((cursor.description[i][0], value)
+                         for i, value in enumerate(row)) for row in cursor.fetchall()]
+
+        return self.__pool.run(work)
+
+    def page(self, after, limit):
+        def work(connection):
+            cursor = connection.cursor()
+            if after is None:
+                postgres_query = "SELECT device_id, notification_email FROM device_list " \
+                                 "ORDER BY device_id LIMIT %s"
+                cursor.execute(postgres_query, [limit])
+            else:
+                postgres_query = "SELECT device_id, notification_email FROM device_list " \
+                                 "WHERE device_id > %s ORDER BY device_id LIMIT %s"
+                cursor.execute(postgres_query, [after, limit])
+            return cursor.fetchall()
+
+        return self.__pool.run(work)
+
+    def for_each(self, callback):
+        """
+        Rows are read through a server side cursor FETCH_SIZE at a time,
+        and a failed connection resumes after the last row called back
+        :param callback: callable taking device_id and email
+        :return: number of devices
+        """
+        state = {'after': None, 'count': 0}
+
+        def work(connection):
+            with connection.cursor(name='device_dump') as cursor:
+                cursor.itersize = FETCH_SIZE
+                if state['after'] is None:
+                    cursor.execute("SELECT device_id, notification_email FROM device_list ORDER BY device_id")
+                else:
+                    cursor.execute("SELECT device_id, notification_email FROM device_list "
+                                   "WHERE device_id > %s ORDER BY device_id", [state['after']])
+                for device_id, email in cursor:
+                    callback(device_id, email)
+                    state['after'] = device_id
+                    state['count'] += 1
+
+        self.__pool.run(work)
+        return state['count']
+
+    def stats(self):
+        return {'pool': self.__pool.stats()}
+
+
+class SqliteRegistry(DeviceRegistry):
+    """
+    Device registry in an embedded SQLite DB, for local load tests and
+    single node deployments
+
+    Each thread gets its own connection, the DB runs in WAL mode so readers
+    do not block the writer.
+    """
+
+    def __init__(self, db_file=DB_FILE):
+        """
+        :param db_file: file name of sqlite DB file
+        """
+        self.__db_file = db_file
+        self.__local = threading.local()
+
+        connection = self.__connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS device_list ("
+                           "device_id INTEGER PRIMARY KEY, "
+                           "notification_email VARCHAR(320) NOT NULL)")
+        connection.commit()
+
+    def __connection(self):
+        """
+        Connection of the calling thread
+        :return: sqlite connection
+        """
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.__db_file, timeout=SQLITE_TIMEOUT_SECS)
+            self.__local.connection = connection
+        return connection
+
+    def upsert(self, device_id, email):
+        # INSERT OR REPLACE has the same effect as PostgreSQL's ON CONFLICT
+        # DO UPDATE here as the table has no other columns, and works with
+        # SQLite older than 3.24
+        connection = self.__connection()
+        with connection:
+            cursor = connection.execute(
+                "INSERT OR REPLACE INTO device_list (device_id, notification_email) VALUES (?, ?)",
+                (device_id, email))
+        return cursor.rowcount
+
+    def retrieve(self, device_id):
+        result = self.__connection().execute(
+            "SELECT notification_email FROM device_list WHERE device_id = ?", (device_id,)).fetchone()
+        return result[0] if result else None
+
+    def retrieve_many(self, device_ids):
+        device_ids = list(device_ids)
+        if not device_ids:
+            return {}
+        query = "SELECT device_id, notification_email FROM device_list WHERE device_id IN ({})".format(
+            ', '.join('?' * len(device_ids)))
+        return dict(self.__connection().execute(query, device_ids).fetchall())
+
+    def dump(self):
+        cursor = self.__connection().execute("SELECT device_id, notification_email FROM device_list")
+        return [{'device_id': device_id, 'notification_email': email} for device_id, email in cursor]
+
+    def page(self, after, limit):
+        if after is None:
+            cursor = self.__connection().execute(
+                "SELECT device_id, notification_email FROM device_list ORDER BY device_id LIMIT ?", (limit,))
+        else:
+            cursor = self.__connection().execute(
+                "SELECT device_id, notification_email FROM device_list "
+                "WHERE device_id > ? ORDER BY device_id LIMIT ?", (after, limit))
+        return cursor.fetchall()
+
+    def for_each(self, callback):
+        count = 0
+        cursor = self.__connection().execute(
+            "SELECT device_id, notification_email FROM device_list ORDER BY device_id")
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return count
+            for device_id, email in rows:
+                callback(device_id, email)
+                count += 1
+
+    def stats(self):
+        return {'db_file': self.__db_file}
@@ -12,27 +12,28 @@ Notes
 - Code follows the PEP 8 style guide:
   https://www.python.org/dev/peps/pep-0008/
 """
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import logging
+import queue
 import smtplib
+import threading
+import time
 import constants as c
 
+DIGEST_WINDOW_SECS = 30
+IDLE_TIMEOUT_SECS = 60
+RESOLVE_WORKERS = 32
 
-def send_email(sender, recipients, subject, content):
-    """
-    Sends an email to recipient(s)
 
-    Parameters
-    ----------
-    sender : str
-    recipients : list
-    subject : str
-    content : str
+def open_session():
     """
-    if not recipients:
-        logging.debug('No recipients specified')
-        return
+    Connects & logs in to the SMTP server
 
+    Returns
+    -------
+    session : smtplib.SMTP
+    """
     # Connect to Gmail Server
     session = smtplib.SMTP(c.SMTP_SERVER, c.SMTP_PORT)
     session.ehlo()
@@ -41,7 +42,24 @@ def send_email(sender, recipients, subject, content):
 
     # Login to Gmail
     session.login(c.GMAIL_USERNAME, c.GMAIL_PASSWORD)
+    return session
+
+
+def build_message(sender, recipient, subject, content):
+    """
+    Builds an html email
 
+    Parameters
+    ----------
+    sender : str
+    recipient : str
+    subject : str
+    content : str
+
+    Returns
+    -------
+    message : str
+    """
     # General email headers
     from_header = 'From: {}'.format('COVID Risk Alert System')
     subject_header = 'Subject: {}'.format(subject)
@@ -51,21 +69,232 @@ def send_email(sender, recipients, subject, content):
     # Create html body of message
     content_html = c.CONTENT_HTML.format(body=content, sender=sender)
 
+    # Create recipient specific email header
+    to_header = 'To: {}'.format(recipient)
+    headers = [from_header, subject_header, to_header,
+               mime_header, type_header]
+    headers = '\r\n'.join(headers)
+    return headers + '\r\n\r\n' + content_html
+
+
+def send_email(sender, recipients, subject, content):
+    """
+    Sends an email to recipient(s)
+
+    Parameters
+    ----------
+    sender : str
+    recipients : list
+    subject : str
+    content : str
+    """
+    if not recipients:
+        logging.debug('No recipients specified')
+        return
+
+    session = open_session()
+
     # Iterate through recipients
     for r in recipients:
-        # Create recipient specific email header
-        to_header = 'To: {}'.format(r)
-        headers = [from_header, subject_header, to_header,
-                   mime_header, type_header]
-        headers = '\r\n'.join(headers)
-        message = headers + '\r\n\r\n' + content_html
+        message = build_message(sender, r, subject, content)
 
         # Send Email
         logging.debug('Sending an email to: {}'.format(r))
         session.sendmail(c.GMAIL_USERNAME, r, message)
 
     # Exit
-    session.quit
+    session.quit()
+
+
+class EmailDispatcher:
+    """
+    Sends notification emails from a background thread
+
+    Alerts are queued so callers never wait on SMTP. One SMTP session is
+    kept open between emails & closed after being idle. Alerts for the
+    same recipient within the digest window are sent as one digest email.
+    A device's own recipient is looked up on a pool of threads, so the
+    lookups of concurrent alerts can be batched together.
+    """
+
+    def __init__(self, digest_window=DIGEST_WINDOW_SECS,
+                 idle_timeout=IDLE_TIMEOUT_SECS, lookup=None,
+                 resolve_workers=RESOLVE_WORKERS):
+        """
+        Parameters
+        ----------
+        digest_window : float
+            Seconds to wait for more alerts to the same recipient,
+            0 to send every alert right away
+        idle_timeout : float
+            Seconds before an unused SMTP session is closed
+        lookup
+            Object whose lookup(device_id) returns the email registered
+            for a device, empty if none
+        resolve_workers : int
+            Device lookups in progress at once
+        """
+        self.__digest_window = digest_window
+        self.__idle_timeout = idle_timeout
+        self.__lookup = lookup
+        self.__resolver = None
+        if lookup is not None:
+            self.__resolver = ThreadPoolExecutor(max_workers=resolve_workers)
+        self.__queue = queue.Queue()
+        self.__pending = {}
+        self.__session = None
+        self.__last_used = 0
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def submit(self, sender, recipients, subject, content, device_id=None):
+        """
+        Queues an email to recipient(s)
+
+        Parameters
+        ----------
+        sender : str
+        recipients : list
+        subject : str
+        content : str
+        device_id : int
+            Device whose registered email is added to the recipients,
+            needs a lookup
+        """
+        recipients = list(recipients or [])
+        if device_id is not None and self.__resolver is not None:
+            self.__resolver.submit(self.__resolve, sender, recipients,
+                                   subject, content, device_id)
+            return
+        self.__put(sender, recipients, subject, content)
+
+    def __resolve(self, sender, recipients, subject, content, device_id):
+        """
+        Adds a device's registered email to the recipients & queues the
+        email, on a resolver thread
+
+        Parameters
+        ----------
+        sender : str
+        recipients : list
+        subject : str
+        content : str
+        device_id : int
+        """
+        try:
+            email = self.__lookup.lookup(device_id)
+        except Exception as e:
+            logging.error('Failed to look up email of {}: {}'.format(
+                device_id, e))
+            email = ''
+        if email and email not in recipients:
+            recipients.append(email)
+        self.__put(sender, recipients, subject, content)
+
+    def __put(self, sender, recipients, subject, content):
+        """
+        Queues an email for the sending thread
+
+        Parameters
+        ----------
+        sender : str
+        recipients : list
+        subject : str
+        content : str
+        """
+        if not recipients:
+            logging.debug('No recipients specified')
+            return
+        self.__queue.put((sender, recipients, subject, content))
+
+    def __run(self):
+        """
+        Collects queued alerts & sends digests when they are due
+        """
+        while True:
+            try:
+                sender, recipients, subject, content = self.__queue.get(
+                    timeout=self.__next_wakeup())
+                due = time.monotonic() + self.__digest_window
+                for r in recipients:
+                    digest = self.__pending.setdefault(r, [due, sender, []])
+                    digest[2].append((subject, content))
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for r, (due, sender, alerts) in list(self.__pending.items()):
+                if due <= now:
+                    del self.__pending[r]
+                    self.__send_digest(sender, r, alerts)
+
+            if self.__session and \
+                    now - self.__last_used >= self.__idle_timeout:
+                logging.debug('Closing idle SMTP session')
+                self.__close()
+
+    def __next_wakeup(self):
+        """
+        Returns
+        -------
+        float
+            Seconds until the next digest is due or the session goes idle
+        """
+        now = time.monotonic()
+        wakeups = [due for due, _, _ in self.__pending.values()]
+        if self.__session:
+            wakeups.append(self.__last_used + self.__idle_timeout)
+        if not wakeups:
+            return None
+        return max(min(wakeups) - now, 0)
+
+    def __send_digest(self, sender, recipient, alerts):
+        """
+        Sends all alerts for a recipient as one email
+
+        Parameters
+        ----------
+        sender : str
+        recipient : str
+        alerts : list
+            (subject, content) tuples
+        """
+        if len(alerts) == 1:
+            subject, content = alerts[0]
+        else:
+            subject = c.DIGEST_SUBJECT.format(count=len(alerts))
+            content = '<br><br>'.join(
+                '<b>{}</b><br>{}'.format(s, b) for s, b in alerts)
+
+        message = build_message(sender, recipient, subject, content)
+        logging.debug('Sending {} alert(s) to: {}'.format(len(alerts),
+                                                          recipient))
+
+        # Retry once on a new session if the server dropped the old one
+        for attempt in range(2):
+            try:
+                if not self.__session:
+                    self.__session = open_session()
+                self.__session.sendmail(c.GMAIL_USERNAME, recipient, message)
+                self.__last_used = time.monotonic()
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                self.__close()
+                if attempt:
+                    logging.error('Failed to email {}: {}'.format(recipient,
+                                                                  e))
+
+    def __close(self):
+        """
+        Closes the SMTP session
+        """
+        if not self.__session:
+            return
+        try:
+            self.__session.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.__session = None
 
 
 if __name__ == '__main__':
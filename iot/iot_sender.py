@@ -10,11 +10,16 @@ Notes
 """
 import argparse
 import socket as s
+import threading
 import time
 import json
+from collections import OrderedDict
 from constants import THINGSPEAK_DELAY_SECS
 import logging
 
+# Minimum time between two status updates to the same device
+STATUS_INTERVAL_SECS = 1
+
 
 def send(address, message):
     """
@@ -119,6 +124,121 @@ def send_co2_update(address, status):
     send(address, message)
 
 
+class StatusPusher:
+    """
+    Pushes LED status updates to devices from a background thread
+
+    Updates are queued so the caller never waits. Each device is sent at
+    most one update per interval, and only the latest status of each
+    type is kept while an update waits for its turn.
+    """
+
+    def __init__(self, interval=STATUS_INTERVAL_SECS):
+        """
+        Parameters
+        ----------
+        interval : float
+            Minimum seconds between two updates to the same device
+        """
+        self.__interval = interval
+        self.__sock = s.socket(s.AF_INET, s.SOCK_DGRAM)
+        self.__condition = threading.Condition()
+        self.__pending = OrderedDict()
+        self.__next_send = {}
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def push(self, address, type_data, status):
+        """
+        Queue a status update, replacing any queued update of the same type
+
+        Parameters
+        ----------
+        address : tuple
+            Address as (str, int) (IP address, UDP port)
+        type_data : str
+            'humidity' or 'co2'
+        status : str
+        """
+        with self.__condition:
+            self.__pending[(address, type_data)] = status
+            self.__condition.notify()
+
+    def push_humidity(self, address, status):
+        """
+        Queue a Humidity LED update
+
+        Parameters
+        ----------
+        address : tuple
+            Address as (str, int) (IP address, UDP port)
+        status : str
+        """
+        self.push(address, 'humidity', status)
+
+    def push_co2(self, address, status):
+        """
+        Queue a CO2 LED update
+
+        Parameters
+        ----------
+        address : tuple
+            Address as (str, int) (IP address, UDP port)
+        status : str
+        """
+        self.push(address, 'co2', status)
+
+    def __run(self):
+        """
+        Sends queued updates as devices become due
+        """
+        while True:
+            with self.__condition:
+                ready, wait = self.__take_ready()
+                while not ready:
+                    self.__condition.wait(wait)
+                    ready, wait = self.__take_ready()
+
+            for address, type_data, status in ready:
+                message = json.dumps({'type': type_data, 'status': status})
+                logging.debug('Sending {} to {}'.format(message, address))
+                try:
+                    self.__sock.sendto(bytes(message, 'utf-8'), address)
+                except OSError as e:
+                    logging.error('Failed to update {}: {}'.format(address,
+                                                                   e))
+
+    def __take_ready(self):
+        """
+        Take the queued updates whose device is due, condition held
+
+        Returns
+        -------
+        ready : list
+            (address, type, status) tuples to send
+        wait : float
+            Seconds until the next queued update is due, None if none
+        """
+        now = time.monotonic()
+        ready = []
+        wait = None
+        for key, status in list(self.__pending.items()):
+            address, type_data = key
+            due = self.__next_send.get(address, 0)
+            if due <= now:
+                del self.__pending[key]
+                ready.append((address, type_data, status))
+                self.__next_send[address] = now + self.__interval
+            elif wait is None or due - now < wait:
+                wait = due - now
+
+        # Forget pacing of devices that are no longer throttled
+        if len(self.__next_send) > 2 * len(self.__pending) + len(ready):
+            self.__next_send = {a: t for a, t in self.__next_send.items()
+                                if t > now}
+        return ready, wait
+
+
 if __name__ == '__main__':
 
     IP = "127.0.0.1"
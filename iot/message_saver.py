@@ -1,9 +1,20 @@
+from segmented_log import SegmentedLog, COMPRESSIONS, FSYNC_POLICIES
+from segmented_log import SegmentIndex, list_segments, iter_records
+from segmented_log import index_path
+import segmented_log
 import socket as s
 import logging
 import argparse
 import constants as c
+import os
+import re
+import sys
 import time
 
+MB = 1024 * 1024
+RECORD_PREFIX = b'{"received_time":'
+DEVICE_ID = re.compile(rb'"id"\s*:\s*"?([^",}\s]*)')
+
 # logging
 LOG = "/tmp/logfile.log"
 logging.basicConfig(filename=LOG, filemode="w", level=logging.DEBUG)
@@ -14,28 +25,129 @@ class MessageSaver:
     Class to save data
     """
 
-    def __init__(self, port, file):
+    def __init__(self, port, file, **log_options):
         """
         Parameters
         ----------
         port : int
         file: string
+            Base path of the log segments
+        log_options : dict
+            Rotation, compression, flush & disk cap options of
+            SegmentedLog
         """
         self.__port = port
         self.__file = file
+        self.__log_options = log_options
 
     def save_data(self):
         """
         Waits to receive data from network
         """
+        log = SegmentedLog(self.__file, **self.__log_options)
+        try:
+            with s.socket(s.AF_INET, s.SOCK_DGRAM) as sock:
+                sock.bind(('', self.__port))
+                # Wake up while idle to flush & rotate old segments
+                sock.settimeout(self.__log_options.get('flush_secs') or
+                                segmented_log.FLUSH_SECS)
+                while True:
+                    try:
+                        message, address = sock.recvfrom(1024)
+                    except s.timeout:
+                        log.tick()
+                        continue
+                    logging.debug('Received: %s', message)
+                    received = time.time()
+                    log.append(RECORD_PREFIX + b'%a,"packet":%b}\n' %
+                               (received, message),
+                               device_id(message), received)
+        finally:
+            log.close()
+
+
+def device_id(packet):
+    """
+    Device id of a packet, without decoding the JSON
+
+    Parameters
+    ----------
+    packet : bytes
+
+    Returns
+    -------
+    bytes
+        None if the packet has no id
+    """
+    match = DEVICE_ID.search(packet)
+    return match.group(1) if match else None
+
+
+def query(file, device=None, start=None, end=None):
+    """
+    Saved packets of a device and/or time window
+
+    Segments whose index rules them out are skipped, the others are read
+    from the indexed offset nearest to start.
+
+    Parameters
+    ----------
+    file : str
+        Base path of the log segments
+    device : str
+        Device id
+    start : float
+        Earliest received time (epoch secs)
+    end : float
+        Latest received time (epoch secs)
+
+    Yields
+    ------
+    bytes
+        Saved lines, oldest first
+    """
+    key = device.encode() if device is not None else None
+    for _, path, _ in list_segments(file):
+        offset = 0
+        if os.path.exists(index_path(path)):
+            index = SegmentIndex.load(index_path(path))
+            if not index.overlaps(start, end):
+                continue
+            if key is not None and key not in index.keys:
+                continue
+            offset = index.seek(start)
+
+        for line in iter_records(path, offset):
+            try:
+                received = float(line[len(RECORD_PREFIX):line.index(b',')])
+            except ValueError:
+                # Torn write at a crash
+                continue
+            if start is not None and received < start:
+                continue
+            if end is not None and received > end:
+                break
+            if key is not None and device_id(line) != key:
+                continue
+            yield line
+
+
+def parse_time(value):
+    """
+    Parameters
+    ----------
+    value : str
+        Epoch secs or local 'YYYY-MM-DD HH:MM:SS'
 
-        with s.socket(s.AF_INET, s.SOCK_DGRAM) as sock, open(self.__file, "a") as f:
-            sock.bind(('', self.__port))
-            while True:
-                message, address = sock.recvfrom(1024)
-                logging.debug('Received: {}'.format(message))
-                # note that this is buffered write, but we are not using this data anyway
-                f.write(f'{{"received_time":{time.time()},"packet":{message.decode()}}}\n')
+    Returns
+    -------
+    float
+        Epoch secs
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return time.mktime(time.strptime(value, '%Y-%m-%d %H:%M:%S'))
 
 
 def parse_args():
@@ -62,9 +174,79 @@ def parse_args():
                         '--file',
                         metavar='<absolut path to file>',
                         default='packets.dat',
-                        help='absolute path to the file for storing packets')
+                        help='absolute path to the file for storing packets, '
+                             'segments are named <file>.<number>')
+
+    parser.add_argument('--segment-mb',
+                        metavar='<MB>',
+                        default=64,
+                        type=float,
+                        help='Start a new segment at this size. Default: 64')
+
+    parser.add_argument('--segment-secs',
+                        metavar='<seconds>',
+                        default=segmented_log.SEGMENT_SECS,
+                        type=float,
+                        help='Start a new segment at this age, 0 for no '
+                             'limit. Default: {}'.format(
+                                 segmented_log.SEGMENT_SECS))
+
+    parser.add_argument('--compress',
+                        choices=sorted(COMPRESSIONS),
+                        default='gzip',
+                        help='Compression of closed segments '
+                             '(zstd needs zstandard). Default: gzip')
+
+    parser.add_argument('--flush-secs',
+                        metavar='<seconds>',
+                        default=segmented_log.FLUSH_SECS,
+                        type=float,
+                        help='Longest time packets stay buffered in memory. '
+                             'Default: {}'.format(segmented_log.FLUSH_SECS))
+
+    parser.add_argument('--fsync',
+                        choices=FSYNC_POLICIES,
+                        default='rotate',
+                        help='When to fsync: never, on segment rotation or '
+                             'on every flush. Default: rotate')
+
+    parser.add_argument('--max-disk-mb',
+                        metavar='<MB>',
+                        default=segmented_log.MAX_DISK_BYTES // MB,
+                        type=float,
+                        help='Delete the oldest segments above this total, '
+                             '0 for no limit. Default: {}'.format(
+                                 segmented_log.MAX_DISK_BYTES // MB))
+
+    parser.add_argument('--query',
+                        default=False,
+                        action='store_true',
+                        help='Print saved packets matching --device, '
+                             '--start & --end instead of receiving')
+
+    parser.add_argument('-d',
+                        '--device',
+                        metavar='<device id>',
+                        help='Device id to query')
+
+    parser.add_argument('--start',
+                        metavar='<time>',
+                        help='Start of the query, epoch secs or '
+                             '"YYYY-MM-DD HH:MM:SS"')
+
+    parser.add_argument('--end',
+                        metavar='<time>',
+                        help='End of the query, epoch secs or '
+                             '"YYYY-MM-DD HH:MM:SS"')
 
     args = parser.parse_args()
+
+    try:
+        args.start = parse_time(args.start) if args.start else None
+        args.end = parse_time(args.end) if args.end else None
+    except ValueError as e:
+        parser.error(str(e))
+
     return args
 
 
@@ -73,5 +255,19 @@ if __name__ == '__main__':
     logging_level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(format=c.LOGGING_FORMAT, level=logging_level)
 
-    poller = MessageSaver(args.port, args.file)
-    poller.save_data()
+    if args.query:
+        for line in query(args.file, args.device, args.start, args.end):
+            sys.stdout.buffer.write(line)
+        sys.exit()
+
+    poller = MessageSaver(args.port, args.file,
+                          segment_bytes=int(args.segment_mb * MB),
+                          segment_secs=args.segment_secs,
+                          compression=args.compress,
+                          flush_secs=args.flush_secs,
+                          fsync=args.fsync,
+                          max_disk_bytes=int(args.max_disk_mb * MB))
+    try:
+        poller.save_data()
+    except KeyboardInterrupt:
+        logging.info('Exiting due to keyboard interrupt')
@@ -11,42 +11,679 @@ Notes
 - Code follows the PEP 8 style guide:
   https://www.python.org/dev/peps/pep-0008/
 """
-from thingspeak import write_to_channel
+from thingspeak import write_to_channel, ChannelPool
+from alert_state import AlertStateTable
+from window_aggregator import WindowAggregator
+from sqlite_db import HumidityDB, Co2DB
+from upload_outbox import UploadOutbox, OUTBOX_FILE
+import abc
+import os
+import thingspeak
 import socket as s
 import constants as c
 import iot_email
 import iot_sender
+import timezones
 import logging
 import argparse
 import json
+import threading
+import time
+import multiprocessing
+import queue
+from collections import OrderedDict
 
 # logging
 LOG = "/tmp/logfile.log"
 logging.basicConfig(filename=LOG, filemode="w", level=logging.DEBUG)
 
+LOOKUP_WINDOW_SECS = 0.01
+LOOKUP_TIMEOUT_SECS = 1
+EMAIL_CACHE_SIZE = 10000
+EMAIL_TTL_SECS = 300
+EMAIL_NEGATIVE_TTL_SECS = 60
+WORKER_QUEUE_SIZE = 1000
+SUPERVISE_SECS = 1
+FLUSH_SECS = 1
+SINK_BATCH_SIZE = 500
+SINK_BATCH_SECS = 1
+SINK_MAX_BUFFERED = 10 * SINK_BATCH_SIZE
+# Type -> (value field, window stats field) of ThingSpeak updates
+UPLOAD_FIELDS = {'humidity': (c.HUMIDITY_FIELD, c.HUMIDITY_STATS_FIELD),
+                 'co2': (c.CO2_FIELD, c.CO2_STATS_FIELD)}
+
+
+class Sink(metaclass=abc.ABCMeta):
+    """
+    Destination of processed readings
+
+    Records are dicts with 'id', 'location', 'type' ('humidity' or 'co2'),
+    'value' & 'time' (epoch seconds the reading was taken). Window
+    summaries also have 'minimum', 'maximum' & 'count', 'value' being the
+    mean.
+    """
+    # True if the sink only gets window summaries & threshold crossings
+    # when DataPoller aggregates readings
+    summarized = False
+
+    @abc.abstractmethod
+    def write(self, record):
+        pass
+
+    def flush(self, force=False):
+        """
+        Write out buffered records, called periodically
+
+        Parameters
+        ----------
+        force : bool
+            Write out every buffered record now
+        """
+        pass
+
+
+class ThingSpeakSink(Sink):
+    """
+    Uploads records to the ThingSpeak channel pool
+
+    Updates go through a durable outbox & are sent oldest first as the
+    channels' rate budget allows, failed updates are retried with
+    backoff. With coalescing, a device's humidity & CO2 readings arriving
+    within coalesce_secs of each other are merged into one update.
+    Window summaries carry the min, max & count of each type in its
+    stats field as 'min,max,count'.
+    """
+    summarized = True
+
+    def __init__(self, channels=None, coalesce_secs=0, outbox=None):
+        """
+        Parameters
+        ----------
+        channels : ChannelPool
+            Channels to write to, the configured pool by default
+        coalesce_secs : float
+            Seconds a reading waits for the device's other reading,
+            0 to upload every record on its own
+        outbox : UploadOutbox
+            Queue of pending updates, OUTBOX_FILE by default
+        """
+        self.__channels = channels if channels is not None else ChannelPool()
+        self.__outbox = outbox if outbox is not None else UploadOutbox()
+        self.__coalesce_secs = coalesce_secs
+        # Device id -> [due time, location, {type: record}], oldest first
+        self.__pending = OrderedDict()
+
+    def write(self, record):
+        """
+        Write a record to the cloud, or hold it to be merged
+
+        Parameters
+        ----------
+        record : dict
+        """
+        if self.__coalesce_secs <= 0:
+            self.__upload(record['id'], record['location'],
+                          {record['type']: record})
+            self.__drain()
+            return
+
+        id_data = record['id']
+        entry = self.__pending.get(id_data)
+
+        # Same type twice, the held reading can't be merged
+        if entry and record['type'] in entry[2]:
+            del self.__pending[id_data]
+            self.__upload(id_data, entry[1], entry[2])
+            entry = None
+
+        if entry is None:
+            entry = [time.monotonic() + self.__coalesce_secs, None, {}]
+            self.__pending[id_data] = entry
+        entry[1] = record['location']
+        entry[2][record['type']] = record
+
+        if len(entry[2]) == 2:
+            del self.__pending[id_data]
+            self.__upload(id_data, entry[1], entry[2])
+        self.__drain()
+
+    def flush(self, force=False):
+        """
+        Upload held readings whose coalescing window is over & send
+        what the outbox holds
+
+        Parameters
+        ----------
+        force : bool
+            Upload every held reading now
+        """
+        now = time.monotonic()
+        while self.__pending:
+            id_data, entry = next(iter(self.__pending.items()))
+            if not force and entry[0] > now:
+                break
+            del self.__pending[id_data]
+            self.__upload(id_data, entry[1], entry[2])
+        self.__drain()
+
+    def backlog(self):
+        """
+        Returns
+        -------
+        int
+            Updates waiting in the outbox
+        """
+        return len(self.__outbox)
+
+    def __upload(self, id_data, location, records):
+        """
+        Queue one channel update in the outbox
+
+        Parameters
+        ----------
+        id_data : int
+        location : str
+        records : dict
+            'humidity' and/or 'co2' to record
+        """
+        fields = {c.NODE_FIELD: id_data,
+                  c.LOCATION_FIELD: location}
+        for type_data, record in records.items():
+            value_field, stats_field = UPLOAD_FIELDS[type_data]
+            fields[value_field] = record['value']
+            if 'count' in record:
+                fields[stats_field] = '{},{},{}'.format(
+                    record['minimum'], record['maximum'], record['count'])
+        self.__outbox.put(id_data, fields)
+
+    def __drain(self):
+        """
+        Send queued updates in order until the outbox is empty, the oldest
+        update is backing off or the channels are rate limited
+        """
+        while True:
+            upload = self.__outbox.head()
+            if upload is None:
+                return
+            seq, id_data, fields = upload
+
+            # Wait for the rate budget rather than sending a burst
+            channel = self.__channels.acquire(id_data)
+            if channel is None:
+                return
+
+            link = '{}/channels/{}/feeds.json?'.format(thingspeak.BASE_URL,
+                                                      channel.feed)
+
+            # Data received that should be recorded in the cloud
+            logging.debug('Writing to cloud')
+            status, reason, body = write_to_channel(channel.write_key,
+                                                    fields)
+
+            # ThingSpeak rejects a write (e.g. rate limited) with entry id 0
+            if status == c.GOOD_STATUS and body not in (None, '', '0'):
+                self.__outbox.ack(seq)
+                logging.debug('Write to cloud was succesful')
+                logging.debug('View results here {}'.format(link))
+            else:
+                rejected = status == c.GOOD_STATUS
+                if rejected:
+                    reason = 'rejected'
+                delay = self.__outbox.retry(seq, rejected)
+                if delay is None:
+                    # Don't let an update the cloud never accepts hold back
+                    # the ones behind it
+                    logging.error('Write to cloud was rejected too many '
+                                  'times, moved update {} of device {} to '
+                                  'the dead letters: {}'.format(seq, id_data,
+                                                                fields))
+                    continue
+                logging.error('Write to cloud was unsuccessful: {}, retrying '
+                              'in {:.0f} s with {} updates waiting'.format(
+                                  reason, delay, len(self.__outbox)))
+                return
+
+
+class ReadingsStoreSink(Sink):
+    """
+    Writes records straight to the local humidity & CO2 DBs in batches,
+    without the round trip through the cloud & cloud_reader.py
+
+    Dates & times are in the channel timezone, like the ones
+    cloud_reader.py saves. A batch that fails to be written (e.g. the DB
+    is locked by another writer) is kept & retried after batch_secs.
+    """
+
+    def __init__(self, humidity_db=c.HUMIDITY_DB_FILE, co2_db=c.CO2_DB_FILE,
+                 batch_size=SINK_BATCH_SIZE, batch_secs=SINK_BATCH_SECS,
+                 max_buffered=SINK_MAX_BUFFERED):
+        """
+        Parameters
+        ----------
+        humidity_db : str
+            file name of humidity sqlite DB file
+        co2_db : str
+            file name of CO2 sqlite DB file
+        batch_size : int
+            Records buffered before writing a batch
+        batch_secs : float
+            Maximum seconds a record stays buffered, unless writing fails
+        max_buffered : int
+            Records of each type kept while writes fail, the oldest are
+            dropped beyond this
+        """
+        self.__dbs = {'humidity': lambda: HumidityDB(db_file=humidity_db),
+                      'co2': lambda: Co2DB(db_file=co2_db)}
+        self.__batch_size = batch_size
+        self.__batch_secs = batch_secs
+        self.__max_buffered = max_buffered
+        self.__batches = {'humidity': [], 'co2': []}
+        self.__oldest = None
+        self.__retry_at = 0
+
+        # Create DBs if they don't exist, or bring them up to date
+        for create_db in self.__dbs.values():
+            with create_db() as db:
+                if not db.table_exists():
+                    db.create_table()
+                else:
+                    db.upgrade_table()
+
+    def write(self, record):
+        """
+        Buffer a record, writing the batch once full
+
+        Parameters
+        ----------
+        record : dict
+        """
+        utc_offset = timezones.utc_offset(c.THINGSPEAK_TIMEZONE,
+                                          record['time'])
+        local = time.gmtime(record['time'] + utc_offset)
+        self.__batches[record['type']].append(
+            {'date': time.strftime('%Y-%m-%d', local),
+             'time': time.strftime('%H:%M:%S', local),
+             'timestamp': int(record['time'] * 1000),
+             'utc_offset': utc_offset // 60,
+             'id': record['id'],
+             'location': record['location'],
+             record['type']: record['value']})
+        if self.__oldest is None:
+            self.__oldest = time.monotonic()
+
+        if sum(len(b) for b in self.__batches.values()) >= \
+                self.__batch_size and time.monotonic() >= self.__retry_at:
+            self.flush(force=True)
+
+    def flush(self, force=False):
+        """
+        Write buffered records, one transaction per DB
+
+        Parameters
+        ----------
+        force : bool
+            Write even if the oldest record is younger than batch_secs
+        """
+        if self.__oldest is None:
+            return
+        now = time.monotonic()
+        if not force and (now - self.__oldest < self.__batch_secs or
+                          now < self.__retry_at):
+            return
+
+        failed = False
+        for type_data, batch in self.__batches.items():
+            if not batch:
+                continue
+            try:
+                with self.__dbs[type_data]() as db:
+                    db.add_records(batch)
+            except Exception as e:
+                # The transaction was rolled back, keep the batch
+                failed = True
+                excess = len(batch) - self.__max_buffered
+                if excess > 0:
+                    del batch[:excess]
+                    logging.error('Dropped {} oldest {} records'.format(
+                        excess, type_data))
+                logging.error('Failed to store {} {} records, retrying in '
+                              '{} s: {}'.format(len(batch), type_data,
+                                                self.__batch_secs, e))
+                continue
+            self.__batches[type_data] = []
+
+        if failed:
+            self.__retry_at = time.monotonic() + self.__batch_secs
+        else:
+            self.__oldest = None
+
+SINKS = {'thingspeak': ThingSpeakSink,
+         'sqlite': ReadingsStoreSink}
+
+
+def create_sinks(names, coalesce_secs=0, channels=None,
+                 outbox_file=OUTBOX_FILE):
+    """
+    Create sinks by name
+
+    Parameters
+    ----------
+    names : list
+        Keys of SINKS
+    coalesce_secs : float
+        Coalescing window of the ThingSpeak sink
+    channels : ChannelPool
+        Channels of the ThingSpeak sink, the configured pool by default
+    outbox_file : str
+        DB file of the ThingSpeak sink's outbox
+
+    Returns
+    -------
+    list
+        Sink instances
+    """
+    sinks = []
+    for name in names:
+        if name == 'thingspeak':
+            sinks.append(ThingSpeakSink(channels, coalesce_secs,
+                                        UploadOutbox(outbox_file)))
+        else:
+            sinks.append(SINKS[name]())
+    return sinks
+
+
+class PendingLookup:
+    """
+    Email lookup waiting for a batched reply
+    """
+    __slots__ = ('event', 'email')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.email = None
+
+
+class EmailLookup:
+    """
+    Aggregates concurrent email lookups into retrieve_many requests
+
+    Lookups arriving within the same short window share one request,
+    so a burst of alerts costs a handful of round trips to the
+    device manager.
+    """
+
+    def __init__(self, address=(c.DEVICE_MANAGER, c.DEVICE_MANAGER_PORT),
+                 window=LOOKUP_WINDOW_SECS, timeout=LOOKUP_TIMEOUT_SECS):
+        """
+        Parameters
+        ----------
+        address : tuple
+            (str, int) address of the device manager
+        window : float
+            Seconds to wait for more lookups before sending a batch
+        timeout : float
+            Seconds to wait for a reply
+        """
+        self.__address = address
+        self.__window = window
+        self.__timeout = timeout
+        self.__pending = {}
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def lookup(self, device_id):
+        """
+        Look up the email registered for a device
+
+        Parameters
+        ----------
+        device_id : int
+
+        Returns
+        -------
+        str
+            Email address, empty if unregistered, None if the lookup
+            failed
+        """
+        with self.__condition:
+            pending = self.__pending.get(device_id)
+            if pending is None:
+                pending = PendingLookup()
+                self.__pending[device_id] = pending
+                self.__condition.notify()
+
+        pending.event.wait(self.__window + 2 * self.__timeout)
+        return pending.email
+
+    def lookup_many(self, device_ids):
+        """
+        Look up the emails of many devices right away
+
+        Parameters
+        ----------
+        device_ids : list
+
+        Returns
+        -------
+        emails : dict
+            device id to email address, missing if lookup failed
+        """
+        emails = {}
+        for i in range(0, len(device_ids), c.MAX_RETRIEVE_MANY):
+            chunk = device_ids[i:i + c.MAX_RETRIEVE_MANY]
+            emails.update(retrieve_emails(chunk, self.__address,
+                                          self.__timeout))
+        return emails
+
+    def __run(self):
+        """
+        Sends batches of pending lookups
+        """
+        while True:
+            with self.__condition:
+                while not self.__pending:
+                    self.__condition.wait()
+
+            # Let concurrent lookups join the batch
+            time.sleep(self.__window)
+
+            with self.__condition:
+                batch = self.__pending
+                self.__pending = {}
+
+            # Keep the thread alive whatever the reply, a failed batch
+            # fails its lookups only
+            try:
+                emails = self.lookup_many(list(batch))
+            except Exception as e:
+                logging.error('Email lookup batch failed: {}'.format(e))
+                emails = {}
+            for device_id, pending in batch.items():
+                # Missing from reply means the lookup failed
+                pending.email = emails.get(device_id)
+                pending.event.set()
+
+
+class EmailCache:
+    """
+    LRU cache of device id -> email with a time to live
+
+    Unregistered devices are cached too, for a shorter time. Expired
+    entries are still served while a background thread refreshes them,
+    so only devices never seen before wait on the device manager.
+    """
+
+    def __init__(self, lookup, size=EMAIL_CACHE_SIZE, ttl=EMAIL_TTL_SECS,
+                 negative_ttl=EMAIL_NEGATIVE_TTL_SECS):
+        """
+        Parameters
+        ----------
+        lookup : EmailLookup
+            Used for devices not in the cache
+        size : int
+            Maximum number of cached devices
+        ttl : float
+            Seconds before a registered email is refreshed
+        negative_ttl : float
+            Seconds before an unregistered device is refreshed
+        """
+        self.__lookup = lookup
+        self.__size = size
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__stale = set()
+        self.__refresh = threading.Condition(self.__lock)
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def lookup(self, device_id):
+        """
+        Look up the email registered for a device
+
+        Parameters
+        ----------
+        device_id : int
+
+        Returns
+        -------
+        str
+            Email address, empty if unregistered or lookup failed
+        """
+        with self.__lock:
+            entry = self.__entries.get(device_id)
+            if entry is not None:
+                email, expires = entry
+                self.__entries.move_to_end(device_id)
+                if expires <= time.monotonic() and device_id not in self.__stale:
+                    self.__stale.add(device_id)
+                    self.__refresh.notify()
+                return email
+
+        # A failed lookup isn't cached as unregistered, the next alert
+        # tries again
+        email = self.__lookup.lookup(device_id)
+        if email is None:
+            return ''
+        self.__store(device_id, email)
+        return email
+
+    def __store(self, device_id, email):
+        """
+        Cache an email, evicting the least recently used entries
+
+        Parameters
+        ----------
+        device_id : int
+        email : str
+        """
+        ttl = self.__ttl if email else self.__negative_ttl
+        with self.__lock:
+            self.__entries[device_id] = (email, time.monotonic() + ttl)
+            self.__entries.move_to_end(device_id)
+            while len(self.__entries) > self.__size:
+                self.__entries.popitem(last=False)
+
+    def __run(self):
+        """
+        Refreshes expired entries in batches
+        """
+        while True:
+            with self.__lock:
+                while not self.__stale:
+                    self.__refresh.wait()
+                stale = list(self.__stale)
+
+            emails = self.__lookup.lookup_many(stale)
+            for device_id in stale:
+                # Missing from reply means the lookup failed, keep the
+                # previous email & retry after the negative TTL
+                if device_id in emails:
+                    self.__store(device_id, emails[device_id])
+                else:
+                    with self.__lock:
+                        entry = self.__entries.get(device_id)
+                        if entry is not None:
+                            self.__entries[device_id] = (
+                                entry[0],
+                                time.monotonic() + self.__negative_ttl)
+
+            with self.__lock:
+                self.__stale.difference_update(stale)
+
+
+def retrieve_emails(device_ids, address=(c.DEVICE_MANAGER, c.DEVICE_MANAGER_PORT),
+                    timeout=LOOKUP_TIMEOUT_SECS):
+    """
+    Retrieve the emails of many devices in one request
+
+    Parameters
+    ----------
+    device_ids : list
+        At most c.MAX_RETRIEVE_MANY 48-bit mac addresses
+    address : tuple
+        (str, int) address of the device manager
+    timeout : float
+
+    Returns
+    -------
+    emails : dict
+        device id to email address, missing if lookup failed
+    """
+    emails = {}
+    request = json.dumps({'type': 'retrieve_many', 'device_ids': device_ids})
+    try:
+        with s.socket(s.AF_INET, s.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.sendto(bytes(request, 'utf-8'), address)
+            reply, _ = sock.recvfrom(c.MAX_DATAGRAM)
+        reply_json = json.loads(reply)
+
+        if 'error' in reply_json:
+            logging.error(f'Failed to retrieve emails for {len(device_ids)} devices. E:{reply_json["error"]}')
+            return emails
+
+        for entry in reply_json['emails']:
+            emails[entry['device_id']] = entry['email']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        # gaierror & timeout are OSErrors, a malformed reply raises the rest
+        logging.error(f'Failed to retrieve emails for {len(device_ids)} devices. E:{str(e)}')
+        return {}
+    return emails
+
 
 class DataPoller:
     """
     Class to poll data
     """
 
-    def __init__(self, port, address):
+    def __init__(self, port, address, window_secs=0, sinks=None):
         """
         Parameters
         ----------
         port : int
         address : list
+        window_secs : float
+            Upload per-device summaries of windows this long plus
+            threshold crossings, 0 to upload every reading
+        sinks : list
+            Sink instances receiving readings, ThingSpeak only by default
         """
         self.__port = port
         self.__recipients = address
+        self.__sinks = sinks if sinks is not None else [ThingSpeakSink()]
+        self.__aggregator = None
+        if window_secs:
+            self.__aggregator = WindowAggregator(window_secs)
+        self.__next_flush = 0
+        self.__dispatcher = iot_email.EmailDispatcher(
+            lookup=EmailCache(EmailLookup()))
+        self.__status = iot_sender.StatusPusher()
 
-        # Flag to be reset if true after values become safe
-        self.__humidity_warning = False
-        self.__co2_warning = False
-
-        # Flag to be set false after first message processing
-        self.__humidity_first = True
-        self.__co2_first = True
+        # Warning flags of every device & location
+        self.__states = AlertStateTable()
 
     def poll_data(self):
         """
@@ -54,25 +691,25 @@ class DataPoller:
         """
         with s.socket(s.AF_INET, s.SOCK_DGRAM) as sock:
             sock.bind(('', self.__port))
+            sock.settimeout(FLUSH_SECS)
             while True:
-                message, address = sock.recvfrom(1024)
-                self.__address = address
-                logging.debug('Received: {}'.format(message))
-                self.process_data(message)
+                try:
+                    message, address = sock.recvfrom(1024)
+                    self.__address = address
+                    logging.debug('Received: {}'.format(message))
+                    self.process_data(message)
+                except s.timeout:
+                    pass
+                self.flush()
 
     def process_data(self, message):
         """
-        Processes data by uploading to cloud
+        Processes data by writing it to the sinks
 
         Parameters
         ----------
         message : bytes
         """
-        link = 'https://api.thingspeak.com/channels/{}/feeds.json?'.format(
-            c.AIR_QUALITY_FEED)
-        fields = {}
-        key = c.AIR_QUALITY_WRITE_KEY
-
         # Retrieve dict from message
         message_dict = eval(message.decode())
         type_data = message_dict.get('type', None)
@@ -88,37 +725,95 @@ class DataPoller:
             logging.error('Unrecognized message. Ignoring')
             return
 
-        # Assembly humidity record
+        # Forget devices that stopped sending
+        self.__states.evict_idle()
+
+        # Process humidity record
         if type_data == 'humidity':
-            self.humidity_processing(value_data, address, id_data)
-            fields = {c.NODE_FIELD: id_data,
-                      c.LOCATION_FIELD: location_data,
-                      c.HUMIDITY_FIELD: value_data}
+            self.humidity_processing(value_data, address, id_data,
+                                     location_data)
 
-        # Aseembly co2 record
+        # Process co2 record
         elif type_data == 'co2':
-            self.co2_processing(value_data, address, id_data)
-            fields = {c.NODE_FIELD: id_data,
-                      c.LOCATION_FIELD: location_data,
-                      c.CO2_FIELD: value_data}
+            self.co2_processing(value_data, address, id_data, location_data)
 
         # Unrecognized type, ignore
         else:
             logging.error('Unrecognized message. Ignoring')
             return
 
-        # Data received that should be recorded in the cloud
-        logging.debug('Writing to cloud')
-        status, reason = write_to_channel(key, fields)
+        # Summarized sinks get window summaries, unless the reading
+        # crosses an alert threshold
+        crossed = True
+        if self.__aggregator is not None:
+            crossed = self.__aggregator.add(id_data, location_data,
+                                            type_data, value_data)
+            if crossed:
+                logging.debug('Threshold crossed, writing reading now')
 
-        # Check status
-        if status == c.GOOD_STATUS:
-            logging.debug('Write to cloud was succesful')
-            logging.debug('View results here {}'.format(link))
-        else:
-            logging.error('Write to cloud was unsuccessful: {}'.format(reason))
+        self.write({'id': id_data,
+                    'location': location_data,
+                    'type': type_data,
+                    'value': value_data,
+                    'time': time.time()}, summarized=crossed)
+
+    def flush(self, force=False):
+        """
+        Write the summaries of closed aggregation windows & flush sinks,
+        at most once every FLUSH_SECS
+
+        Parameters
+        ----------
+        force : bool
+            Close every window & write every buffered record now
+        """
+        # Flushing walks every window, don't pay that per datagram
+        now = time.monotonic()
+        if not force and now < self.__next_flush:
+            return
+        self.__next_flush = now + FLUSH_SECS
+
+        if self.__aggregator is not None:
+            for summary in self.__aggregator.flush(force):
+                logging.debug('Writing {}'.format(summary))
+                self.write({'id': summary.id,
+                            'location': summary.location,
+                            'type': summary.type,
+                            'value': round(summary.mean, 2),
+                            'minimum': summary.minimum,
+                            'maximum': summary.maximum,
+                            'count': summary.count,
+                            'time': time.time()}, raw=False)
+
+        for sink in self.__sinks:
+            sink.flush(force)
 
-    def humidity_processing(self, value, address, id_data):
+    def write(self, record, raw=True, summarized=True):
+        """
+        Write a record to the sinks
+
+        Parameters
+        ----------
+        record : dict
+        raw : bool
+            Write to sinks that get every reading
+        summarized : bool
+            Write to sinks that get window summaries
+        """
+        for sink in self.__sinks:
+            if sink.summarized and self.__aggregator is not None:
+                wanted = summarized
+            else:
+                wanted = raw
+            if not wanted:
+                continue
+            try:
+                sink.write(record)
+            except Exception as e:
+                logging.error('{} failed to write record: {}'.format(
+                    type(sink).__name__, e))
+
+    def humidity_processing(self, value, address, id_data, location=None):
         """
         Further process humidity data
 
@@ -127,40 +822,44 @@ class DataPoller:
         value : float
         address : tuple
         id_data : int
+        location : str
         """
+        state = self.__states.get(id_data, location)
         if value < c.HUMIDITY_THRESHOLD:
             logging.info('Low humidity! Alert user')
 
             # Send notification only upon first recognition of warning
-            if not self.__humidity_warning:
-                self.__humidity_warning = True
+            if not state.humidity_warning:
+                self.__states.set_warning(state, 'humidity', True)
+                logging.info('{} device(s) with low humidity at {}'.format(
+                    self.__states.location(state.location).humidity_warnings,
+                    state.location))
 
-                # Send email to defined recipients
+                # Send email to defined recipients & the device's owner
                 sender = c.SENDER
-                recipients = update_recipients_list(self.__recipients, id_data)
                 subject = c.HUMIDITY_SUBJECT
                 content = c.HUMIDITY_CONTENT.format(humidity=value)
                 logging.debug('Sending Humidity warning email to user')
-                iot_email.send_email(sender, recipients, subject, content)
+                self.__dispatcher.submit(sender, self.__recipients, subject,
+                                         content, device_id=id_data)
 
                 # If address found in message, send message back
                 if address[0] and address[1]:
                     # Update LED screen
                     logging.debug('Sending Pi a WARNING humidity message')
-                    iot_sender.send_humidity_update(address, 'warning')
+                    self.__status.push_humidity(address, 'warning')
 
         else:
             # Reset warning
-            if self.__humidity_warning or self.__humidity_first:
-                self.__humidity_warning = False
-                self.__humidity_first = False
+            if state.humidity_warning or state.humidity_first:
+                self.__states.set_warning(state, 'humidity', False)
 
                 # If address found in message, send message back
                 if address[0] and address[1]:
                     logging.debug('Sending Pi a SAFE humidity message')
-                    iot_sender.send_humidity_update(address, 'safe')
+                    self.__status.push_humidity(address, 'safe')
 
-    def co2_processing(self, value, address, id_data):
+    def co2_processing(self, value, address, id_data, location=None):
         """
         Further process CO2 data
 
@@ -169,70 +868,247 @@ class DataPoller:
         value : int
         address : tuple
         id_data: int
+        location : str
         """
+        state = self.__states.get(id_data, location)
         if value > c.CO2_THRESHOLD:
             logging.info('High CO2 Concentration level! Alert user')
 
             # Send notification only upon first recognition of warning
-            if not self.__co2_warning:
-                self.__co2_warning = True
+            if not state.co2_warning:
+                self.__states.set_warning(state, 'co2', True)
+                logging.info('{} device(s) with high CO2 at {}'.format(
+                    self.__states.location(state.location).co2_warnings,
+                    state.location))
 
-                # Send email to defined recipients
+                # Send email to defined recipients & the device's owner
                 sender = c.SENDER
-                recipients = update_recipients_list(self.__recipients, id_data)
                 subject = c.CO2_SUBJECT
                 content = c.CO2_CONTENT.format(co2=value)
                 logging.debug('Sending CO2 warning email to user')
-                iot_email.send_email(sender, recipients, subject, content)
+                self.__dispatcher.submit(sender, self.__recipients, subject,
+                                         content, device_id=id_data)
 
                 # If address found in message, send message back
                 if address[0] and address[1]:
                     # Update LED screen
                     logging.debug('Sending Pi a WARNING CO2 message')
-                    iot_sender.send_co2_update(address, 'warning')
-                    self.__co2_warning = True
+                    self.__status.push_co2(address, 'warning')
 
         else:
             # Reset warning
-            if self.__co2_warning or self.__co2_first:
-                self.__co2_warning = False
-                self.__co2_first = False
+            if state.co2_warning or state.co2_first:
+                self.__states.set_warning(state, 'co2', False)
 
                 # If address found in message, send message back
                 if address[0] and address[1]:
                     logging.debug('Sending Pi a SAFE CO2 message')
-                    iot_sender.send_co2_update(address, 'safe')
+                    self.__status.push_co2(address, 'safe')
 
 
-def update_recipients_list(recipient_list, id_data):
+def run_worker(port, address, messages, window_secs=0,
+               sinks=('thingspeak',), coalesce_secs=0, shard=(0, 1),
+               outbox_file=OUTBOX_FILE):
     """
-    Check whether this device has a notification email address associated
-    If so, append to the list of.
+    Process datagrams handed over by the supervisor
 
-    :param recipient_list: current list of recipients
-    :param id_data: 48-bit mac address
-    :return: updated recipients list
+    Parameters
+    ----------
+    port : int
+    address : list
+    messages : multiprocessing.Queue
+    window_secs : float
+    sinks : list
+        Names of the sinks to create in the worker
+    coalesce_secs : float
+        Coalescing window of the ThingSpeak sink
+    shard : tuple
+        (index, count) of the worker, picks its share of the channels
+    outbox_file : str
+        Outbox DB file, each worker keeps its own
+    """
+    channels = ChannelPool().shard(*shard)
+    poller = DataPoller(port, address, window_secs,
+                        create_sinks(sinks, coalesce_secs, channels,
+                                     outbox_file))
+    while True:
+        try:
+            message = messages.get(timeout=FLUSH_SECS)
+            poller.process_data(message)
+        except queue.Empty:
+            pass
+        except Exception as e:
+            logging.error('Failed to process message: {}'.format(e))
+        poller.flush()
+
+
+class WorkerPool:
+    """
+    Spreads received datagrams across DataPoller worker processes
+
+    Datagrams are routed by device id, so each worker owns the alert
+    state of its share of devices, and writes to its own share of the
+    ThingSpeak channels. Workers that die are restarted.
+    """
+
+    def __init__(self, port, address, workers, window_secs=0,
+                 sinks=('thingspeak',), coalesce_secs=0,
+                 outbox_file=OUTBOX_FILE):
+        """
+        Parameters
+        ----------
+        port : int
+        address : list
+        workers : int
+            Number of worker processes
+        window_secs : float
+            Aggregation window of each worker, 0 to upload every reading
+        sinks : list
+            Names of the sinks each worker writes to
+        coalesce_secs : float
+            Coalescing window of each worker's ThingSpeak sink
+        outbox_file : str
+            Outbox DB file, suffixed with each worker's index
+        """
+        self.__port = port
+        self.__address = address
+        self.__window_secs = window_secs
+        self.__sinks = sinks
+        self.__coalesce_secs = coalesce_secs
+        self.__outbox_file = outbox_file
+        self.__queues = [multiprocessing.Queue(WORKER_QUEUE_SIZE)
+                         for _ in range(workers)]
+        self.__workers = [None] * workers
+
+    def __start(self, index):
+        """
+        Start (or restart) a worker process
+
+        Parameters
+        ----------
+        index : int
+        """
+        base, ext = os.path.splitext(self.__outbox_file)
+        outbox_file = '{}-{}{}'.format(base, index, ext)
+        worker = multiprocessing.Process(
+            target=run_worker,
+            args=(self.__port, self.__address, self.__queues[index],
+                  self.__window_secs, self.__sinks, self.__coalesce_secs,
+                  (index, len(self.__workers)), outbox_file),
+            name='worker-{}'.format(index),
+            daemon=True)
+        worker.start()
+        self.__workers[index] = worker
+        logging.info('Started worker {} (pid {})'.format(index, worker.pid))
+
+    def __supervise(self):
+        """
+        Restart workers that died
+        """
+        for index, worker in enumerate(self.__workers):
+            if not worker.is_alive():
+                logging.error('Worker {} exited with {}, restarting'.format(
+                    index, worker.exitcode))
+                # A worker killed inside get() leaves the queue locked,
+                # its backlog is dropped with it
+                self.__queues[index] = multiprocessing.Queue(
+                    WORKER_QUEUE_SIZE)
+                self.__start(index)
+
+    def __route(self, message):
+        """
+        Pick the worker owning the device that sent a datagram
+
+        Parameters
+        ----------
+        message : bytes
+
+        Returns
+        -------
+        int
+            Index of the worker
+        """
+        try:
+            id_data = json.loads(message.decode()).get('id')
+        except (ValueError, AttributeError):
+            id_data = message
+        return hash(id_data) % len(self.__workers)
+
+    def poll_data(self):
+        """
+        Waits to receive data from network & hands it to workers
+        """
+        for index in range(len(self.__workers)):
+            self.__start(index)
+
+        with s.socket(s.AF_INET, s.SOCK_DGRAM) as sock:
+            sock.bind(('', self.__port))
+            sock.settimeout(SUPERVISE_SECS)
+            last_check = time.monotonic()
+            while True:
+                try:
+                    message, address = sock.recvfrom(1024)
+                    logging.debug('Received: {}'.format(message))
+                    index = self.__route(message)
+                    try:
+                        self.__queues[index].put_nowait(message)
+                    except queue.Full:
+                        logging.warning('Worker {} is behind, dropping message'.format(index))
+                except s.timeout:
+                    pass
+
+                if time.monotonic() - last_check >= SUPERVISE_SECS:
+                    self.__supervise()
+                    last_check = time.monotonic()
+
+
+def retrieve_email(id_data):
     """
+    Retrieve the notification email of a single device
 
+    :param id_data: 48-bit mac address
+    :return: email address, empty if unregistered or lookup failed
+    """
     email_sock = s.socket(s.AF_INET, s.SOCK_DGRAM)
     email_sock.settimeout(1)
     request = json.dumps({'type': 'retrieve', 'device_id': id_data})
     email_address = ""
     try:
-        email_sock.sendto(bytes(request, 'utf-8'), (c.DEVICE_MANAGER, 3210))
-        reply, _ = email_sock.recvfrom(1024)
+        email_sock.sendto(bytes(request, 'utf-8'), (c.DEVICE_MANAGER, c.DEVICE_MANAGER_PORT))
+        reply, _ = email_sock.recvfrom(c.MAX_DATAGRAM)
         reply_json = json.loads(reply)
-        email_address = reply_json['email']
+        if 'error' in reply_json:
+            logging.error(f'Failed to retrieve email for {id_data}. E:{reply_json["error"]}')
+        email_address = reply_json.get('email', '')
     except (s.gaierror, s.timeout) as e:
         logging.error(f'Failed to retrieve email for {id_data}. E:{str(e)}')
     finally:
         email_sock.close()
 
-    if len(email_address) != 0:
+    return email_address
+
+
+def update_recipients_list(recipient_list, id_data, lookup=None):
+    """
+    Check whether this device has a notification email address associated
+    If so, append to the list of.
+
+    :param recipient_list: current list of recipients
+    :param id_data: 48-bit mac address
+    :param lookup: EmailLookup or EmailCache, None for a single request
+    :return: updated recipients list
+    """
+    if lookup:
+        email_address = lookup.lookup(id_data)
+    else:
+        email_address = retrieve_email(id_data)
+
+    if email_address:
         if not recipient_list:
             recipient_list = [email_address]
         else:
-            recipient_list.append(email_address)
+            # Copy so one device's email is not kept for other devices
+            recipient_list = recipient_list + [email_address]
 
     return recipient_list
 
@@ -263,6 +1139,43 @@ def parse_args():
                         nargs='*',
                         help='Email address(es) to receive notifications')
 
+    parser.add_argument('-w',
+                        '--workers',
+                        metavar='<workers>',
+                        default=1,
+                        type=int,
+                        help='Worker processes, split by device. Default: 1')
+
+    parser.add_argument('--window',
+                        metavar='<seconds>',
+                        default=0,
+                        type=float,
+                        help='Upload per-device window summaries & threshold '
+                             'crossings instead of every reading. Default: 0')
+
+    parser.add_argument('-s',
+                        '--sink',
+                        choices=sorted(SINKS),
+                        nargs='+',
+                        default=['thingspeak'],
+                        help='Where readings are written. sqlite writes to '
+                             'the local humidity & CO2 DBs directly. '
+                             'Default: thingspeak')
+
+    parser.add_argument('--coalesce',
+                        metavar='<seconds>',
+                        default=0,
+                        type=float,
+                        help='Merge a device\'s humidity & CO2 readings '
+                             'within this window into one cloud write. '
+                             'Default: 0')
+
+    parser.add_argument('--outbox',
+                        metavar='<db_file>',
+                        default=OUTBOX_FILE,
+                        help='DB file of pending cloud uploads. '
+                             'Default: {}'.format(OUTBOX_FILE))
+
     args = parser.parse_args()
     return args
 
@@ -279,5 +1192,12 @@ if __name__ == '__main__':
     if args.address:
         recipients = args.address
 
-    poller = DataPoller(args.port, args.address)
+    if args.workers > 1:
+        poller = WorkerPool(args.port, args.address, args.workers,
+                            args.window, args.sink, args.coalesce,
+                            args.outbox)
+    else:
+        poller = DataPoller(args.port, args.address, args.window,
+                            create_sinks(args.sink, args.coalesce,
+                                         outbox_file=args.outbox))
     poller.poll_data()
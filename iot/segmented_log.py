@@ -0,0 +1,625 @@
+"""
+segmented_log.py
+
+Append-only log split into rotating segments with a disk cap
+
+Each closed segment gets a sparse index <segment>.idx: its time range, a
+bloom filter of the keys appended & the offset of a record every
+INDEX_INTERVAL_BYTES, so readers can skip segments & seek within them.
+
+Notes
+-----
+- Docstrings follow the numpydoc style:
+  https://numpydoc.readthedocs.io/en/latest/format.html
+- Code follows the PEP 8 style guide:
+  https://www.python.org/dev/peps/pep-0008/
+"""
+import gzip
+import hashlib
+import io
+import json
+import logging
+import math
+import mmap
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+SEGMENT_SECS = 3600
+FLUSH_SECS = 1
+MAX_DISK_BYTES = 4 * 1024 * 1024 * 1024
+WRITE_BUFFER_BYTES = 1024 * 1024
+COPY_CHUNK_BYTES = 1024 * 1024
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+FSYNC_POLICIES = ('never', 'rotate', 'flush')
+INDEX_SUFFIX = '.idx'
+INDEX_INTERVAL_BYTES = 64 * 1024
+BLOOM_BITS = 8192
+BLOOM_HASHES = 4
+# About 1% false positives whatever the number of keys
+BLOOM_BITS_PER_KEY = 10
+BLOOM_MIN_BITS = 64
+
+
+def index_path(segment_path):
+    """
+    Parameters
+    ----------
+    segment_path : str
+        Segment, compressed or not
+
+    Returns
+    -------
+    str
+        Path of the segment's index
+    """
+    for extension in COMPRESSIONS.values():
+        if extension and segment_path.endswith(extension):
+            segment_path = segment_path[:-len(extension)]
+    return segment_path + INDEX_SUFFIX
+
+
+def compress_file(path, compression):
+    """
+    Compress a file next to itself & remove the original
+
+    Parameters
+    ----------
+    path : str
+    compression : str
+        'gzip' or 'zstd'
+
+    Returns
+    -------
+    str
+        Path of the compressed file
+    """
+    target = path + COMPRESSIONS[compression]
+    with open(path, 'rb') as src, open(target + '.tmp', 'wb') as dst:
+        if compression == 'zstd':
+            compressor = zstandard.ZstdCompressor()
+            compressor.copy_stream(src, dst)
+        else:
+            with gzip.GzipFile(fileobj=dst, mode='wb') as gz:
+                shutil.copyfileobj(src, gz, COPY_CHUNK_BYTES)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(target + '.tmp', target)
+    os.remove(path)
+    return target
+
+
+def list_segments(path):
+    """
+    Segments of a log on disk, oldest first
+
+    Parameters
+    ----------
+    path : str
+        Base path of the segments
+
+    Returns
+    -------
+    list
+        (seq, path, compressed) of each segment
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    pattern = re.compile(r'^{}\.(\d+)(\.gz|\.zst)?$'.format(
+        re.escape(os.path.basename(path))))
+    segments = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            segments.append((int(match.group(1)),
+                             os.path.join(directory, name),
+                             match.group(2) is not None))
+    segments.sort()
+    return segments
+
+
+def iter_records(segment_path, offset=0):
+    """
+    Lines of a segment, from an offset of its uncompressed data
+
+    Uncompressed segments are memory-mapped, compressed ones are
+    decompressed as they're read.
+
+    Parameters
+    ----------
+    segment_path : str
+    offset : int
+        Start of a record, e.g. from SegmentIndex.seek
+
+    Yields
+    ------
+    bytes
+        One record, with its newline
+    """
+    if segment_path.endswith(COMPRESSIONS['gzip']) or \
+            segment_path.endswith(COMPRESSIONS['zstd']):
+        with open(segment_path, 'rb') as f:
+            if segment_path.endswith(COMPRESSIONS['gzip']):
+                reader = gzip.GzipFile(fileobj=f)
+                reader.seek(offset)
+            else:
+                if zstandard is None:
+                    raise Exception('Reading zstd segments requires '
+                                    'zstandard!')
+                reader = io.BufferedReader(
+                    zstandard.ZstdDecompressor().stream_reader(f))
+                while offset > 0:
+                    skipped = len(reader.read(min(offset, COPY_CHUNK_BYTES)))
+                    if not skipped:
+                        return
+                    offset -= skipped
+            with reader:
+                for line in reader:
+                    yield line
+        return
+
+    with open(segment_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            position = offset
+            size = len(mapped)
+            while position < size:
+                end = mapped.find(b'\n', position)
+                end = size if end == -1 else end + 1
+                yield mapped[position:end]
+                position = end
+
+
+class BloomFilter:
+    """
+    Set membership with false positives but no false negatives
+    """
+
+    def __init__(self, bits=BLOOM_BITS, hashes=BLOOM_HASHES, data=None):
+        """
+        Parameters
+        ----------
+        bits : int
+        hashes : int
+            Bits set per key
+        data : bytes
+            Bits of a saved filter
+        """
+        self.__bits = bits
+        self.__hashes = hashes
+        self.__data = bytearray(data) if data else bytearray(bits // 8)
+
+    @classmethod
+    def sized(cls, count, bits_per_key=BLOOM_BITS_PER_KEY):
+        """
+        Empty filter sized for a number of distinct keys
+
+        Parameters
+        ----------
+        count : int
+            Keys that will be added
+        bits_per_key : int
+
+        Returns
+        -------
+        BloomFilter
+        """
+        bits = max(BLOOM_MIN_BITS, -(-count * bits_per_key // 8) * 8)
+        hashes = max(1, round(bits_per_key * math.log(2)))
+        return cls(bits, hashes)
+
+    @property
+    def bits(self):
+        """
+        int : Size of the filter
+        """
+        return self.__bits
+
+    @property
+    def hashes(self):
+        """
+        int : Bits set per key
+        """
+        return self.__hashes
+
+    @property
+    def data(self):
+        """
+        bytes : Bits of the filter
+        """
+        return bytes(self.__data)
+
+    def add(self, key):
+        """
+        Parameters
+        ----------
+        key : bytes
+        """
+        for bit in self.__positions(key):
+            self.__data[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, key):
+        return all(self.__data[bit >> 3] & (1 << (bit & 7))
+                   for bit in self.__positions(key))
+
+    def __positions(self, key):
+        """
+        Bits of a key, by double hashing one digest
+
+        Parameters
+        ----------
+        key : bytes
+
+        Returns
+        -------
+        generator
+        """
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.__bits
+                for i in range(self.__hashes))
+
+
+class SegmentIndex:
+    """
+    Sparse index of a segment
+    """
+
+    def __init__(self, interval_bytes=INDEX_INTERVAL_BYTES):
+        """
+        Parameters
+        ----------
+        interval_bytes : int
+            Bytes between indexed offsets
+        """
+        self.interval_bytes = interval_bytes
+        self.first_time = None
+        self.last_time = None
+        self.count = 0
+        # Built once the segment is closed & its distinct keys are known
+        self.keys = None
+        self.__key_set = set()
+        # (timestamp, offset) of a record every interval_bytes
+        self.offsets = []
+        self.__next_offset = 0
+
+    def add(self, offset, key=None, timestamp=None):
+        """
+        Index a record
+
+        Parameters
+        ----------
+        offset : int
+            Where the record starts in the segment
+        key : bytes
+        timestamp : float
+        """
+        self.count += 1
+        if key is not None:
+            self.__key_set.add(key)
+        if timestamp is None:
+            return
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+        if offset >= self.__next_offset:
+            self.offsets.append((timestamp, offset))
+            self.__next_offset = offset + self.interval_bytes
+
+    def overlaps(self, start=None, end=None):
+        """
+        Parameters
+        ----------
+        start : float
+        end : float
+
+        Returns
+        -------
+        bool
+            True if the segment may hold records within the time range
+        """
+        if self.first_time is None:
+            return True
+        return (start is None or self.last_time >= start) and \
+            (end is None or self.first_time <= end)
+
+    def seek(self, start=None):
+        """
+        Parameters
+        ----------
+        start : float
+
+        Returns
+        -------
+        int
+            Offset of the last indexed record before start
+        """
+        offset = 0
+        if start is not None:
+            for timestamp, indexed in self.offsets:
+                if timestamp >= start:
+                    break
+                offset = indexed
+        return offset
+
+    def seal(self):
+        """
+        Build the bloom filter of the keys added, sized for their number
+        """
+        self.keys = BloomFilter.sized(len(self.__key_set))
+        for key in self.__key_set:
+            self.keys.add(key)
+        self.__key_set = set()
+
+    def save(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+        """
+        if self.keys is None:
+            self.seal()
+        index = {'first_time': self.first_time,
+                 'last_time': self.last_time,
+                 'count': self.count,
+                 'bloom_bits': self.keys.bits,
+                 'bloom_hashes': self.keys.hashes,
+                 'bloom': self.keys.data.hex(),
+                 'offsets': self.offsets}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Parameters
+        ----------
+        path : str
+
+        Returns
+        -------
+        SegmentIndex
+        """
+        with open(path) as f:
+            saved = json.load(f)
+        index = cls()
+        index.first_time = saved['first_time']
+        index.last_time = saved['last_time']
+        index.count = saved['count']
+        index.keys = BloomFilter(saved['bloom_bits'], saved['bloom_hashes'],
+                                 bytes.fromhex(saved['bloom']))
+        index.offsets = [tuple(o) for o in saved['offsets']]
+        return index
+
+
+class SegmentedLog:
+    """
+    Log written to numbered segment files <path>.<seq>
+
+    The active segment is rotated once it's too big or too old. Closed
+    segments are compressed in the background & the oldest segments are
+    deleted while the log is over its disk cap.
+    """
+
+    def __init__(self, path, segment_bytes=SEGMENT_BYTES,
+                 segment_secs=SEGMENT_SECS, compression='gzip',
+                 flush_secs=FLUSH_SECS, fsync='rotate',
+                 max_disk_bytes=MAX_DISK_BYTES):
+        """
+        Parameters
+        ----------
+        path : str
+            Base path of the segments
+        segment_bytes : int
+            Rotate once the active segment reaches this size
+        segment_secs : float
+            Rotate once the active segment is this old, 0 for no limit
+        compression : str
+            'none', 'gzip' or 'zstd' for closed segments
+        flush_secs : float
+            Longest time written data stays in the process' buffer,
+            0 to flush every write
+        fsync : str
+            'never', 'rotate' (closed segments) or 'flush' (every flush)
+        max_disk_bytes : int
+            Disk cap of all segments, 0 for no cap
+
+        Raises
+        ------
+        Exception
+            Invalid compression or fsync policy
+        """
+        if compression not in COMPRESSIONS:
+            raise Exception('Invalid compression!')
+        if compression == 'zstd' and zstandard is None:
+            raise Exception('zstd compression requires zstandard!')
+        if fsync not in FSYNC_POLICIES:
+            raise Exception('Invalid fsync policy!')
+
+        self.__path = path
+        self.__segment_bytes = segment_bytes
+        self.__segment_secs = segment_secs
+        self.__compression = compression
+        self.__flush_secs = flush_secs
+        self.__fsync = fsync
+        self.__max_disk_bytes = max_disk_bytes
+
+        self.__file = None
+        self.__index = None
+        self.__size = 0
+        self.__opened = 0
+        self.__flushed = 0
+        self.__lock = threading.Lock()
+        self.__closed = queue.Queue()
+        self.__compressor = threading.Thread(target=self.__compress_loop,
+                                             daemon=True)
+        self.__compressor.start()
+
+        # Segments left uncompressed by a previous run
+        segments = self.segments()
+        self.__seq = segments[-1][0] if segments else 0
+        for _, path, compressed in segments:
+            if not compressed:
+                self.__closed.put(path)
+        self.__open_segment()
+
+    def segments(self):
+        """
+        Segments on disk, oldest first
+
+        Returns
+        -------
+        list
+            (seq, path, compressed) of each segment
+        """
+        return list_segments(self.__path)
+
+    def append(self, data, key=None, timestamp=None):
+        """
+        Append to the active segment
+
+        Parameters
+        ----------
+        data : bytes
+            One record
+        key : bytes
+            Indexed in the segment's bloom filter
+        timestamp : float
+            Time of the record, records must be appended in time order
+        """
+        with self.__lock:
+            self.__index.add(self.__size, key, timestamp)
+            self.__file.write(data)
+            self.__size += len(data)
+            if self.__size >= self.__segment_bytes or self.__too_old():
+                self.__rotate()
+            else:
+                self.__maybe_flush()
+
+    def tick(self):
+        """
+        Apply the flush & age limits while no data is appended
+        """
+        with self.__lock:
+            if self.__size and self.__too_old():
+                self.__rotate()
+            else:
+                self.__maybe_flush()
+
+    def close(self):
+        """
+        Close the active segment & wait for pending compressions
+        """
+        with self.__lock:
+            self.__close_segment()
+        self.__closed.put(None)
+        self.__compressor.join()
+
+    def __too_old(self):
+        """
+        Returns
+        -------
+        bool
+            True if the active segment has been open for segment_secs
+        """
+        return bool(self.__segment_secs) and \
+            time.monotonic() - self.__opened >= self.__segment_secs
+
+    def __maybe_flush(self):
+        """
+        Flush the buffer if it's been held for flush_secs
+        """
+        now = time.monotonic()
+        if now - self.__flushed >= self.__flush_secs:
+            self.__file.flush()
+            if self.__fsync == 'flush':
+                os.fsync(self.__file.fileno())
+            self.__flushed = now
+
+    def __open_segment(self):
+        """
+        Start a new active segment
+        """
+        self.__seq += 1
+        path = '{}.{:08d}'.format(self.__path, self.__seq)
+        self.__file = open(path, 'ab', buffering=WRITE_BUFFER_BYTES)
+        self.__size = self.__file.tell()
+        self.__opened = time.monotonic()
+        self.__flushed = self.__opened
+        self.__index = SegmentIndex()
+        logging.debug('Opened segment {}'.format(path))
+
+    def __close_segment(self):
+        """
+        Close the active segment & queue it for compression
+        """
+        self.__file.flush()
+        if self.__fsync != 'never':
+            os.fsync(self.__file.fileno())
+        self.__file.close()
+        if self.__index.count:
+            self.__index.seal()
+            self.__index.save(index_path(self.__file.name))
+        self.__closed.put(self.__file.name)
+
+    def __rotate(self):
+        """
+        Replace the active segment with a new one
+        """
+        self.__close_segment()
+        self.__open_segment()
+
+    def __compress_loop(self):
+        """
+        Compress closed segments & enforce the disk cap, off the write
+        path
+        """
+        while True:
+            path = self.__closed.get()
+            if path is None:
+                return
+            if not os.path.exists(path):
+                # Already deleted to stay under the disk cap
+                continue
+            try:
+                if self.__compression != 'none':
+                    path = compress_file(path, self.__compression)
+                    logging.debug('Compressed segment {}'.format(path))
+                self.__enforce_cap()
+            except Exception as e:
+                logging.error('Failed to compress segment {}: {}'.format(
+                    path, e))
+
+    def __enforce_cap(self):
+        """
+        Delete the oldest closed segments while over the disk cap
+        """
+        if not self.__max_disk_bytes:
+            return
+
+        segments = self.segments()
+        sizes = [os.path.getsize(path) for _, path, _ in segments]
+        total = sum(sizes)
+        with self.__lock:
+            active = self.__seq
+
+        for (seq, path, _), size in zip(segments, sizes):
+            if total <= self.__max_disk_bytes or seq == active:
+                break
+            os.remove(path)
+            if os.path.exists(index_path(path)):
+                os.remove(index_path(path))
+            total -= size
+            logging.info('Deleted segment {} to stay under the disk '
+                         'cap'.format(path))
@@ -14,11 +14,74 @@ Notes
 import abc
 import sqlite3
 import logging
+from array import array
 import constants as c
 
 FIRST_ROW = 0
 SINGLE_RECORD = 1
 
+# SQL expression for each supported aggregation (value column substituted)
+AGGREGATES = {'avg': 'avg({field})',
+              'min': 'min({field})',
+              'max': 'max({field})',
+              'count': 'count({field})',
+              'percentile': 'percentile({field}, ?)'}
+GROUPINGS = ('id', 'location')
+# Columns added after the first release, nullable so old rows stay valid
+TIME_COLUMNS = (('timestamp', 'integer'), ('utc_offset', 'integer'))
+# Epoch secs of a record, date & time are wall-clock time in the channel
+# timezone so they are only read as UTC for rows saved without either column
+WALL_CLOCK_SQL = "CAST(strftime('%s', date || ' ' || time) AS INTEGER)"
+TIMESTAMP_SQL = "COALESCE(timestamp / 1000, {0} - utc_offset * 60, {0})" \
+    .format(WALL_CLOCK_SQL)
+
+
+class Percentile:
+    """
+    Custom SQLite aggregate computing a percentile of a column
+
+    Registered on every connection as percentile(value, rank), where rank
+    is in the range [0, 100]. Linear interpolation is used between the
+    closest ranks.
+    """
+
+    def __init__(self):
+        self.__values = []
+        self.__rank = None
+
+    def step(self, value, rank):
+        """
+        Add a value to the aggregate
+
+        Parameters
+        ----------
+        value : float
+        rank : float
+        """
+        if value is None:
+            return
+        self.__rank = rank
+        self.__values.append(float(value))
+
+    def finalize(self):
+        """
+        Compute the percentile of all values stepped so far
+
+        Returns
+        -------
+        float
+            None if no values were aggregated
+        """
+        if not self.__values:
+            return None
+
+        values = sorted(self.__values)
+        position = (len(values) - 1) * min(max(self.__rank, 0), 100) / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        fraction = position - lower
+        return values[lower] + (values[upper] - values[lower]) * fraction
+
 
 class SqliteDB(metaclass=abc.ABCMeta):
     """"
@@ -30,6 +93,8 @@ class SqliteDB(metaclass=abc.ABCMeta):
         file name of sqlite DB file
     _name : str
         name of DB
+    _field : str
+        name of the measurement column, set by subclasses
     _dbconnect : Connection
         sqlite connection object
     _cursor : Cursor
@@ -45,12 +110,22 @@ class SqliteDB(metaclass=abc.ABCMeta):
         Check if table exists
     create_table()
         Abstract method to create table
+    upgrade_table()
+        Add columns missing from tables made by older versions
     add_record(record)
         Abstract method to add record
+    add_records(records)
+        Add many records in the current transaction
+    create_time_index()
+        Index the table by date & time
+    record_keys(start, end)
+        Records within a time range
     record_exists(record)
         Abstract method to check if record exists
     get_records()
         Abstract method to get records
+    aggregate(function, group_by, bucket_secs, rank, start, end)
+        Aggregate the measurement column inside SQLite
     """
 
     def __init__(self, db_file, name):
@@ -66,6 +141,7 @@ class SqliteDB(metaclass=abc.ABCMeta):
         """
         self._db_file = db_file
         self._name = name
+        self._field = None
         self._dbconnect = None
         self._cursor = None
 
@@ -82,7 +158,8 @@ class SqliteDB(metaclass=abc.ABCMeta):
 
     def __exit__(self, exception, value, trace):
         """
-        DB context manager exit
+        DB context manager exit, the transaction is rolled back if the
+        block raised
 
         Parameters
         ----------
@@ -90,6 +167,8 @@ class SqliteDB(metaclass=abc.ABCMeta):
         value
         trace : traceback
         """
+        if exception is not None:
+            self._dbconnect.rollback()
         self.manual_exit()
 
     def manual_enter(self):
@@ -99,9 +178,15 @@ class SqliteDB(metaclass=abc.ABCMeta):
         """
         self._dbconnect = sqlite3.connect(self._db_file)
 
+        # Readers don't block the writers (workers, sinks & cloud_reader.py)
+        self._dbconnect.execute('PRAGMA journal_mode=WAL')
+
         # Set row_factory to access columns by name
         self._dbconnect.row_factory = sqlite3.Row
 
+        # Register custom aggregates used by aggregate()
+        self._dbconnect.create_aggregate('percentile', 2, Percentile)
+
         # Create a cursor to work with the db
         self._cursor = self._dbconnect.cursor()
 
@@ -110,10 +195,12 @@ class SqliteDB(metaclass=abc.ABCMeta):
         Performs steps in exit
         Available for manual use as per Facade pattern
         """
-        self._dbconnect.commit()
-        self._dbconnect.close()
-        self._dbconnect = None
-        self._cursor = None
+        try:
+            self._dbconnect.commit()
+        finally:
+            self._dbconnect.close()
+            self._dbconnect = None
+            self._cursor = None
 
     def table_exists(self):
         """
@@ -136,6 +223,184 @@ class SqliteDB(metaclass=abc.ABCMeta):
         logging.debug('Table exists? : {}'.format(table_exists))
         return table_exists
 
+    def upgrade_table(self):
+        """
+        Add the timestamp & utc_offset columns to a table created before
+        they existed
+
+        Raises
+        ------
+        Exception
+            Invalid use of SqliteDB context manager
+        """
+        if not self._dbconnect or not self._cursor:
+            raise Exception('Invalid call to Context Manager method!')
+
+        self._cursor.execute("PRAGMA table_info({})".format(self._name))
+        columns = {row['name'] for row in self._cursor.fetchall()}
+        for column, column_type in TIME_COLUMNS:
+            if column not in columns:
+                logging.info('Adding column {} to {}'.format(column,
+                                                             self._name))
+                self._cursor.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    self._name, column, column_type))
+
+    def aggregate(self, function, group_by=('id',), bucket_secs=None,
+                  rank=None, start=None, end=None):
+        """
+        Aggregate the measurement column without pulling rows into Python
+
+        The whole computation is pushed down to SQLite, only one row per
+        group is returned. Results are columnar: one list per grouping
+        column plus compact arrays for the time buckets & values.
+
+        Parameters
+        ----------
+        function : str
+            One of 'avg', 'min', 'max', 'count' or 'percentile'
+        group_by : tuple
+            Columns to group by, any of 'id' & 'location'
+        bucket_secs : int
+            Width of time buckets in seconds, None for no time grouping
+        rank : float
+            Percentile rank in [0, 100], required for 'percentile'
+        start : str
+            Inclusive lower bound as 'YYYY-MM-DD HH:MM:SS', in the
+            wall-clock time the records were saved with
+        end : str
+            Exclusive upper bound as 'YYYY-MM-DD HH:MM:SS', same as start
+
+        Returns
+        -------
+        result : dict
+            Maps each group_by column to a list, 'bucket' to an
+            array of bucket start times (epoch secs, UTC) if bucket_secs
+            is given and 'value' to an array of aggregated values.
+            Buckets come from the timestamp column, rows saved without a
+            timestamp or utc_offset are bucketed by their wall-clock time
+            read as UTC. Tables older than these columns need
+            upgrade_table() first
+
+        Raises
+        ------
+        Exception
+            Invalid use of SqliteDB context manager
+        Exception
+            Invalid aggregation arguments
+        """
+        logging.debug('Aggregating {} of table'.format(function))
+        if not self._dbconnect or not self._cursor:
+            raise Exception('Invalid call to Context Manager method!')
+
+        if function not in AGGREGATES:
+            raise Exception('Invalid aggregate function!')
+        if any(g not in GROUPINGS for g in group_by):
+            raise Exception('Invalid aggregate grouping!')
+        if function == 'percentile' and rank is None:
+            raise Exception('Percentile rank is required!')
+
+        columns = list(group_by)
+        params = []
+        if bucket_secs:
+            columns.append('{ts} / {b} * {b} AS bucket'.format(
+                ts=TIMESTAMP_SQL, b=int(bucket_secs)))
+
+        select = columns + [AGGREGATES[function].format(field=self._field)]
+        if function == 'percentile':
+            params.append(rank)
+
+        # Compared as (date, time) so the date index is used
+        conditions = []
+        if start:
+            conditions.append('(date, time) >= (?, ?)')
+            params.extend(start.split(' '))
+        if end:
+            conditions.append('(date, time) < (?, ?)')
+            params.extend(end.split(' '))
+        if conditions:
+            self.create_time_index()
+
+        query = 'SELECT {} FROM {}'.format(', '.join(select), self._name)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        keys = list(group_by) + (['bucket'] if bucket_secs else [])
+        if keys:
+            query += ' GROUP BY {0} ORDER BY {0}'.format(', '.join(keys))
+
+        self._cursor.execute(query, params)
+
+        result = {g: [] for g in group_by}
+        if bucket_secs:
+            result['bucket'] = array('q')
+        result['value'] = array('d')
+
+        for row in self._cursor.fetchall():
+            for i, key in enumerate(keys):
+                result[key].append(row[i])
+            value = row[len(keys)]
+            result['value'].append(float('nan') if value is None else value)
+
+        return result
+
+    def add_records(self, records):
+        """
+        Add many records, committed together on context manager exit
+
+        Parameters
+        ----------
+        records : list
+            Entries to add to DB
+        """
+        logging.debug('Adding {} entries to table'.format(len(records)))
+        for record in records:
+            self.add_record(record)
+
+    def create_time_index(self):
+        """
+        Index the table by date & time, if it isn't already
+
+        Raises
+        ------
+        Exception
+            Invalid use of SqliteDB context manager
+        """
+        if not self._dbconnect or not self._cursor:
+            raise Exception('Invalid call to Context Manager method!')
+
+        self._cursor.execute(
+            "CREATE INDEX IF NOT EXISTS {0}_date_time "
+            "ON {0} (date, time)".format(self._name))
+
+    def record_keys(self, start, end):
+        """
+        Records within a time range, for checking many records at once
+
+        Parameters
+        ----------
+        start : str
+            Inclusive lower bound as 'YYYY-MM-DD HH:MM:SS'
+        end : str
+            Inclusive upper bound as 'YYYY-MM-DD HH:MM:SS'
+
+        Returns
+        -------
+        set
+            (date, time, id, location, value) of each record
+        """
+        logging.debug('Get records from {} to {}'.format(start, end))
+        if not self._dbconnect or not self._cursor:
+            raise Exception('Invalid call to Context Manager method!')
+
+        # DBs created before the index existed get it on first use
+        self.create_time_index()
+        self._cursor.execute(
+            "SELECT date, time, id, location, {} FROM {} "
+            "WHERE (date, time) BETWEEN (?, ?) AND (?, ?)".format(
+                self._field, self._name),
+            tuple(start.split(' ')) + tuple(end.split(' ')))
+        return set(tuple(row) for row in self._cursor.fetchall())
+
     @abc.abstractmethod
     def create_table(self):
         pass
@@ -182,6 +447,7 @@ class HumidityDB(SqliteDB):
             name of DB table
         """
         super().__init__(db_file, name)
+        self._field = 'humidity'
 
     def create_table(self):
         """
@@ -199,7 +465,9 @@ class HumidityDB(SqliteDB):
         self._cursor.execute(
             "create table {} (date text, \
              time text, id integer, location text, \
-             humidity float)".format(self._name))
+             humidity float, timestamp integer, utc_offset integer)".format(
+                self._name))
+        self.create_time_index()
 
     def add_record(self, record):
         """
@@ -231,8 +499,10 @@ class HumidityDB(SqliteDB):
             raise Exception('Invalid HumidityDB record!')
 
         self._cursor.execute(
-            "insert into {} values(?, ?, ?, ?, ?)".format(self._name),
-            (date, time, id_data, location, humidity))
+            "insert into {} (date, time, id, location, humidity, timestamp, \
+             utc_offset) values(?, ?, ?, ?, ?, ?, ?)".format(self._name),
+            (date, time, id_data, location, humidity, record.get('timestamp'),
+             record.get('utc_offset')))
 
     def record_exists(self, record):
         """
@@ -331,6 +601,7 @@ class Co2DB(SqliteDB):
             name of DB table
         """
         super().__init__(db_file, name)
+        self._field = 'co2'
 
     def create_table(self):
         """
@@ -348,7 +619,9 @@ class Co2DB(SqliteDB):
         self._cursor.execute(
             "create table {} (date text, \
              time text, id integer, location text, \
-             co2 integer)".format(self._name))
+             co2 integer, timestamp integer, utc_offset integer)".format(
+                self._name))
+        self.create_time_index()
 
     def add_record(self, record):
         """
@@ -380,8 +653,10 @@ class Co2DB(SqliteDB):
             raise Exception('Invalid Co2DB record!')
 
         self._cursor.execute(
-            "insert into {} values(?, ?, ?, ?, ?)".format(self._name),
-            (date, time, id_data, location, co2))
+            "insert into {} (date, time, id, location, co2, timestamp, \
+             utc_offset) values(?, ?, ?, ?, ?, ?, ?)".format(self._name),
+            (date, time, id_data, location, co2, record.get('timestamp'),
+             record.get('utc_offset')))
 
     def record_exists(self, record):
         """
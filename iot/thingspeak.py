@@ -13,11 +13,180 @@ Notes
 import http.client
 import urllib
 import requests
+import codecs
+import json
 import logging
+import os
+import re
+import threading
+import time
+import zlib
 import constants as c
+from collections import namedtuple
 
+WRITE_TIMEOUT_SECS = 10
+READ_TIMEOUT_SECS = 60
+STREAM_CHUNK_BYTES = 64 * 1024
+MAX_RESULTS = 8000
+FEEDS_ARRAY = re.compile(r'"feeds"\s*:\s*\[')
 
-def write_to_channel(key, fields):
+# Point at a local stand-in (thingspeak_server.py) with THINGSPEAK_URL
+BASE_URL = os.environ.get('THINGSPEAK_URL', c.THINGSPEAK_URL)
+
+Channel = namedtuple('Channel', ['feed', 'write_key', 'read_key'])
+
+
+class ChannelPool:
+    """
+    Spreads writes across several ThingSpeak channels
+
+    Each device has a home channel. A channel's key may only be written
+    once per interval, so when the home channel's budget is used up the
+    write goes to whichever channel is free.
+    """
+
+    def __init__(self, channels=c.AIR_QUALITY_CHANNELS,
+                 interval=c.THINGSPEAK_WRITE_SECS, start_delay=0):
+        """
+        Parameters
+        ----------
+        channels : list
+            (feed, write key, read key) of each channel
+        interval : float
+            Minimum seconds between writes with the same key
+        start_delay : float
+            Seconds before the first write with each key
+        """
+        if not channels:
+            raise Exception('No ThingSpeak channels!')
+        self.__channels = [Channel(*channel) for channel in channels]
+        self.__interval = interval
+        self.__next_write = [time.monotonic() + start_delay] * \
+            len(self.__channels)
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__channels)
+
+    @property
+    def channels(self):
+        """
+        list : Channels of the pool
+        """
+        return list(self.__channels)
+
+    def home(self, device_id):
+        """
+        Home channel of a device (stable across processes)
+
+        Parameters
+        ----------
+        device_id : int
+
+        Returns
+        -------
+        Channel
+        """
+        return self.__channels[self.__home_index(device_id)]
+
+    def acquire(self, device_id):
+        """
+        Take a write from a channel's budget
+
+        Parameters
+        ----------
+        device_id : int
+
+        Returns
+        -------
+        Channel
+            Channel to write to, None if every channel is rate limited
+        """
+        with self.__lock:
+            now = time.monotonic()
+            index = self.__home_index(device_id)
+            if self.__next_write[index] > now:
+                index = min(range(len(self.__channels)),
+                            key=self.__next_write.__getitem__)
+                if self.__next_write[index] > now:
+                    return None
+            self.__next_write[index] = now + self.__interval
+        return self.__channels[index]
+
+    def __home_index(self, device_id):
+        """
+        Parameters
+        ----------
+        device_id : int
+
+        Returns
+        -------
+        int
+            Index of the device's home channel
+        """
+        return zlib.crc32(str(device_id).encode()) % len(self.__channels)
+
+    def wait_secs(self):
+        """
+        Seconds until a channel can be written again
+
+        Returns
+        -------
+        float
+        """
+        with self.__lock:
+            return max(0.0, min(self.__next_write) - time.monotonic())
+
+    def shard(self, index, count):
+        """
+        Split the channels between processes so budgets aren't shared
+
+        Parameters
+        ----------
+        index : int
+            Index of this process
+        count : int
+            Number of processes
+
+        Returns
+        -------
+        ChannelPool
+            Every count-th channel. When there are fewer channels than
+            processes, the whole pool with each key's budget split
+            between the processes: a write every count intervals, offset
+            by index intervals.
+        """
+        if len(self.__channels) < count:
+            logging.warning('{} channels for {} processes, each process '
+                            'writes a key every {} s'.format(
+                                len(self.__channels), count,
+                                self.__interval * count))
+            return ChannelPool(self.__channels, self.__interval * count,
+                               self.__interval * index)
+        return ChannelPool(self.__channels[index::count], self.__interval)
+
+
+def connect(base_url=None):
+    """
+    Open a connection to the ThingSpeak API
+
+    Parameters
+    ----------
+    base_url : str
+        e.g. https://api.thingspeak.com, BASE_URL by default
+
+    Returns
+    -------
+    http.client.HTTPConnection
+    """
+    url = urllib.parse.urlsplit(base_url or BASE_URL)
+    if url.scheme == 'https':
+        return http.client.HTTPSConnection(url.netloc,
+                                           timeout=WRITE_TIMEOUT_SECS)
+    return http.client.HTTPConnection(url.netloc, timeout=WRITE_TIMEOUT_SECS)
+
+
+def write_to_channel(key, fields, base_url=None):
     """
     Writes to a given ThingSpeak channel
 
@@ -26,6 +195,8 @@ def write_to_channel(key, fields):
     key : str
     fields : dict
         fields to write to ThingSpeak channel
+    base_url : str
+        API to write to, BASE_URL by default
 
     Returns
     -------
@@ -33,21 +204,69 @@ def write_to_channel(key, fields):
         status of write
     reason : str
         reason for status of write
+    body : str
+        entry id of the write, '0' if ThingSpeak rejected it
     """
-    headers = {'Content-typZZe': 'application/x-www-form-urlencoded',
+    headers = {'Content-type': 'application/x-www-form-urlencoded',
                'Accept': 'text/plain'}
     fields['key'] = key
     status = None
     reason = None
+    body = None
     params = urllib.parse.urlencode(fields)
     logging.debug('Fields to write: {}'.format(fields))
 
     try:
-        conn = http.client.HTTPConnection('api.thingspeak.com:80')
+        conn = connect(base_url)
         conn.request('POST', '/update', params, headers)
         response = conn.getresponse()
         status = response.status
         reason = response.reason
+        body = response.read().decode().strip()
+        conn.close()
+    except Exception:
+        logging.error("Connection failed!")
+
+    logging.debug('{response_status}, {response_reason}'.format(
+        response_status=status,
+        response_reason=reason))
+
+    return status, reason, body
+
+
+def bulk_write_to_channel(key, feed, updates, base_url=None):
+    """
+    Writes several entries to a given ThingSpeak channel at once
+
+    Parameters
+    ----------
+    key : str
+    feed : str
+    updates : list
+        Dicts of fields, each with 'created_at' or 'delta_t'
+    base_url : str
+        API to write to, BASE_URL by default
+
+    Returns
+    -------
+    status : int
+        status of write
+    reason : str
+        reason for status of write
+    """
+    headers = {'Content-type': 'application/json'}
+    body = json.dumps({'write_api_key': key, 'updates': updates})
+    status = None
+    reason = None
+    logging.debug('Writing {} entries'.format(len(updates)))
+
+    try:
+        conn = connect(base_url)
+        conn.request('POST', '/channels/{}/bulk_update.json'.format(feed),
+                     body, headers)
+        response = conn.getresponse()
+        status = response.status
+        reason = response.reason
         conn.close()
     except Exception:
         logging.error("Connection failed!")
@@ -59,7 +278,7 @@ def write_to_channel(key, fields):
     return status, reason
 
 
-def read_from_channel(key, feed):
+def read_from_channel(key, feed, base_url=None):
     """
     Reads data from a given ThingSpeak channel
 
@@ -67,12 +286,99 @@ def read_from_channel(key, feed):
     ----------
     key : str
     feed : str
+    base_url : str
+        API to read from, BASE_URL by default
 
     Returns
     -------
     fields : dict
         fields read from ThingSpeak channel
     """
-    read_url = c.READ_URL.format(CHANNEL_FEED=feed, READ_KEY=key)
+    read_url = c.READ_URL.format(BASE_URL=base_url or BASE_URL,
+                                 CHANNEL_FEED=feed, READ_KEY=key)
     fields = requests.get(read_url).json()
     return fields
+
+
+def iter_feed_entries(chunks):
+    """
+    Parse the entries of a feeds.json response as it arrives
+
+    Only one entry is decoded at a time, so memory stays bounded however
+    long the feed is.
+
+    Parameters
+    ----------
+    chunks : iterable
+        str pieces of the response body
+
+    Yields
+    ------
+    dict
+        Feed entries, in order
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+
+    # Skip the channel header up to the feeds array
+    while True:
+        match = FEEDS_ARRAY.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buffer += chunk
+
+    while True:
+        buffer = buffer.lstrip(' \t\r\n,')
+        if buffer.startswith(']'):
+            return
+        try:
+            entry, end = decoder.raw_decode(buffer)
+        except ValueError:
+            # Entry split across chunks
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise Exception('Truncated feed!')
+            buffer += chunk
+            continue
+        buffer = buffer[end:]
+        yield entry
+
+
+def stream_from_channel(key, feed, params=None, base_url=None):
+    """
+    Reads entries from a given ThingSpeak channel without loading the
+    whole response
+
+    Parameters
+    ----------
+    key : str
+    feed : str
+    params : dict
+        Extra feeds.json parameters, e.g. start, end & results
+    base_url : str
+        API to read from, BASE_URL by default
+
+    Yields
+    ------
+    dict
+        Feed entries, oldest first
+    """
+    url = '{}/channels/{}/feeds.json'.format(base_url or BASE_URL, feed)
+    query = {'api_key': key, 'timezone': c.THINGSPEAK_TIMEZONE}
+    query.update(params or {})
+    response = requests.get(url, params=query, stream=True,
+                            timeout=READ_TIMEOUT_SECS)
+    try:
+        response.raise_for_status()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = (decoder.decode(chunk)
+                  for chunk in response.iter_content(STREAM_CHUNK_BYTES))
+        for entry in iter_feed_entries(chunks):
+            yield entry
+    finally:
+        response.close()
@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+"""
+thingspeak_server.py
+
+Local stand-in for the ThingSpeak API, for testing without the internet
+
+Implements /update, /channels/<id>/bulk_update.json &
+/channels/<id>/feeds.json for the channels in constants.py, with optional
+latency, error injection & the per-key write limit.
+
+Notes
+-----
+- Docstrings follow the numpydoc style:
+  https://numpydoc.readthedocs.io/en/latest/format.html
+- Code follows the PEP 8 style guide:
+  https://www.python.org/dev/peps/pep-0008/
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from datetime import datetime, timedelta
+import abc
+import argparse
+import calendar
+import json
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+import constants as c
+import timezones
+
+SERVER_PORT = 3000
+FIELDS = ['field{}'.format(i) for i in range(1, 9)]
+DEFAULT_RESULTS = 100
+MAX_RESULTS = 8000
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+FEEDS_PATH = re.compile(r'^/channels/(\w+)/feeds\.json$')
+BULK_PATH = re.compile(r'^/channels/(\w+)/bulk_update\.json$')
+
+
+def parse_time(value, timezone=None):
+    """
+    Parse a ThingSpeak time parameter
+
+    Parameters
+    ----------
+    value : str
+        'YYYY-MM-DD HH:NN:SS' or ISO 8601, in UTC if it ends with 'Z'
+    timezone : str
+        Timezone of times without 'Z', UTC by default
+
+    Returns
+    -------
+    str
+        Time in TIME_FORMAT
+
+    Raises
+    ------
+    ValueError
+        Unparseable time
+    Exception
+        Unknown timezone
+    """
+    utc = value.endswith('Z') or not timezone
+    value = value.replace('T', ' ').rstrip('Z')
+    parsed = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    if not utc:
+        # Offset at the local time, checked again in case it's near a
+        # transition
+        secs = calendar.timegm(parsed.timetuple())
+        offset = timezones.utc_offset(timezone, secs)
+        offset = timezones.utc_offset(timezone, secs - offset)
+        parsed -= timedelta(seconds=offset)
+    return parsed.strftime(TIME_FORMAT)
+
+
+def format_time(created_at, timezone=None):
+    """
+    Format a stored time as ThingSpeak does for a timezone parameter
+
+    Parameters
+    ----------
+    created_at : str
+        Time in TIME_FORMAT
+    timezone : str
+        UTC by default
+
+    Returns
+    -------
+    str
+        'YYYY-MM-DDTHH:MM:SSZ' in UTC, 'YYYY-MM-DDTHH:MM:SS+HH:MM' otherwise
+
+    Raises
+    ------
+    Exception
+        Unknown timezone
+    """
+    if not timezone:
+        return created_at
+    secs = calendar.timegm(time.strptime(created_at, TIME_FORMAT))
+    offset = timezones.utc_offset(timezone, secs)
+    sign = '-' if offset < 0 else '+'
+    return '{}{}{:02d}:{:02d}'.format(
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(secs + offset)),
+        sign, abs(offset) // 3600, abs(offset) % 3600 // 60)
+
+
+class FeedStore(metaclass=abc.ABCMeta):
+    """
+    Entries of every channel
+    """
+
+    @abc.abstractmethod
+    def add(self, feed, entries):
+        """
+        Append entries to a channel
+
+        Parameters
+        ----------
+        feed : str
+        entries : list
+            (created_at, fields dict) of each entry
+
+        Returns
+        -------
+        int
+            Entry id of the last entry
+        """
+
+    @abc.abstractmethod
+    def feeds(self, feed, results=DEFAULT_RESULTS, start=None, end=None):
+        """
+        Latest entries of a channel, oldest first
+
+        Parameters
+        ----------
+        feed : str
+        results : int
+            Maximum entries
+        start : str
+            Earliest created_at, inclusive
+        end : str
+            Latest created_at, inclusive
+
+        Returns
+        -------
+        list
+            Entry dicts as ThingSpeak returns them
+        """
+
+
+class MemoryStore(FeedStore):
+    """
+    Entries kept in memory
+    """
+
+    def __init__(self):
+        self.__feeds = {}
+        self.__lock = threading.Lock()
+
+    def add(self, feed, entries):
+        with self.__lock:
+            channel = self.__feeds.setdefault(feed, [])
+            for created_at, fields in entries:
+                entry = {'created_at': created_at,
+                         'entry_id': len(channel) + 1}
+                entry.update(fields)
+                channel.append(entry)
+            return len(channel)
+
+    def feeds(self, feed, results=DEFAULT_RESULTS, start=None, end=None):
+        with self.__lock:
+            entries = [e for e in self.__feeds.get(feed, [])
+                       if (start is None or e['created_at'] >= start) and
+                       (end is None or e['created_at'] <= end)]
+        return entries[-results:] if results else []
+
+
+class SqliteStore(FeedStore):
+    """
+    Entries kept in a SQLite DB, shared by the server's threads
+    """
+
+    def __init__(self, db_file):
+        """
+        Parameters
+        ----------
+        db_file : str
+        """
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(db_file,
+                                            check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "feed TEXT NOT NULL, "
+            "entry_id INTEGER NOT NULL, "
+            "created_at TEXT NOT NULL, "
+            "{}, "
+            "PRIMARY KEY (feed, entry_id))".format(
+                ', '.join('{} TEXT'.format(f) for f in FIELDS)))
+        self.__connection.commit()
+
+    def add(self, feed, entries):
+        with self.__lock, self.__connection:
+            cursor = self.__connection.execute(
+                "SELECT COALESCE(MAX(entry_id), 0) FROM entries "
+                "WHERE feed = ?", (feed,))
+            entry_id = cursor.fetchone()[0]
+            rows = []
+            for created_at, fields in entries:
+                entry_id += 1
+                rows.append([feed, entry_id, created_at] +
+                            [fields.get(f) for f in FIELDS])
+            self.__connection.executemany(
+                "INSERT INTO entries VALUES ({})".format(
+                    ', '.join('?' * (3 + len(FIELDS)))), rows)
+            return entry_id
+
+    def feeds(self, feed, results=DEFAULT_RESULTS, start=None, end=None):
+        query = "SELECT * FROM entries WHERE feed = ?"
+        params = [feed]
+        if start is not None:
+            query += " AND created_at >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND created_at <= ?"
+            params.append(end)
+        query += " ORDER BY entry_id DESC LIMIT ?"
+        params.append(results)
+
+        with self.__lock:
+            rows = self.__connection.execute(query, params).fetchall()
+
+        entries = []
+        for row in reversed(rows):
+            entry = {'created_at': row[2], 'entry_id': row[1]}
+            for name, value in zip(FIELDS, row[3:]):
+                if value is not None:
+                    entry[name] = value
+            entries.append(entry)
+        return entries
+
+
+class ThingSpeakServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server answering like the ThingSpeak API
+    """
+    daemon_threads = True
+
+    def __init__(self, address, store=None, channels=c.AIR_QUALITY_CHANNELS,
+                 latency=0, error_rate=0, interval=c.THINGSPEAK_WRITE_SECS):
+        """
+        Parameters
+        ----------
+        address : tuple
+            (host, port) to listen on
+        store : FeedStore
+            MemoryStore by default
+        channels : list
+            (feed, write key, read key) of each channel served
+        latency : float
+            Seconds added to every response
+        error_rate : float
+            Fraction of requests answered with a 500
+        interval : float
+            Minimum seconds between writes with the same key
+        """
+        super().__init__(address, ThingSpeakHandler)
+        self.store = store if store is not None else MemoryStore()
+        self.write_keys = {write: feed for feed, write, _ in channels}
+        self.read_keys = {feed: read for feed, _, read in channels}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.interval = interval
+        self.__last_write = {}
+        self.__lock = threading.Lock()
+
+    def take_write(self, key):
+        """
+        Take a write from a key's rate budget
+
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        bool
+            False if the key wrote less than interval seconds ago
+        """
+        with self.__lock:
+            now = time.monotonic()
+            last = self.__last_write.get(key)
+            if last is not None and now - last < self.interval:
+                return False
+            self.__last_write[key] = now
+            return True
+
+
+class ThingSpeakHandler(BaseHTTPRequestHandler):
+    """
+    Handles one ThingSpeak API request
+    """
+
+    def do_GET(self):
+        self.__handle()
+
+    def do_POST(self):
+        self.__handle()
+
+    def log_message(self, format, *args):
+        logging.debug('{} - {}'.format(self.address_string(), format % args))
+
+    def __handle(self):
+        """
+        Route a request after the injected latency & errors
+        """
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if random.random() < self.server.error_rate:
+            self.__reply(500, 'Injected error')
+            return
+
+        if url.path == '/update':
+            if body:
+                params.update(urllib.parse.parse_qsl(body.decode()))
+            self.__update(params)
+            return
+
+        match = BULK_PATH.match(url.path)
+        if match and self.command == 'POST':
+            self.__bulk_update(match.group(1), body)
+            return
+
+        match = FEEDS_PATH.match(url.path)
+        if match:
+            self.__feeds(match.group(1), params)
+            return
+
+        self.__reply(404, 'Not found')
+
+    def __update(self, params):
+        """
+        Write one entry, replies with its entry id (0 if rejected)
+
+        Parameters
+        ----------
+        params : dict
+        """
+        key = params.get('api_key', params.get('key'))
+        feed = self.server.write_keys.get(key)
+        if feed is None or not self.server.take_write(key):
+            self.__reply(200, '0')
+            return
+
+        fields = {f: params[f] for f in FIELDS if f in params}
+        try:
+            created_at = parse_time(params['created_at']) \
+                if 'created_at' in params \
+                else datetime.utcnow().strftime(TIME_FORMAT)
+        except ValueError:
+            self.__reply(200, '0')
+            return
+        entry_id = self.server.store.add(feed, [(created_at, fields)])
+        self.__reply(200, str(entry_id))
+
+    def __bulk_update(self, feed, body):
+        """
+        Write several entries
+
+        Parameters
+        ----------
+        feed : str
+        body : bytes
+            JSON with write_api_key & updates
+        """
+        try:
+            request = json.loads(body.decode())
+            key = request['write_api_key']
+            updates = request['updates']
+        except (ValueError, KeyError, TypeError):
+            self.__reply(400, json.dumps({'success': False}))
+            return
+
+        if self.server.write_keys.get(key) != feed:
+            self.__reply(401, json.dumps({'success': False}))
+            return
+
+        if not self.server.take_write(key):
+            self.__reply(429, json.dumps({'success': False}))
+            return
+
+        # delta_t is seconds before now, like ThingSpeak's relative times
+        now = datetime.utcnow()
+        entries = []
+        try:
+            for update in updates:
+                if 'created_at' in update:
+                    created_at = parse_time(str(update['created_at']))
+                else:
+                    delta = timedelta(
+                        seconds=float(update.get('delta_t', 0)))
+                    created_at = (now - delta).strftime(TIME_FORMAT)
+                fields = {f: str(update[f]) for f in FIELDS if f in update}
+                entries.append((created_at, fields))
+        except (ValueError, TypeError, AttributeError):
+            self.__reply(400, json.dumps({'success': False}))
+            return
+        entries.sort(key=lambda entry: entry[0])
+
+        self.server.store.add(feed, entries)
+        self.__reply(202, json.dumps({'success': True}))
+
+    def __feeds(self, feed, params):
+        """
+        Reply with a channel's latest entries
+
+        Parameters
+        ----------
+        feed : str
+        params : dict
+        """
+        read_key = self.server.read_keys.get(feed)
+        if read_key is None:
+            self.__reply(404, '-1')
+            return
+        if params.get('api_key') != read_key:
+            self.__reply(400, '-1')
+            return
+
+        # Times of the request & reply are in the timezone parameter
+        timezone = params.get('timezone')
+        try:
+            results = min(int(params.get('results', DEFAULT_RESULTS)),
+                          MAX_RESULTS)
+            start = parse_time(params['start'], timezone) \
+                if 'start' in params else None
+            end = parse_time(params['end'], timezone) \
+                if 'end' in params else None
+            entries = [dict(e, created_at=format_time(e['created_at'],
+                                                      timezone))
+                       for e in self.server.store.feeds(feed, results, start,
+                                                        end)]
+        except Exception:
+            self.__reply(400, '-1')
+            return
+
+        channel = {'id': int(feed) if feed.isdigit() else feed,
+                   'last_entry_id': entries[-1]['entry_id'] if entries
+                   else None}
+        self.__reply(200, json.dumps({'channel': channel, 'feeds': entries}),
+                     'application/json')
+
+    def __reply(self, status, body, content_type='text/plain'):
+        """
+        Parameters
+        ----------
+        status : int
+        body : str
+        content_type : str
+        """
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def parse_args():
+    """
+    Parses arguments for manual operation of the ThingSpeak stand-in
+
+    Returns
+    -------
+    args : Namespace
+        Populated attributes based on args
+    """
+    parser = argparse.ArgumentParser(
+        description='Run a local ThingSpeak stand-in (CTRL-C to exit)')
+
+    parser.add_argument('-v',
+                        '--verbose',
+                        default=False,
+                        action='store_true',
+                        help='Print all debug logs')
+
+    parser.add_argument('-p',
+                        '--port',
+                        type=int,
+                        default=SERVER_PORT,
+                        metavar='<port>',
+                        help='Port to listen on. '
+                             'Default: {}'.format(SERVER_PORT))
+
+    parser.add_argument('-f',
+                        '--db-file',
+                        metavar='<db_file>',
+                        help='Keep entries in this SQLite DB. '
+                             'Default: in memory')
+
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0,
+                        metavar='<seconds>',
+                        help='Delay added to every response. Default: 0')
+
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0,
+                        metavar='<fraction>',
+                        help='Fraction of requests failed with a 500. '
+                             'Default: 0')
+
+    parser.add_argument('--interval',
+                        type=float,
+                        default=c.THINGSPEAK_WRITE_SECS,
+                        metavar='<seconds>',
+                        help='Minimum time between writes with a key. '
+                             'Default: {}'.format(c.THINGSPEAK_WRITE_SECS))
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging_level = logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(format=c.LOGGING_FORMAT, level=logging_level)
+
+    store = SqliteStore(args.db_file) if args.db_file else MemoryStore()
+    server = ThingSpeakServer(('', args.port), store,
+                              latency=args.latency,
+                              error_rate=args.error_rate,
+                              interval=args.interval)
+    logging.info('Serving on port {}, CTRL-C to stop'.format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Exiting due to keyboard interrupt')
+    finally:
+        server.server_close()
@@ -0,0 +1,301 @@
+"""
+timezones.py
+
+Local time in a named timezone, e.g. the ThingSpeak channel timezone,
+whatever the timezone of the machine
+
+Notes
+-----
+- Python 3.6 has no zoneinfo, the TZif files of the system tz database
+  are parsed here instead (RFC 8536). The process TZ is never changed,
+  so other threads (e.g. logging) keep seeing the machine timezone
+- Docstrings follow the numpydoc style:
+  https://numpydoc.readthedocs.io/en/latest/format.html
+- Code follows the PEP 8 style guide:
+  https://www.python.org/dev/peps/pep-0008/
+"""
+from bisect import bisect_right
+import calendar
+from datetime import date, datetime
+import os
+import re
+import struct
+import threading
+import time
+
+ZONEINFO_DIR = '/usr/share/zoneinfo'
+TZIF_HEADER = struct.Struct('>4sc15x6l')
+# Default time of day of POSIX TZ rule transitions
+RULE_TIME_SECS = 2 * 3600
+
+# POSIX TZ string, e.g. 'EST5EDT,M3.2.0,M11.1.0' or '<+0330>-3:30'
+_NAME = r'(?:[A-Za-z]{3,}|<[+\-0-9A-Za-z]+>)'
+_OFFSET = r'[+\-]?\d{1,3}(?::\d{2}){0,2}'
+_DATE = r'(?:J\d{1,3}|\d{1,3}|M\d{1,2}\.\d\.\d)'
+_POSIX_TZ = re.compile(
+    r'{n}({o})(?:{n}({o})?,({d})(?:/({o}))?,({d})(?:/({o}))?)?$'.format(
+        n=_NAME, o=_OFFSET, d=_DATE))
+
+_lock = threading.Lock()
+_zones = {}
+
+
+def _parse_hms(text):
+    """
+    Parameters
+    ----------
+    text : str
+        [+-]hh[:mm[:ss]]
+
+    Returns
+    -------
+    int
+        Seconds
+    """
+    sign = -1 if text.startswith('-') else 1
+    parts = [int(p) for p in text.lstrip('+-').split(':')]
+    return sign * sum(p * 60 ** (2 - i) for i, p in enumerate(parts))
+
+
+def _rule_day(rule, year):
+    """
+    Parameters
+    ----------
+    rule : str
+        POSIX TZ rule date, 'Jn', 'n' or 'Mm.w.d'
+    year : int
+
+    Returns
+    -------
+    int
+        Epoch seconds of the start of the day, as if it were UTC
+    """
+    if rule.startswith('M'):
+        month, week, weekday = (int(p) for p in rule[1:].split('.'))
+        # date.weekday() counts from Monday, the rule from Sunday
+        first = (date(year, month, 1).weekday() + 1) % 7
+        day = 1 + (weekday - first) % 7 + (week - 1) * 7
+        while day > calendar.monthrange(year, month)[1]:
+            day -= 7
+        return calendar.timegm((year, month, day, 0, 0, 0))
+
+    start = calendar.timegm((year, 1, 1, 0, 0, 0))
+    if rule.startswith('J'):
+        # 1 to 365, February 29th is never counted
+        day = int(rule[1:])
+        leap = calendar.isleap(year) and day >= 60
+        return start + (day - 1 + leap) * 86400
+    return start + int(rule) * 86400
+
+
+class PosixRule:
+    """
+    Offset after the last transition of a TZif file, from its footer
+    """
+
+    def __init__(self, tz):
+        """
+        Parameters
+        ----------
+        tz : str
+            POSIX TZ string
+
+        Raises
+        ------
+        Exception
+            Unsupported TZ string
+        """
+        match = _POSIX_TZ.match(tz)
+        if not match:
+            raise Exception('Unsupported TZ string {}!'.format(tz))
+        std, dst, start, start_time, end, end_time = match.groups()
+
+        # POSIX offsets are positive west of UTC
+        self.__std = -_parse_hms(std)
+        self.__dst = None
+        if start:
+            self.__dst = -_parse_hms(dst) if dst else self.__std + 3600
+            self.__start = start
+            self.__start_time = _parse_hms(start_time) if start_time \
+                else RULE_TIME_SECS
+            self.__end = end
+            self.__end_time = _parse_hms(end_time) if end_time \
+                else RULE_TIME_SECS
+
+    def offset(self, secs):
+        """
+        Parameters
+        ----------
+        secs : float
+            Epoch seconds
+
+        Returns
+        -------
+        int
+            Seconds ahead of UTC
+        """
+        if self.__dst is None:
+            return self.__std
+
+        # Transition times are local, standard time for the start of DST
+        year = time.gmtime(secs + self.__std).tm_year
+        start = _rule_day(self.__start, year) + self.__start_time - \
+            self.__std
+        end = _rule_day(self.__end, year) + self.__end_time - self.__dst
+        if start < end:
+            dst = start <= secs < end
+        else:
+            # Southern hemisphere, DST spans the new year
+            dst = not end <= secs < start
+        return self.__dst if dst else self.__std
+
+
+class Zone:
+    """
+    Offsets of a timezone, from its TZif file
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            TZif file
+
+        Raises
+        ------
+        Exception
+            Not a TZif file
+        """
+        with open(path, 'rb') as tzif:
+            data = tzif.read()
+        magic, version, *counts = TZIF_HEADER.unpack_from(data)
+        if magic != b'TZif':
+            raise Exception('Not a TZif file {}!'.format(path))
+
+        # Version 2+ repeats the data with 64 bit times, then a footer
+        time_size = 4
+        offset = TZIF_HEADER.size
+        if version != b'\x00':
+            offset += self.__data_size(counts, time_size)
+            counts = TZIF_HEADER.unpack_from(data, offset)[2:]
+            time_size = 8
+            offset += TZIF_HEADER.size
+        isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = counts
+
+        self.__transitions = list(struct.unpack_from(
+            '>{}{}'.format(timecnt, 'l' if time_size == 4 else 'q'),
+            data, offset))
+        offset += timecnt * time_size
+        types = struct.unpack_from('>{}B'.format(timecnt), data, offset)
+        offset += timecnt
+        utoffs = [struct.unpack_from('>l', data, offset + i * 6)[0]
+                  for i in range(typecnt)]
+        self.__offsets = [utoffs[i] for i in types]
+        self.__first = utoffs[0]
+
+        self.__rule = None
+        if time_size == 8:
+            offset += self.__data_size(counts, time_size) - \
+                timecnt * (time_size + 1)
+            footer = data[offset:].strip(b'\n').decode('ascii')
+            if footer:
+                self.__rule = PosixRule(footer)
+
+    @staticmethod
+    def __data_size(counts, time_size):
+        isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = counts
+        return (timecnt * (time_size + 1) + typecnt * 6 + charcnt +
+                leapcnt * (time_size + 4) + isstdcnt + isutcnt)
+
+    def offset(self, secs):
+        """
+        Parameters
+        ----------
+        secs : float
+            Epoch seconds
+
+        Returns
+        -------
+        int
+            Seconds ahead of UTC
+        """
+        i = bisect_right(self.__transitions, secs)
+        if i == 0:
+            if self.__transitions or self.__rule is None:
+                return self.__first
+        elif i < len(self.__transitions) or self.__rule is None:
+            return self.__offsets[i - 1]
+        return self.__rule.offset(secs)
+
+
+def utc_offset(name, secs=None):
+    """
+    Seconds a timezone is ahead of UTC at a time
+
+    Parameters
+    ----------
+    name : str
+        tz database name, e.g. 'America/New_York', or 'UTC'
+    secs : float
+        Epoch seconds, now by default
+
+    Returns
+    -------
+    int
+
+    Raises
+    ------
+    Exception
+        Unknown timezone
+    """
+    if secs is None:
+        secs = time.time()
+    if name.upper() in ('UTC', 'Z'):
+        return 0
+
+    zone = _zones.get(name)
+    if zone is None:
+        path = os.path.normpath(os.path.join(ZONEINFO_DIR, name))
+        if not path.startswith(ZONEINFO_DIR + os.sep) or \
+                not os.path.isfile(path):
+            raise Exception('Unknown timezone {}!'.format(name))
+        try:
+            zone = Zone(path)
+        except (OSError, struct.error, UnicodeDecodeError) as e:
+            raise Exception('Unreadable timezone {}: {}!'.format(name, e))
+        with _lock:
+            zone = _zones.setdefault(name, zone)
+    return zone.offset(secs)
+
+
+def local_time(name, secs=None):
+    """
+    Parameters
+    ----------
+    name : str
+    secs : float
+        Epoch seconds, now by default
+
+    Returns
+    -------
+    time.struct_time
+        Time in the timezone, tm_gmtoff isn't set
+    """
+    if secs is None:
+        secs = time.time()
+    return time.gmtime(secs + utc_offset(name, secs))
+
+
+def now(name):
+    """
+    Parameters
+    ----------
+    name : str
+
+    Returns
+    -------
+    datetime
+        Current time in the timezone, naive & to the second
+    """
+    return datetime(*local_time(name)[:6])
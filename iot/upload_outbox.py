@@ -0,0 +1,194 @@
+"""
+upload_outbox.py
+
+Durable queue of cloud uploads waiting to be sent
+
+Notes
+-----
+- Docstrings follow the numpydoc style:
+  https://numpydoc.readthedocs.io/en/latest/format.html
+- Code follows the PEP 8 style guide:
+  https://www.python.org/dev/peps/pep-0008/
+"""
+import json
+import random
+import sqlite3
+import time
+
+OUTBOX_FILE = 'outbox.db'
+BACKOFF_BASE_SECS = 1
+BACKOFF_MAX_SECS = 300
+MAX_REJECTIONS = 5
+
+
+class UploadOutbox:
+    """
+    Uploads kept on disk until the cloud accepts them
+
+    The DB runs in WAL mode so each upload is committed before it's sent,
+    a restart resumes where it left off. Uploads are handed out oldest
+    first, a failed upload holds back the ones behind it until its
+    backoff expires so they drain in order. An upload the cloud keeps
+    rejecting is moved to a dead letter table so it can't hold back the
+    rest forever, failures to reach the cloud are retried without limit.
+    """
+
+    def __init__(self, db_file=OUTBOX_FILE, backoff_base=BACKOFF_BASE_SECS,
+                 backoff_max=BACKOFF_MAX_SECS, max_rejections=MAX_REJECTIONS):
+        """
+        Parameters
+        ----------
+        db_file : str
+        backoff_base : float
+            Seconds to wait after the first failure, doubled per failure
+        backoff_max : float
+            Longest wait between attempts
+        max_rejections : int
+            Rejections before an upload is given up on
+        """
+        self.__backoff_base = backoff_base
+        self.__backoff_max = backoff_max
+        self.__max_rejections = max_rejections
+        self.__connection = sqlite3.connect(db_file)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "device_id INTEGER NOT NULL, "
+            "fields TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt REAL NOT NULL DEFAULT 0)")
+        columns = [row[1] for row in self.__connection.execute(
+            "PRAGMA table_info(outbox)")]
+        if 'rejections' not in columns:
+            self.__connection.execute(
+                "ALTER TABLE outbox "
+                "ADD COLUMN rejections INTEGER NOT NULL DEFAULT 0")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letter ("
+            "seq INTEGER PRIMARY KEY, "
+            "device_id INTEGER NOT NULL, "
+            "fields TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL, "
+            "failed_at REAL NOT NULL)")
+        self.__connection.commit()
+
+    def __len__(self):
+        """
+        Returns
+        -------
+        int
+            Backlog of uploads not yet accepted
+        """
+        cursor = self.__connection.execute("SELECT COUNT(*) FROM outbox")
+        return cursor.fetchone()[0]
+
+    def dead_letters(self):
+        """
+        Returns
+        -------
+        int
+            Uploads given up on after max_rejections
+        """
+        cursor = self.__connection.execute(
+            "SELECT COUNT(*) FROM dead_letter")
+        return cursor.fetchone()[0]
+
+    def put(self, device_id, fields):
+        """
+        Queue an upload
+
+        Parameters
+        ----------
+        device_id : int
+        fields : dict
+            Fields to write to the channel
+        """
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT INTO outbox (device_id, fields) VALUES (?, ?)",
+                (device_id, json.dumps(fields)))
+
+    def head(self):
+        """
+        Oldest upload, if it's due
+
+        Returns
+        -------
+        tuple
+            (seq, device id, fields), None if the outbox is empty or the
+            oldest upload is backing off
+        """
+        cursor = self.__connection.execute(
+            "SELECT seq, device_id, fields, next_attempt FROM outbox "
+            "ORDER BY seq LIMIT 1")
+        row = cursor.fetchone()
+        if row is None or row[3] > time.time():
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def ack(self, seq):
+        """
+        Remove an upload the cloud accepted
+
+        Parameters
+        ----------
+        seq : int
+        """
+        with self.__connection:
+            self.__connection.execute("DELETE FROM outbox WHERE seq = ?",
+                                      (seq,))
+
+    def retry(self, seq, rejected=False):
+        """
+        Back off an upload that failed, or give up on it once it's been
+        rejected max_rejections times
+
+        Jitter spreads the retries of several outboxes after an outage.
+
+        Parameters
+        ----------
+        seq : int
+        rejected : bool
+            The cloud refused the upload, rather than couldn't be reached
+
+        Returns
+        -------
+        float
+            Seconds until the next attempt, None if the upload was moved
+            to the dead letter table
+        """
+        cursor = self.__connection.execute(
+            "SELECT attempts, rejections FROM outbox WHERE seq = ?", (seq,))
+        row = cursor.fetchone()
+        if row is None:
+            return 0
+        attempts = row[0] + 1
+        rejections = row[1] + rejected
+
+        if rejections >= self.__max_rejections:
+            with self.__connection:
+                self.__connection.execute(
+                    "INSERT INTO dead_letter "
+                    "SELECT seq, device_id, fields, ?, ? FROM outbox "
+                    "WHERE seq = ?", (attempts, time.time(), seq))
+                self.__connection.execute("DELETE FROM outbox WHERE seq = ?",
+                                          (seq,))
+            return None
+
+        delay = min(self.__backoff_max,
+                    self.__backoff_base * 2 ** (attempts - 1))
+        delay *= random.uniform(0.5, 1)
+        with self.__connection:
+            self.__connection.execute(
+                "UPDATE outbox SET attempts = ?, rejections = ?, "
+                "next_attempt = ? WHERE seq = ?",
+                (attempts, rejections, time.time() + delay, seq))
+        return delay
+
+    def close(self):
+        """
+        Close the DB
+        """
+        self.__connection.close()
@@ -0,0 +1,215 @@
+"""
+window_aggregator.py
+
+Per-device windowed aggregation of readings before cloud upload
+
+Notes
+-----
+- Docstrings follow the numpydoc style:
+  https://numpydoc.readthedocs.io/en/latest/format.html
+- Code follows the PEP 8 style guide:
+  https://www.python.org/dev/peps/pep-0008/
+"""
+import time
+import constants as c
+
+
+def in_warning(type_data, value):
+    """
+    Check a reading against its alert threshold
+
+    Parameters
+    ----------
+    type_data : str
+        'humidity' or 'co2'
+    value : float
+
+    Returns
+    -------
+    bool
+        True if the reading should raise an alert
+    """
+    if type_data == 'humidity':
+        return value < c.HUMIDITY_THRESHOLD
+    return value > c.CO2_THRESHOLD
+
+
+class Window:
+    """
+    Running summary of one device's readings of one type
+    """
+    __slots__ = ('id', 'location', 'type', 'start', 'count', 'total',
+                 'minimum', 'maximum', 'warning')
+
+    def __init__(self, id_data, location, type_data, start):
+        """
+        Parameters
+        ----------
+        id_data : int
+        location : str
+        type_data : str
+        start : float
+            Time the window opened
+        """
+        self.id = id_data
+        self.location = location
+        self.type = type_data
+        self.start = start
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.warning = None
+
+    @property
+    def mean(self):
+        """
+        float : mean of the readings in the window
+        """
+        return self.total / self.count if self.count else None
+
+    def add(self, value):
+        """
+        Add a reading to the window
+
+        Parameters
+        ----------
+        value : float
+        """
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def reset(self, start):
+        """
+        Start a new window, keeping the device's threshold side
+
+        Parameters
+        ----------
+        start : float
+        """
+        self.start = start
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+
+class Summary:
+    """
+    Summary of a closed window
+    """
+    __slots__ = ('id', 'location', 'type', 'start', 'end', 'mean',
+                 'minimum', 'maximum', 'count')
+
+    def __init__(self, window, end):
+        """
+        Parameters
+        ----------
+        window : Window
+        end : float
+            Time the window closed
+        """
+        self.id = window.id
+        self.location = window.location
+        self.type = window.type
+        self.start = window.start
+        self.end = end
+        self.mean = window.mean
+        self.minimum = window.minimum
+        self.maximum = window.maximum
+        self.count = window.count
+
+    def __repr__(self):
+        return ('Summary(id={}, type={}, mean={:.2f}, min={}, max={}, '
+                'count={})'.format(self.id, self.type, self.mean,
+                                   self.minimum, self.maximum, self.count))
+
+
+class WindowAggregator:
+    """
+    Aggregates readings per device & type over tumbling windows
+
+    Each device keeps running count/sum/min/max, so memory per device is
+    constant no matter how many readings arrive in a window. Readings
+    crossing an alert threshold are flagged so they can be uploaded
+    right away instead of waiting for the window to close.
+    """
+
+    def __init__(self, window_secs):
+        """
+        Parameters
+        ----------
+        window_secs : float
+            Length of a window in seconds
+        """
+        self.__window_secs = window_secs
+        self.__windows = {}
+
+    def __len__(self):
+        return len(self.__windows)
+
+    def add(self, id_data, location, type_data, value):
+        """
+        Add a reading to its device's window
+
+        Parameters
+        ----------
+        id_data : int
+        location : str
+        type_data : str
+            'humidity' or 'co2'
+        value : float
+
+        Returns
+        -------
+        crossed : bool
+            True if the reading crossed the alert threshold, or is the
+            device's first reading & already past it
+        """
+        key = (id_data, type_data)
+        window = self.__windows.get(key)
+        if window is None:
+            window = Window(id_data, location, type_data, time.monotonic())
+            self.__windows[key] = window
+        window.location = location
+        window.add(value)
+
+        warning = in_warning(type_data, value)
+        if window.warning is None:
+            crossed = warning
+        else:
+            crossed = warning != window.warning
+        window.warning = warning
+        return crossed
+
+    def flush(self, force=False):
+        """
+        Close windows that have run for window_secs
+
+        Windows without new readings are dropped rather than reported.
+
+        Parameters
+        ----------
+        force : bool
+            Close every window with readings regardless of age
+
+        Returns
+        -------
+        summaries : list
+            Summary of each closed window
+        """
+        now = time.monotonic()
+        summaries = []
+        for key, window in list(self.__windows.items()):
+            if not force and now - window.start < self.__window_secs:
+                continue
+            if window.count:
+                summaries.append(Summary(window, now))
+                window.reset(now)
+            else:
+                del self.__windows[key]
+        return summaries
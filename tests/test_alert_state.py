@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+test_alert_state.py
+"""
+from unittest import TestCase, main
+from unittest.mock import patch
+from alert_state import AlertStateTable
+
+
+class TestAlertStateTable(TestCase):
+
+    def setUp(self):
+        self.__table = AlertStateTable(idle_secs=60)
+
+    def test_per_device_state(self):
+        """
+        Test one device's warning does not mask another's
+        """
+        first = self.__table.get(1, 'Room 1')
+        second = self.__table.get(2, 'Room 1')
+        self.assertTrue(first.humidity_first)
+
+        self.__table.set_warning(first, 'humidity', True)
+        self.assertTrue(self.__table.get(1, 'Room 1').humidity_warning)
+        self.assertFalse(second.humidity_warning)
+        self.assertFalse(first.humidity_first)
+
+        location = self.__table.location('Room 1')
+        self.assertEqual(location.devices, 2)
+        self.assertEqual(location.humidity_warnings, 1)
+        self.assertEqual(location.co2_warnings, 0)
+
+        # Moving device carries its warning to the new location
+        self.__table.get(1, 'Room 2')
+        self.assertEqual(location.humidity_warnings, 0)
+        self.assertEqual(self.__table.location('Room 2').humidity_warnings, 1)
+
+    @patch('alert_state.time.monotonic')
+    def test_evict_idle(self, mock_monotonic):
+        """
+        Test only devices idle for longer than idle_secs are evicted
+        """
+        mock_monotonic.return_value = 0
+        state = self.__table.get(1, 'Room 1')
+        self.__table.set_warning(state, 'co2', True)
+        mock_monotonic.return_value = 30
+        self.__table.get(2, 'Room 2')
+
+        mock_monotonic.return_value = 61
+        self.assertEqual(self.__table.evict_idle(), 1)
+        self.assertEqual(len(self.__table), 1)
+        self.assertIsNone(self.__table.location('Room 1'))
+
+        # Evicted device starts over
+        self.assertTrue(self.__table.get(1, 'Room 1').co2_first)
+
+
+if __name__ == '__main__':
+    main()
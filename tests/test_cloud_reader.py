@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+test_cloud_reader.py
+"""
+from unittest import TestCase, main
+from cloud_reader import TimestampParser, parse_feed
+import constants as c
+
+
+class TestTimestampParser(TestCase):
+
+    def setUp(self):
+        self.__parser = TimestampParser()
+
+    def test_utc(self):
+        """
+        Test parsing a time in UTC
+        """
+        self.assertEqual(self.__parser.parse('2020-11-22T19:03:17Z'),
+                         (1606071797000, 0, '2020-11-22', '19:03:17'))
+
+    def test_offsets(self):
+        """
+        Test offsets behind & ahead of UTC give the same instant
+        """
+        err_msg = 'Negative offset was applied the wrong way'
+        self.assertEqual(self.__parser.parse('2020-11-22T14:03:17-05:00'),
+                         (1606071797000, -300, '2020-11-22', '14:03:17'),
+                         err_msg)
+        err_msg = 'Positive offset was applied the wrong way'
+        self.assertEqual(self.__parser.parse('2020-11-23T00:33:17+05:30'),
+                         (1606071797000, 330, '2020-11-23', '00:33:17'),
+                         err_msg)
+
+    def test_malformed(self):
+        """
+        Test unparseable times are rejected
+        """
+        for created_at in ('', '2020-11-22', '2020-11-22 19:03:17Z',
+                           '2020-11-22T19:03:17', '2020-11-22T19:03:17+0500',
+                           '2020-11-22T19:03:17EST', '2020-11-22T19:xx:17Z'):
+            with self.assertRaises(ValueError, msg=created_at):
+                self.__parser.parse(created_at)
+
+
+class TestParseFeed(TestCase):
+
+    def test_split(self):
+        """
+        Test an entry with both readings is split into one record each
+        """
+        entry = {'created_at': '2020-11-22T14:03:17-05:00',
+                 c.NODE_FIELD: '4886718345',
+                 c.LOCATION_FIELD: 'Room 54321',
+                 c.HUMIDITY_FIELD: '45.5',
+                 c.CO2_FIELD: '800'}
+        parsed, records = parse_feed(entry, TimestampParser())
+
+        self.assertTrue(parsed)
+        common = {'date': '2020-11-22',
+                  'time': '14:03:17',
+                  'timestamp': 1606071797000,
+                  'utc_offset': -300,
+                  'id': 4886718345,
+                  'location': 'Room 54321'}
+        self.assertEqual(records, [dict(common, humidity=45.5),
+                                   dict(common, co2=800.0)])
+
+    def test_single(self):
+        """
+        Test an entry with one reading gives one record
+        """
+        entry = {'created_at': '2020-11-22T19:03:17Z',
+                 c.NODE_FIELD: '1',
+                 c.LOCATION_FIELD: 'Room 1',
+                 c.CO2_FIELD: '800'}
+        parsed, records = parse_feed(entry, TimestampParser())
+        self.assertTrue(parsed)
+        self.assertEqual(len(records), 1)
+        self.assertNotIn('humidity', records[0])
+
+    def test_bad_entries(self):
+        """
+        Test entries with bad dates or numbers are skipped
+        """
+        entry = {'created_at': 'yesterday',
+                 c.NODE_FIELD: '1',
+                 c.LOCATION_FIELD: 'Room 1',
+                 c.CO2_FIELD: '800'}
+        self.assertEqual(parse_feed(entry, TimestampParser()), (False, []))
+
+        entry = dict(entry, created_at='2020-11-22T19:03:17Z')
+        entry[c.CO2_FIELD] = 'lots'
+        self.assertEqual(parse_feed(entry, TimestampParser()), (False, []))
+
+
+if __name__ == '__main__':
+    main()
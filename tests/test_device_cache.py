@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+test_device_cache.py
+"""
+from unittest import TestCase, main
+from device_manager import DeviceCache
+
+
+class TestDeviceCache(TestCase):
+
+    def test_fill(self):
+        """
+        Test a DB read fills the cache if the device didn't change
+        """
+        cache = DeviceCache()
+        generation = cache.generation()
+        self.assertTrue(cache.fill(1, 'first@example.com', generation))
+        self.assertEqual(cache.get(1), (True, 'first@example.com'))
+
+    def test_stale_fill(self):
+        """
+        Test a DB read racing a register or invalidate isn't cached
+        """
+        cache = DeviceCache()
+
+        # Read misses, the device registers, then the read returns
+        generation = cache.generation()
+        cache.put(1, 'new@example.com')
+        err_msg = 'Read from before the register was cached'
+        self.assertFalse(cache.fill(1, '', generation), err_msg)
+        self.assertEqual(cache.get(1), (True, 'new@example.com'), err_msg)
+
+        generation = cache.generation()
+        cache.invalidate(2)
+        err_msg = 'Read from before the invalidate was cached'
+        self.assertFalse(cache.fill(2, 'old@example.com', generation),
+                         err_msg)
+        self.assertEqual(cache.get(2), (False, ''), err_msg)
+
+        # Changes of other devices don't matter
+        err_msg = 'Read of an unchanged device was not cached'
+        self.assertTrue(cache.fill(3, '', generation), err_msg)
+        self.assertEqual(cache.get(3), (True, ''), err_msg)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+test_device_registry.py
+"""
+import os
+from unittest import TestCase, main
+from device_registry import SqliteRegistry
+
+TEMP_DEVICE_DB = 'temp_device_list.db'
+
+
+class TestSqliteRegistry(TestCase):
+
+    def setUp(self):
+        self.__registry = SqliteRegistry(TEMP_DEVICE_DB)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(TEMP_DEVICE_DB + suffix):
+                os.remove(TEMP_DEVICE_DB + suffix)
+
+    def test_upsert(self):
+        """
+        Test registering a device & updating its email
+        """
+        err_msg = 'Unregistered device has an email'
+        self.assertIsNone(self.__registry.retrieve(4886718345), err_msg)
+
+        self.__registry.upsert(4886718345, 'first@example.com')
+        self.__registry.upsert(4886718345, 'second@example.com')
+        err_msg = 'Email was not updated'
+        self.assertEqual(self.__registry.retrieve(4886718345),
+                         'second@example.com', err_msg)
+        err_msg = 'Upsert created a duplicate device'
+        self.assertEqual(len(self.__registry.dump()), 1, err_msg)
+
+    def test_retrieve_many(self):
+        """
+        Test retrieving registered & unregistered devices together
+        """
+        self.__registry.upsert(1, 'one@example.com')
+        self.__registry.upsert(2, 'two@example.com')
+        emails = self.__registry.retrieve_many([1, 2, 3])
+        self.assertEqual(emails, {1: 'one@example.com',
+                                  2: 'two@example.com'})
+
+    def test_page(self):
+        """
+        Test paging through the registry in device id order
+        """
+        for device_id in (5, 3, 1, 4, 2):
+            self.__registry.upsert(device_id, '{}@example.com'.format(device_id))
+
+        first = self.__registry.page(None, 2)
+        self.assertEqual([row[0] for row in first], [1, 2])
+        second = self.__registry.page(first[-1][0], 2)
+        self.assertEqual([row[0] for row in second], [3, 4])
+
+        rows = []
+        count = self.__registry.for_each(lambda d, e: rows.append(d))
+        self.assertEqual(count, 5)
+        self.assertEqual(rows, [1, 2, 3, 4, 5])
+
+
+if __name__ == '__main__':
+    main()
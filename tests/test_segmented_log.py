@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+test_segmented_log.py
+"""
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+from unittest.mock import patch
+from segmented_log import SegmentedLog, SegmentIndex, BloomFilter
+from segmented_log import index_path, iter_records
+
+
+class TestSegmentedLog(TestCase):
+
+    def setUp(self):
+        self.__directory = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__directory, 'packets.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.__directory)
+
+    def __read_all(self, log):
+        data = b''
+        for _, path, compressed in log.segments():
+            opener = gzip.open if compressed else open
+            with opener(path, 'rb') as f:
+                data += f.read()
+        return data
+
+    def test_rotation(self):
+        """
+        Test segments rotate by size, are compressed & keep all data
+        """
+        log = SegmentedLog(self.__path, segment_bytes=100, flush_secs=0)
+        lines = [b'%03d' % i + b'x' * 46 + b'\n' for i in range(10)]
+        for line in lines:
+            log.append(line)
+        log.close()
+
+        segments = log.segments()
+        err_msg = 'Log was not rotated by size'
+        self.assertEqual(len(segments), 6, err_msg)
+        err_msg = 'Closed segments were not compressed'
+        self.assertTrue(all(compressed for _, _, compressed in segments),
+                        err_msg)
+        err_msg = 'Data was lost or reordered'
+        self.assertEqual(self.__read_all(log), b''.join(lines), err_msg)
+
+    @patch('segmented_log.time.monotonic')
+    def test_age_rotation(self, mock_monotonic):
+        """
+        Test appending to a segment older than segment_secs rotates it
+        """
+        mock_monotonic.return_value = 0
+        log = SegmentedLog(self.__path, segment_secs=60, compression='none')
+        log.append(b'first\n')
+        mock_monotonic.return_value = 30
+        log.append(b'second\n')
+        mock_monotonic.return_value = 60
+        log.append(b'third\n')
+        log.append(b'fourth\n')
+        log.close()
+
+        err_msg = 'Log was not rotated by age while appending'
+        self.assertEqual([seq for seq, _, _ in log.segments()], [1, 2],
+                         err_msg)
+        self.assertEqual(self.__read_all(log),
+                         b'first\nsecond\nthird\nfourth\n', err_msg)
+
+    def test_resume(self):
+        """
+        Test a new log continues the numbering of the previous one
+        """
+        log = SegmentedLog(self.__path, compression='none')
+        log.append(b'first\n')
+        log.close()
+        log = SegmentedLog(self.__path, compression='none')
+        log.append(b'second\n')
+        log.close()
+
+        err_msg = 'Previous segment was overwritten'
+        self.assertEqual([seq for seq, _, _ in log.segments()], [1, 2],
+                         err_msg)
+        self.assertEqual(self.__read_all(log), b'first\nsecond\n', err_msg)
+
+    def test_disk_cap(self):
+        """
+        Test the oldest segments are deleted above the disk cap
+        """
+        log = SegmentedLog(self.__path, segment_bytes=100,
+                           compression='none', max_disk_bytes=250)
+        for i in range(10):
+            log.append(b'%02d' % i + b'x' * 97 + b'\n')
+        log.close()
+
+        segments = log.segments()
+        total = sum(os.path.getsize(path) for _, path, _ in segments)
+        err_msg = 'Log is over its disk cap'
+        self.assertLessEqual(total, 250, err_msg)
+        err_msg = 'Newest segments were not kept'
+        self.assertEqual([seq for seq, _, _ in segments], [9, 10, 11],
+                         err_msg)
+
+    def test_index(self):
+        """
+        Test closed segments are indexed & readable from an indexed offset
+        """
+        log = SegmentedLog(self.__path, segment_bytes=10000)
+        for i in range(100):
+            log.append(b'%03d' % i + b'x' * 96 + b'\n', b'%d' % (i % 10),
+                       1000 + i)
+        log.close()
+
+        _, path, _ = log.segments()[0]
+        index = SegmentIndex.load(index_path(path))
+        err_msg = 'Index has the wrong time range'
+        self.assertEqual((index.first_time, index.last_time, index.count),
+                         (1000, 1099, 100), err_msg)
+        self.assertFalse(index.overlaps(1100, 1200), err_msg)
+        self.assertTrue(index.overlaps(1050, 1200), err_msg)
+
+        err_msg = 'Appended key is missing from the bloom filter'
+        self.assertTrue(all(b'%d' % i in index.keys for i in range(10)),
+                        err_msg)
+
+        records = list(iter_records(path, index.seek(1090)))
+        err_msg = 'Seek skipped the requested records'
+        self.assertLessEqual(int(records[0][:3]), 90, err_msg)
+        self.assertEqual(records[-1][:3], b'099', err_msg)
+
+    def test_bloom_filter(self):
+        """
+        Test the bloom filter has no false negatives & few positives
+        """
+        bloom = BloomFilter()
+        for i in range(500):
+            bloom.add(b'%d' % i)
+
+        err_msg = 'Bloom filter has a false negative'
+        self.assertTrue(all(b'%d' % i in bloom for i in range(500)),
+                        err_msg)
+        false_positives = sum(b'%d' % i in bloom for i in range(500, 10500))
+        err_msg = 'Bloom filter has too many false positives'
+        self.assertLess(false_positives, 500, err_msg)
+
+        saved = BloomFilter(data=bloom.data)
+        err_msg = 'Saved bloom filter differs'
+        self.assertTrue(all(b'%d' % i in saved for i in range(500)), err_msg)
+
+    def test_bloom_filter_sizing(self):
+        """
+        Test a segment's bloom filter is sized for its distinct keys
+        """
+        index = SegmentIndex()
+        for i in range(20000):
+            index.add(i * 100, b'%d' % (i % 10000))
+        index.seal()
+        path = os.path.join(self.__directory, 'segment.idx')
+        index.save(path)
+        index = SegmentIndex.load(path)
+
+        err_msg = 'Bloom filter has a false negative'
+        self.assertTrue(all(b'%d' % i in index.keys for i in range(10000)),
+                        err_msg)
+        false_positives = sum(b'%d' % i in index.keys
+                              for i in range(10000, 20000))
+        err_msg = 'Bloom filter has too many false positives'
+        self.assertLess(false_positives, 300, err_msg)
+
+
+if __name__ == '__main__':
+    main()
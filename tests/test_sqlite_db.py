@@ -59,6 +59,139 @@ class TestHumidityDB(TestCase):
         err_msg = 'Record failed to be added to DB table'
         self.assertTrue(self.__db.record_exists(record), err_msg)
 
+    def test_aggregate(self):
+        """
+        Test aggregating records per device & time bucket inside SQLite
+        """
+        self.__db.create_table()
+        for id_data, time, humidity in ((1, '14:00:10', 30.0),
+                                        (1, '14:00:50', 50.0),
+                                        (1, '14:01:30', 70.0),
+                                        (2, '14:00:20', 20.0)):
+            self.__db.add_record({'date': '2020-11-22',
+                                  'time': time,
+                                  'id': id_data,
+                                  'location': 'Room 54321',
+                                  'humidity': humidity})
+
+        result = self.__db.aggregate('avg')
+        self.assertEqual(result['id'], [1, 2])
+        self.assertEqual(list(result['value']), [50.0, 20.0])
+
+        result = self.__db.aggregate('max', bucket_secs=60)
+        self.assertEqual(result['id'], [1, 1, 2])
+        self.assertEqual(list(result['value']), [50.0, 70.0, 20.0])
+        self.assertEqual(result['bucket'][1] - result['bucket'][0], 60)
+
+        result = self.__db.aggregate('percentile', group_by=('location',),
+                                     rank=50)
+        self.assertEqual(result['location'], ['Room 54321'])
+        self.assertEqual(list(result['value']), [40.0])
+
+        result = self.__db.aggregate('count', group_by=(),
+                                     start='2020-11-22 14:00:30')
+        self.assertEqual(list(result['value']), [2])
+
+    def test_aggregate_buckets(self):
+        """
+        Test time buckets are UTC & time bounds compare date then time
+        """
+        self.__db.create_table()
+        # 2020-11-22 19:03:17 UTC, saved in the channel timezone (EST)
+        self.__db.add_record({'date': '2020-11-22',
+                              'time': '14:03:17',
+                              'timestamp': 1606071797000,
+                              'utc_offset': -300,
+                              'id': 1,
+                              'location': 'Room 54321',
+                              'humidity': 45.0})
+        self.__db.add_record({'date': '2020-11-22',
+                              'time': '14:03:17',
+                              'utc_offset': -300,
+                              'id': 2,
+                              'location': 'Room 54321',
+                              'humidity': 45.0})
+
+        result = self.__db.aggregate('count', bucket_secs=60,
+                                     start='2020-11-22 14:03:17',
+                                     end='2020-11-22 14:03:18')
+        err_msg = 'Bucket is not in UTC'
+        self.assertEqual(list(result['bucket']), [1606071780, 1606071780],
+                         err_msg)
+        self.assertEqual(list(result['value']), [1, 1])
+
+        result = self.__db.aggregate('count', group_by=(),
+                                     start='2020-11-22 14:03:18')
+        self.assertEqual(list(result['value']), [0])
+
+    def test_upgrade_table(self):
+        """
+        Test adding the time columns to a table made before they existed
+        """
+        self.__db._cursor.execute(
+            "create table {} (date text, time text, id integer, "
+            "location text, humidity float)".format(TEMP_HUMIDITY_TABLE))
+        self.__db.upgrade_table()
+        self.__db.upgrade_table()
+
+        record = {'date': '2020-11-22',
+                  'time': '14:03:17',
+                  'id': 1,
+                  'location': 'Room 54321',
+                  'humidity': 45.0,
+                  'timestamp': 1606071797000,
+                  'utc_offset': -300}
+        self.__db.add_record(record)
+        self.__db._cursor.execute(
+            "SELECT timestamp, utc_offset FROM {}".format(
+                TEMP_HUMIDITY_TABLE))
+        err_msg = 'Time columns were not added'
+        self.assertEqual(tuple(self.__db._cursor.fetchone()),
+                         (1606071797000, -300), err_msg)
+
+    def test_record_keys(self):
+        """
+        Test getting the records of a time range through the date index
+        """
+        self.__db.create_table()
+        for date, time in (('2020-11-21', '23:59:59'),
+                           ('2020-11-22', '00:00:00'),
+                           ('2020-11-22', '00:59:59'),
+                           ('2020-11-22', '01:00:00')):
+            self.__db.add_record({'date': date,
+                                  'time': time,
+                                  'id': 1,
+                                  'location': 'Room 54321',
+                                  'humidity': 45.0})
+
+        keys = self.__db.record_keys('2020-11-22 00:00:00',
+                                     '2020-11-22 00:59:59')
+        self.assertEqual(keys, {('2020-11-22', '00:00:00', 1, 'Room 54321',
+                                 45.0),
+                                ('2020-11-22', '00:59:59', 1, 'Room 54321',
+                                 45.0)})
+
+    def test_rollback(self):
+        """
+        Test records added in a block that raised aren't committed
+        """
+        self.__db.create_table()
+        self.__db.manual_exit()
+        record = {'date': '2020-11-22',
+                  'time': '14:03:17',
+                  'id': 1,
+                  'location': 'Room 54321',
+                  'humidity': 45.0}
+
+        with self.assertRaises(Exception):
+            with self.__db as db:
+                db.add_record(record)
+                raise Exception('Failed mid batch!')
+
+        self.__db.manual_enter()
+        err_msg = 'Record of the failed block was committed'
+        self.assertFalse(self.__db.record_exists(record), err_msg)
+
 
 class TestCo2DB(TestCase):
 
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+test_thingspeak_server.py
+"""
+import json
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from unittest import TestCase, main
+from thingspeak_server import ThingSpeakServer, MemoryStore, SqliteStore
+
+TEMP_FEEDS_DB = 'temp_feeds.db'
+CHANNELS = [('1', 'WRITE1', 'READ1'), ('2', 'WRITE2', 'READ2')]
+
+
+class TestThingSpeakServer(TestCase):
+
+    def setUp(self):
+        self.__start(MemoryStore())
+
+    def tearDown(self):
+        self.__stop()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(TEMP_FEEDS_DB + suffix):
+                os.remove(TEMP_FEEDS_DB + suffix)
+
+    def __start(self, store, **kwargs):
+        kwargs.setdefault('interval', 0)
+        self.__server = ThingSpeakServer(('127.0.0.1', 0), store, CHANNELS,
+                                         **kwargs)
+        self.__url = 'http://127.0.0.1:{}'.format(
+            self.__server.server_address[1])
+        self.__thread = threading.Thread(target=self.__server.serve_forever)
+        self.__thread.start()
+
+    def __stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+    def __request(self, path, data=None, content_type=None):
+        request = urllib.request.Request(self.__url + path, data)
+        if content_type:
+            request.add_header('Content-Type', content_type)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode()
+
+    def __update(self, key, **fields):
+        fields['api_key'] = key
+        data = urllib.parse.urlencode(fields).encode()
+        return self.__request('/update', data)
+
+    def __feeds(self, feed, key, **params):
+        params['api_key'] = key
+        status, body = self.__request('/channels/{}/feeds.json?{}'.format(
+            feed, urllib.parse.urlencode(params)))
+        return status, json.loads(body)
+
+    def test_update(self):
+        """
+        Test entries written with /update are read back in order
+        """
+        for store in (MemoryStore(), SqliteStore(TEMP_FEEDS_DB)):
+            self.__stop()
+            self.__start(store)
+
+            self.assertEqual(self.__update('WRITE1', field1=7, field2=500),
+                             (200, '1'), 'First entry id is not 1')
+            self.assertEqual(self.__update('WRITE1', field1=8, field3=30),
+                             (200, '2'), 'Second entry id is not 2')
+            self.assertEqual(self.__update('BADKEY', field1=9),
+                             (200, '0'), 'Bad key was not rejected')
+
+            status, channel = self.__feeds('1', 'READ1', results=1)
+            err_msg = 'Latest entry was not returned'
+            self.assertEqual(status, 200, err_msg)
+            self.assertEqual(len(channel['feeds']), 1, err_msg)
+            self.assertEqual(channel['feeds'][0]['field1'], '8', err_msg)
+            self.assertEqual(channel['feeds'][0]['field3'], '30', err_msg)
+
+            status, _ = self.__feeds('1', 'READ2')
+            self.assertEqual(status, 400, 'Bad read key was not rejected')
+
+    def test_bulk_update(self):
+        """
+        Test bulk entries are ordered by time & filtered by range
+        """
+        updates = [{'created_at': '2021-03-01 10:00:02', 'field1': 2},
+                   {'created_at': '2021-03-01 10:00:01', 'field1': 1}]
+        body = json.dumps({'write_api_key': 'WRITE2', 'updates': updates})
+        status, _ = self.__request('/channels/2/bulk_update.json',
+                                   body.encode(), 'application/json')
+        self.assertEqual(status, 202, 'Bulk update was not accepted')
+
+        _, channel = self.__feeds('2', 'READ2', start='2021-03-01 10:00:02')
+        err_msg = 'Time range was not applied'
+        self.assertEqual([e['field1'] for e in channel['feeds']], ['2'],
+                         err_msg)
+        self.assertEqual(channel['feeds'][0]['created_at'],
+                         '2021-03-01T10:00:02Z', err_msg)
+
+    def test_timezone(self):
+        """
+        Test the time range & created_at are in the timezone parameter
+        """
+        updates = [{'created_at': '2021-03-01 15:00:00', 'field1': 1},
+                   {'created_at': '2021-07-01 15:00:00', 'field1': 2}]
+        body = json.dumps({'write_api_key': 'WRITE2', 'updates': updates})
+        self.__request('/channels/2/bulk_update.json', body.encode(),
+                       'application/json')
+
+        _, channel = self.__feeds('2', 'READ2', timezone='America/New_York',
+                                  start='2021-03-01 10:00:00',
+                                  end='2021-03-01 10:00:00')
+        err_msg = 'Time range was not in the timezone'
+        self.assertEqual([e['field1'] for e in channel['feeds']], ['1'],
+                         err_msg)
+
+        _, channel = self.__feeds('2', 'READ2', timezone='America/New_York')
+        err_msg = 'created_at was not in the timezone'
+        self.assertEqual([e['created_at'] for e in channel['feeds']],
+                         ['2021-03-01T10:00:00-05:00',
+                          '2021-07-01T11:00:00-04:00'], err_msg)
+
+        status, _ = self.__feeds('2', 'READ2', timezone='Nowhere/Nothing')
+        self.assertEqual(status, 400, 'Unknown timezone was accepted')
+
+    def test_rate_limit(self):
+        """
+        Test a key can't write again within the interval
+        """
+        self.__stop()
+        self.__start(MemoryStore(), interval=60)
+        self.assertEqual(self.__update('WRITE1', field1=1), (200, '1'),
+                         'First write was rejected')
+        self.assertEqual(self.__update('WRITE1', field1=2), (200, '0'),
+                         'Write within the interval was accepted')
+        self.assertEqual(self.__update('WRITE2', field1=3), (200, '1'),
+                         'Other key was rate limited')
+
+    def test_error_injection(self):
+        """
+        Test injected errors
+        """
+        self.__stop()
+        self.__start(MemoryStore(), error_rate=1)
+        status, _ = self.__update('WRITE1', field1=1)
+        self.assertEqual(status, 500, 'Error was not injected')
+
+
+if __name__ == '__main__':
+    main()
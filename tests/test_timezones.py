@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+test_timezones.py
+"""
+import os
+from unittest import TestCase, main
+from timezones import PosixRule, utc_offset
+
+# 2020-11-22 19:03:17 & 2020-06-24 12:00:00 UTC
+WINTER = 1606071797
+SUMMER = 1593000000
+# 2040-07-01 00:00:00 UTC, after the last transition of most TZif files
+FUTURE = 2224972800
+
+
+class TestUtcOffset(TestCase):
+
+    def test_offsets(self):
+        """
+        Test standard & daylight saving offsets in both hemispheres
+        """
+        self.assertEqual(utc_offset('America/New_York', WINTER), -18000)
+        self.assertEqual(utc_offset('America/New_York', SUMMER), -14400)
+        self.assertEqual(utc_offset('America/New_York', FUTURE), -14400)
+        self.assertEqual(utc_offset('Australia/Sydney', WINTER), 39600)
+        self.assertEqual(utc_offset('Australia/Sydney', SUMMER), 36000)
+        self.assertEqual(utc_offset('Asia/Kolkata', WINTER), 19800)
+        self.assertEqual(utc_offset('UTC', WINTER), 0)
+
+    def test_process_timezone(self):
+        """
+        Test the process TZ isn't touched
+        """
+        saved = os.environ.get('TZ')
+        utc_offset('Europe/Paris', WINTER)
+        self.assertEqual(os.environ.get('TZ'), saved)
+
+    def test_unknown(self):
+        """
+        Test unknown & out of tree timezones are rejected
+        """
+        for name in ('Mars/Olympus_Mons', '../../../etc/passwd', ''):
+            with self.assertRaises(Exception, msg=name):
+                utc_offset(name, WINTER)
+
+
+class TestPosixRule(TestCase):
+
+    def test_rules(self):
+        """
+        Test the TZ strings of TZif footers around their transitions
+        """
+        rule = PosixRule('EST5EDT,M3.2.0,M11.1.0')
+        # DST starts 2020-03-08 02:00 EST & ends 2020-11-01 02:00 EDT
+        self.assertEqual(rule.offset(1583650799), -18000)
+        self.assertEqual(rule.offset(1583650800), -14400)
+        self.assertEqual(rule.offset(1604210399), -14400)
+        self.assertEqual(rule.offset(1604210400), -18000)
+
+        rule = PosixRule('AEST-10AEDT,M10.1.0,M4.1.0/3')
+        self.assertEqual(rule.offset(WINTER), 39600)
+        self.assertEqual(rule.offset(SUMMER), 36000)
+
+        self.assertEqual(PosixRule('<+0330>-3:30').offset(WINTER), 12600)
+        with self.assertRaises(Exception):
+            PosixRule('not a rule')
+
+
+if __name__ == '__main__':
+    main()
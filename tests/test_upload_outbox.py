@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+test_upload_outbox.py
+"""
+import os
+from unittest import TestCase, main
+from upload_outbox import UploadOutbox
+
+TEMP_OUTBOX_DB = 'temp_outbox.db'
+
+
+class TestUploadOutbox(TestCase):
+
+    def setUp(self):
+        self.__outbox = UploadOutbox(TEMP_OUTBOX_DB, backoff_base=60)
+
+    def tearDown(self):
+        self.__outbox.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(TEMP_OUTBOX_DB + suffix):
+                os.remove(TEMP_OUTBOX_DB + suffix)
+
+    def test_order(self):
+        """
+        Test uploads are handed out oldest first & survive a reopen
+        """
+        self.__outbox.put(1, {'field1': 1, 'field2': 500})
+        self.__outbox.put(2, {'field1': 2, 'field3': 30})
+        self.__outbox.close()
+        self.__outbox = UploadOutbox(TEMP_OUTBOX_DB)
+
+        err_msg = 'Backlog was not kept on disk'
+        self.assertEqual(len(self.__outbox), 2, err_msg)
+
+        seq, device_id, fields = self.__outbox.head()
+        err_msg = 'Oldest upload was not first'
+        self.assertEqual((device_id, fields), (1, {'field1': 1,
+                                                   'field2': 500}), err_msg)
+
+        self.__outbox.ack(seq)
+        err_msg = 'Accepted upload was not removed'
+        self.assertEqual(self.__outbox.head()[1], 2, err_msg)
+        self.assertEqual(len(self.__outbox), 1, err_msg)
+
+    def test_retry(self):
+        """
+        Test a failed upload backs off & holds back the ones behind it
+        """
+        self.__outbox.put(1, {'field1': 1})
+        self.__outbox.put(2, {'field1': 2})
+        seq = self.__outbox.head()[0]
+
+        delay = self.__outbox.retry(seq)
+        err_msg = 'Backoff is outside its jitter range'
+        self.assertTrue(30 <= delay <= 60, err_msg)
+        err_msg = 'Upload behind a failed one was handed out'
+        self.assertIsNone(self.__outbox.head(), err_msg)
+
+        delay = self.__outbox.retry(seq)
+        err_msg = 'Backoff did not grow'
+        self.assertTrue(60 <= delay <= 120, err_msg)
+
+        err_msg = 'Failed upload was lost'
+        self.assertEqual(len(self.__outbox), 2, err_msg)
+
+    def test_dead_letter(self):
+        """
+        Test an upload rejected max_rejections times stops holding back
+        the others
+        """
+        self.__outbox.close()
+        self.__outbox = UploadOutbox(TEMP_OUTBOX_DB, backoff_base=0,
+                                     max_rejections=3)
+        self.__outbox.put(1, {'field1': 1})
+        self.__outbox.put(2, {'field1': 2})
+        seq = self.__outbox.head()[0]
+
+        err_msg = 'Failures to reach the cloud were counted as rejections'
+        for _ in range(5):
+            self.assertIsNotNone(self.__outbox.retry(seq), err_msg)
+
+        self.assertIsNotNone(self.__outbox.retry(seq, rejected=True))
+        self.assertIsNotNone(self.__outbox.retry(seq, rejected=True))
+        err_msg = 'Upload was not given up on'
+        self.assertIsNone(self.__outbox.retry(seq, rejected=True), err_msg)
+        self.assertEqual(self.__outbox.dead_letters(), 1, err_msg)
+
+        err_msg = 'Upload behind the given up one was held back'
+        self.assertEqual(self.__outbox.head()[1], 2, err_msg)
+        self.assertEqual(len(self.__outbox), 1, err_msg)
+
+
+if __name__ == '__main__':
+    main()
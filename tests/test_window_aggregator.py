@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+test_window_aggregator.py
+"""
+from unittest import TestCase, main
+from unittest.mock import patch
+from window_aggregator import WindowAggregator
+import constants as c
+
+
+@patch('window_aggregator.time.monotonic')
+class TestWindowAggregator(TestCase):
+
+    def test_summary(self, mock_monotonic):
+        """
+        Test windows are summarized per device once window_secs elapsed
+        """
+        mock_monotonic.return_value = 0
+        aggregator = WindowAggregator(window_secs=60)
+        for value in (50, 60, 70):
+            aggregator.add(1, 'Room 1', 'humidity', value)
+        aggregator.add(2, 'Room 2', 'humidity', 45)
+
+        mock_monotonic.return_value = 30
+        self.assertEqual(aggregator.flush(), [])
+
+        mock_monotonic.return_value = 60
+        summaries = {s.id: s for s in aggregator.flush()}
+        self.assertEqual(len(summaries), 2)
+        self.assertEqual(summaries[1].count, 3)
+        self.assertEqual(summaries[1].mean, 60)
+        self.assertEqual(summaries[1].minimum, 50)
+        self.assertEqual(summaries[1].maximum, 70)
+        self.assertEqual(summaries[2].mean, 45)
+
+        # Windows without new readings are dropped
+        mock_monotonic.return_value = 120
+        self.assertEqual(aggregator.flush(), [])
+        self.assertEqual(len(aggregator), 0)
+
+    def test_threshold_crossing(self, mock_monotonic):
+        """
+        Test readings crossing the alert threshold are flagged
+        """
+        mock_monotonic.return_value = 0
+        aggregator = WindowAggregator(window_secs=60)
+        low = c.CO2_THRESHOLD - 100
+        high = c.CO2_THRESHOLD + 100
+        self.assertFalse(aggregator.add(1, 'Room 1', 'co2', low))
+        self.assertFalse(aggregator.add(1, 'Room 1', 'co2', low))
+        self.assertTrue(aggregator.add(1, 'Room 1', 'co2', high))
+        self.assertFalse(aggregator.add(1, 'Room 1', 'co2', high))
+        self.assertTrue(aggregator.add(1, 'Room 1', 'co2', low))
+
+        # A device's first reading is flagged if it's already in warning
+        self.assertTrue(aggregator.add(2, 'Room 2', 'co2', high))
+        self.assertFalse(aggregator.add(2, 'Room 2', 'co2', high))
+
+
+if __name__ == '__main__':
+    main()